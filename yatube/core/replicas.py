@@ -0,0 +1,94 @@
+"""Чтение лент с реплик базы.
+
+Запросы к моделям из DATABASE_REPLICA_APPS внутри view, помеченных
+reads_from_replica, уходят на случайную реплику из DATABASE_REPLICAS;
+все записи и остальные чтения - в default. Реплика отстаёт от
+основной базы, поэтому пользователь, который только что сам что-то
+записал, DATABASE_REPLICA_STICKY_SECONDS секунд читает из default
+(см. pin_primary) и сразу видит свой пост, комментарий или подписку.
+
+Отрисованное с отстающей реплики нельзя класть в кеши с версией ленты:
+версия уже свежая, а данные ещё старые, и кеш отдавал бы их часами.
+Поэтому кеши фрагментов и карточек пополняются только при чтениях
+из default (см. replica_reads), а страницу для кеша анонимов view
+отрисовывает, читая из default (см. read_primary).
+"""
+from contextvars import ContextVar
+from functools import wraps
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PIN_SESSION_KEY = 'db_primary_until'
+
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if (not _replica_reads.get() or not settings.DATABASE_REPLICAS
+                or model._meta.app_label
+                not in settings.DATABASE_REPLICA_APPS):
+            return None
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        # Иначе объект, прочитанный с реплики, Django записал бы туда
+        # же, откуда его прочитал.
+        instance = hints.get('instance')
+        if (instance is not None
+                and instance._state.db in settings.DATABASE_REPLICAS):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Реплики получают схему вместе с данными основной базы.
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+def pin_primary(request):
+    """Следующие чтения пользователя какое-то время идут в default."""
+    request.session[PIN_SESSION_KEY] = (
+        time.time() + settings.DATABASE_REPLICA_STICKY_SECONDS)
+
+
+def is_pinned(request):
+    # Без cookie сессии записей у посетителя не было; сессию
+    # не трогаем, чтобы не добавлять ответу Vary: Cookie.
+    if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+        return False
+    return request.session.get(PIN_SESSION_KEY, 0) > time.time()
+
+
+def read_primary(request):
+    """Чтения view этого запроса идут в default."""
+    request.reads_primary = True
+
+
+def replica_reads():
+    """Могут ли чтения текущего view уйти на реплику."""
+    return bool(_replica_reads.get() and settings.DATABASE_REPLICAS)
+
+
+def reads_from_replica(view):
+    """Декоратор view, чтения которого можно отдать реплике."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        token = _replica_reads.set(
+            not getattr(request, 'reads_primary', False)
+            and not is_pinned(request))
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+    return wrapper
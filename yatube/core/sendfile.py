@@ -0,0 +1,131 @@
+"""Отдача файлов с диска для медиа и кеша картинок.
+
+Если задан SENDFILE_HEADER, ответ пустой: файл по заголовку
+X-Accel-Redirect (nginx) или X-Sendfile (Apache, lighttpd) отдаёт
+веб-сервер, он же разбирает Range. Иначе файл читается потоком через
+FileResponse, а запросы Range и условные запросы (If-None-Match,
+If-Modified-Since, If-Range) обрабатываются здесь.
+"""
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeFile:
+    """Часть открытого файла длиной length с позиции start."""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def serve(request, path, cache_control=None):
+    """Ответ с файлом path; path уже проверен вызывающим кодом."""
+    stat = os.stat(path)
+    etag = quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = accel_response(path)
+    if response is None:
+        response = file_response(request, path, stat.st_size, etag,
+                                 last_modified)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if cache_control:
+        response['Cache-Control'] = cache_control
+    return response
+
+
+def accel_response(path):
+    """Пустой ответ, файл которого отдаст веб-сервер, или None."""
+    header = settings.SENDFILE_HEADER
+    if header is None:
+        return None
+    if header == 'X-Accel-Redirect':
+        # nginx знает файлы только по internal location.
+        for root, location in settings.SENDFILE_LOCATIONS.items():
+            relative = os.path.relpath(path, root)
+            if not relative.startswith(os.pardir):
+                value = location.rstrip('/') + '/' + relative.replace(
+                    os.sep, '/')
+                break
+        else:
+            return None
+    else:
+        value = path
+    content_type, encoding = mimetypes.guess_type(path)
+    response = HttpResponse(
+        content_type=content_type or 'application/octet-stream')
+    response[header] = value
+    return response
+
+
+def file_response(request, path, size, etag, last_modified):
+    content_type, encoding = mimetypes.guess_type(path)
+    content_type = content_type or 'application/octet-stream'
+    byte_range = requested_range(request, size, etag, last_modified)
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    elif byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    else:
+        start, end = byte_range
+        response = FileResponse(
+            RangeFile(open(path, 'rb'), start, end - start + 1),
+            status=206, content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def requested_range(request, size, etag, last_modified):
+    """Диапазон (первый, последний байт) из заголовка Range.
+
+    None - отдать файл целиком: Range нет, он не разобран, состоит
+    из нескольких диапазонов или If-Range говорит, что файл сменился.
+    False - диапазон за концом файла (416).
+    """
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', '').strip())
+    if match is None or request.method != 'GET':
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag and (
+            parse_http_date_safe(if_range) != last_modified):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    elif last:
+        start, end = max(size - int(last), 0), size - 1
+        if not int(last):
+            return False
+    else:
+        return None
+    if start >= size:
+        return False
+    return start, end
@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.db.utils import ConnectionHandler
+from django.test import SimpleTestCase, override_settings
+
+
+class SqlitePragmasTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        # Новое соединение с отдельной базой в файле: соединение
+        # с тестовой базой открыто раньше теста.
+        self.connection = ConnectionHandler({'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(directory, 'pragmas.sqlite3'),
+        }})['default']
+        self.addCleanup(self.connection.close)
+
+    # Значение не совпадает с таймаутом sqlite3 по умолчанию (5 с).
+    @override_settings(SQLITE_PRAGMAS={**settings.SQLITE_PRAGMAS,
+                                       'busy_timeout': 1234})
+    def test_pragmas_applied_to_new_connections(self):
+        """Каждое новое соединение получает прагмы из SQLITE_PRAGMAS"""
+        expected = (
+            ('journal_mode', 'wal'),
+            # NORMAL
+            ('synchronous', 1),
+            ('busy_timeout', 1234),
+        )
+        with self.connection.cursor() as cursor:
+            for pragma, value in expected:
+                with self.subTest(pragma=pragma):
+                    cursor.execute(f'PRAGMA {pragma}')
+                    self.assertEqual(cursor.fetchone()[0], value)
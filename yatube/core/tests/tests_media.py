@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
+CONTENT = bytes(range(256)) * 4
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class MediaViewTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        os.makedirs(os.path.join(TEMP_MEDIA_ROOT, 'posts'), exist_ok=True)
+        with open(os.path.join(TEMP_MEDIA_ROOT, 'posts', 'file.bin'),
+                  'wb') as file:
+            file.write(CONTENT)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def get(self, **headers):
+        response = self.client.get('/media/posts/file.bin', **headers)
+        if response.streaming:
+            response.body = b''.join(response.streaming_content)
+            response.close()
+        else:
+            response.body = response.content
+        return response
+
+    def test_whole_file(self):
+        """Файл отдаётся потоком с валидаторами для кеша"""
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, CONTENT)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+
+    def test_range(self):
+        """Запрос Range получает только нужные байты"""
+        cases = (
+            ('bytes=10-19', 206, CONTENT[10:20], 'bytes 10-19/1024'),
+            ('bytes=1000-', 206, CONTENT[1000:], 'bytes 1000-1023/1024'),
+            ('bytes=-4', 206, CONTENT[-4:], 'bytes 1020-1023/1024'),
+            ('bytes=2000-', 416, b'', 'bytes */1024'),
+        )
+        for header, status, content, content_range in cases:
+            with self.subTest(range=header):
+                response = self.get(HTTP_RANGE=header)
+                self.assertEqual(response.status_code, status)
+                self.assertEqual(response.body, content)
+                self.assertEqual(response['Content-Range'], content_range)
+
+    def test_conditional_requests(self):
+        """Неизменившийся файл даёт 304, устаревший If-Range - весь файл"""
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"old"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, CONTENT)
+
+    def test_outside_media_root(self):
+        """Файлы вне MEDIA_ROOT не отдаются"""
+        response = self.client.get('/media/../manage.py')
+        self.assertEqual(response.status_code, 404)
+
+    def test_accel_redirect(self):
+        """При SENDFILE_HEADER файл отдаёт веб-сервер"""
+        with override_settings(
+                SENDFILE_HEADER='X-Accel-Redirect',
+                SENDFILE_LOCATIONS={TEMP_MEDIA_ROOT: '/internal/media/'}):
+            response = self.get()
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/internal/media/posts/file.bin')
+        self.assertEqual(response.body, b'')
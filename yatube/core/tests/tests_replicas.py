@@ -0,0 +1,108 @@
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.db import router, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from core.replicas import PIN_SESSION_KEY, reads_from_replica
+from posts import feed_cache
+from posts.middleware import AnonymousPageCacheMiddleware
+from posts.models import Post
+from posts.templatetags.post_cards import card_keys, post_cards
+
+User = get_user_model()
+
+
+@override_settings(DATABASE_REPLICAS=('replica',))
+class ReplicaRouterTests(TestCase):
+    def read_databases(self, request):
+        @reads_from_replica
+        def view(request):
+            return (router.db_for_read(Post), router.db_for_read(User),
+                    router.db_for_write(Post))
+        return view(request)
+
+    def test_feed_reads_go_to_replica(self):
+        """Внутри view посты читаются с реплики, всё остальное - из default"""
+        request = RequestFactory().get('/')
+        self.assertEqual(self.read_databases(request),
+                         ('replica', 'default', 'default'))
+        self.assertEqual(router.db_for_read(Post), 'default')
+
+    def test_pinned_user_reads_primary(self):
+        """После своей записи пользователь читает из default"""
+        request = RequestFactory().get('/')
+        request.COOKIES['sessionid'] = 'key'
+        for until, database in ((time.time() + 10, 'default'),
+                                (time.time() - 10, 'replica')):
+            with self.subTest(until=until):
+                request.session = {PIN_SESSION_KEY: until}
+                self.assertEqual(self.read_databases(request)[0], database)
+
+    def test_replica_renders_not_cached(self):
+        """Отрисованное с реплики не попадает в кеш фрагментов и карточек"""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        post = Post.objects.create(
+            author=User.objects.create_user(username='author'), text='Пост')
+
+        @reads_from_replica
+        def view(request):
+            post_cards([post])
+            return feed_cache.context('index')['feed_cache_timeout']
+
+        self.assertEqual(view(RequestFactory().get('/')), 0)
+        self.assertFalse(cache.get_many(card_keys(post)))
+
+    def test_anonymous_page_rendered_from_primary(self):
+        """Страницу для кеша анонимов view отрисовывает из default"""
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        @reads_from_replica
+        def view(request):
+            return feed_cache.tag(
+                HttpResponse(router.db_for_read(Post)), 'index')
+
+        response = AnonymousPageCacheMiddleware(view)(
+            RequestFactory().get('/'))
+        self.assertEqual(response.content, b'default')
+
+
+class PinPrimaryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer')
+        self.author = User.objects.create_user(username='author')
+        self.post = Post.objects.create(author=self.author, text='Пост')
+        self.client.force_login(self.user)
+
+    def session(self):
+        key = self.client.cookies['sessionid'].value
+        return Session.objects.get(session_key=key).get_decoded()
+
+    def test_writes_pin_primary(self):
+        """Запись поста, комментария и подписки закрепляет чтения за default"""
+        writes = (
+            (reverse('posts:post_create'), {'text': 'Новый пост'}),
+            (reverse('posts:add_comment', args=(self.post.pk,)),
+             {'text': 'Комментарий'}),
+            (reverse('posts:profile_follow', args=('author',)), None),
+        )
+        for url, data in writes:
+            with self.subTest(url=url):
+                session = self.client.session
+                session.pop(PIN_SESSION_KEY, None)
+                session.save()
+                with mock.patch.object(transaction, 'on_commit',
+                                       lambda func: func()):
+                    if data is None:
+                        self.client.get(url)
+                    else:
+                        self.client.post(url, data)
+                self.assertGreater(self.session()[PIN_SESSION_KEY],
+                                   time.time())
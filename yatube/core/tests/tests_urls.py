@@ -5,7 +5,6 @@ from posts.models import User
 
 class PostsPagesTests(TestCase):
     def setUp(self):
-        super().setUpClass()
         self.user_1 = User.objects.create_user(username='user_1')
         self.authorized_user_1 = Client()
         self.authorized_user_1.force_login(self.user_1)
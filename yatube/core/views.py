@@ -1,7 +1,16 @@
+import os
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404
 from django.shortcuts import render
+from django.utils._os import safe_join
+from django.views.decorators.http import require_safe
 
 from http import HTTPStatus
 
+from . import sendfile
+
 
 def page_not_found(request, exception):
     return render(request, 'core/404.html', {'path': request.path},
@@ -19,3 +28,16 @@ def internal_server_error(request, *args, **argv):
 
 def error_403(request, exception):
     return render(request, 'core/403.html', status=HTTPStatus.FORBIDDEN)
+
+
+@require_safe
+def media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+    return sendfile.serve(
+        request, full_path,
+        cache_control=f'public, max-age={settings.MEDIA_CACHE_MAX_AGE}')
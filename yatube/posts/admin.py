@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import Post, Group, Comment, Follow
+from . import archive, search
+from .models import ArchivedPost, Post, Group, Comment, Follow
 
 
 class PostAdmin(admin.ModelAdmin):
@@ -10,6 +11,42 @@ class PostAdmin(admin.ModelAdmin):
     empty_value_display = '-пусто-'
     list_editable = ('group',)
 
+    def get_search_results(self, request, queryset, search_term):
+        # Вместо LIKE '%слово%' по всей таблице - полнотекстовый индекс.
+        if not search.available(queryset.db) or not search.match_expression(
+                search_term):
+            return super().get_search_results(request, queryset,
+                                              search_term)
+        return search.filter_matching(queryset, search_term), False
+
+
+class ArchivedPostAdmin(PostAdmin):
+    """Посты архива: все запросы раздела идут в POST_ARCHIVE_DATABASE,
+    как в примере с несколькими базами из документации Django."""
+
+    # Авторы и группы лежат в default: JOIN в архиве невозможен.
+    list_select_related = ()
+
+    def has_module_permission(self, request):
+        return archive.enabled() and super().has_module_permission(request)
+
+    def has_add_permission(self, request):
+        # В архив посты только переносятся командой archive_posts.
+        return False
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if not archive.enabled():
+            return queryset.none()
+        return queryset.using(archive.database()).prefetch_related(
+            'author', 'group')
+
+    def save_model(self, request, obj, form, change):
+        obj.save(using=archive.database())
+
+    def delete_model(self, request, obj):
+        obj.delete(using=archive.database())
+
 
 class GroupAdmin(admin.ModelAdmin):
     list_display = ('pk', 'title', 'slug')
@@ -31,6 +68,7 @@ class FollowAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Post, PostAdmin)
+admin.site.register(ArchivedPost, ArchivedPostAdmin)
 admin.site.register(Group, GroupAdmin)
 admin.site.register(Comment, CommentAdmin)
 admin.site.register(Follow, FollowAdmin)
@@ -0,0 +1,138 @@
+"""Архив старых постов.
+
+Почти все чтения лент приходятся на последние недели, поэтому команда
+archive_posts переносит посты старше POST_ARCHIVE_AFTER_DAYS дней
+вместе с комментариями в базу POST_ARCHIVE_DATABASE с той же схемой,
+сохраняя id. Горячие таблицы шардов и default от этого не растут.
+
+Ленты (см. posts.paginators.tiers) читают архив, только когда
+листают глубже горячих постов, а страница поста ищет его в архиве,
+если в горячей базе его нет (get_object_or_404). Архивные посты
+по-прежнему можно править и комментировать: ArchiveRouter оставляет
+такие записи в архиве, а автора и группу читает из default.
+
+Поиск (posts.search) ищет и по архиву, а в админке архивные посты
+показывает отдельный раздел (ArchivedPostAdmin).
+"""
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.http import Http404
+from django.shortcuts import get_object_or_404 as _get_object_or_404
+
+from . import paginators, shards
+from .models import Comment, Post
+
+ARCHIVED_MODELS = (Post, Comment)
+
+
+def enabled():
+    return bool(settings.POST_ARCHIVE_DATABASE)
+
+
+def database():
+    return settings.POST_ARCHIVE_DATABASE
+
+
+def first(queryset):
+    """queryset.first(), а если в горячей базе строки нет - из архива."""
+    row = queryset.first()
+    if row is None and enabled():
+        row = queryset.using(database()).first()
+    return row
+
+
+def get_object_or_404(queryset, **kwargs):
+    """get_object_or_404, которая ищет и в архиве."""
+    try:
+        return queryset.get(**kwargs)
+    except queryset.model.DoesNotExist:
+        if not enabled():
+            raise Http404(f'No {queryset.model._meta.object_name} '
+                          f'matches the given query.')
+    return _get_object_or_404(queryset.using(database()), **kwargs)
+
+
+def hot_parts(queryset):
+    """Тот же запрос к каждой горячей базе - без архива."""
+    return paginators.spread(queryset, settings.POST_SHARDS)
+
+
+def archive_posts(before, batch_size, pause=0.0):
+    """Переносит в архив посты, опубликованные раньше before, вместе
+    с комментариями; возвращает число перенесённых постов."""
+    posts = Post.objects.filter(pub_date__lt=before)
+    return sum(_archive(part, batch_size, pause)
+               for part in hot_parts(posts))
+
+
+def _archive(posts, batch_size, pause):
+    # Как при переносе между шардами (см. shards.move_author), строки
+    # удаляются мимо сигналов и каскадов: пост только сменил базу.
+    source, target = posts.db, database()
+    posts = posts.order_by('pk')
+    archived = last_pk = 0
+    retry = False
+    while True:
+        try:
+            with transaction.atomic(using=source):
+                batch = list(posts.filter(pk__gt=last_pk)[:batch_size])
+                if not batch:
+                    return archived
+                post_ids = [post.pk for post in batch]
+                comments = list(Comment.objects.using(source).filter(
+                    post_id__in=post_ids))
+                with transaction.atomic(using=target):
+                    shards.copy_rows(Post, batch, target)
+                    if retry:
+                        Post.objects.using(target).bulk_update(
+                            batch, shards.POST_FIELDS)
+                    shards.copy_rows(Comment, comments, target)
+                    shards.reserve_ids(target)
+                shards.delete_rows(
+                    Comment, [comment.pk for comment in comments], source)
+                shards.delete_rows(Post, post_ids, source)
+        except IntegrityError:
+            # Пока пачка копировалась, к её посту написали комментарий:
+            # внешний ключ не дал удалить пост, переносим пачку заново.
+            if retry:
+                raise
+            retry = True
+            continue
+        retry = False
+        last_pk = post_ids[-1]
+        archived += len(batch)
+        time.sleep(pause)
+
+
+class ArchiveRouter:
+    """Оставляет в архиве запросы к архивным постам и комментариям."""
+
+    def db_for_read(self, model, **hints):
+        return self._database(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self._database(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if enabled() and database() in (obj1._state.db, obj2._state.db):
+            return True
+        return None
+
+    def _database(self, model, instance):
+        if instance is None or not enabled() or not _archived(instance):
+            return None
+        if model._meta.concrete_model in ARCHIVED_MODELS:
+            return database()
+        # Автор и группа архивного поста лежат в default.
+        return DEFAULT_DB_ALIAS
+
+
+def _archived(instance):
+    if isinstance(instance, Comment) and instance._state.adding:
+        # Новый комментарий ложится в базу своего поста.
+        instance = Comment._meta.get_field('post').get_cached_value(
+            instance, None)
+    return (isinstance(instance, ARCHIVED_MODELS)
+            and instance._state.db == database())
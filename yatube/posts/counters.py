@@ -0,0 +1,128 @@
+"""Денормализованные счётчики постов, подписок и комментариев.
+
+Счётчики меняются F()-выражениями из сигналов (см. posts.signals),
+а команда reconcile_counters исправляет накопившиеся расхождения.
+"""
+from collections import Counter
+
+from django.db.models import Count, F
+
+from . import shards
+from .models import AuthorStats, Comment, Follow, Post, User
+
+
+def bump_author(user_id, **deltas):
+    """Сдвигает счётчики автора, например bump_author(1, posts_count=-1).
+
+    Счётчик не уходит ниже нуля. Если строки счётчиков ещё нет,
+    при увеличении она создаётся пересчётом.
+    """
+    stats = AuthorStats.objects.filter(user_id=user_id)
+    for field, delta in deltas.items():
+        if delta < 0:
+            stats = stats.filter(**{f'{field}__gte': -delta})
+    updated = stats.update(
+        **{field: F(field) + delta for field, delta in deltas.items()})
+    if not updated and all(delta > 0 for delta in deltas.values()):
+        recount_author(user_id)
+
+
+def bump_comments(post_id, delta, using=None):
+    posts = Post.objects.db_manager(using).filter(pk=post_id)
+    if delta < 0:
+        posts = posts.filter(comments_count__gte=-delta)
+    posts.update(comments_count=F('comments_count') + delta)
+
+
+def recount_author(user_id):
+    stats, _ = AuthorStats.objects.update_or_create(
+        user_id=user_id,
+        defaults={
+            'posts_count': sum(posts.count() for posts
+                               in shards.author_parts(user_id)),
+            'followers_count': Follow.objects.filter(
+                author_id=user_id).count(),
+            'following_count': Follow.objects.filter(
+                user_id=user_id).count(),
+        },
+    )
+    return stats
+
+
+def stats_for(user):
+    try:
+        return user.stats
+    except AuthorStats.DoesNotExist:
+        return recount_author(user.pk)
+
+
+def _counts(queryset, field, pks):
+    return dict(queryset.filter(**{f'{field}__in': pks})
+                .values_list(field).annotate(Count('pk')).order_by())
+
+
+def reconcile_authors(batch_size):
+    """Сверяет счётчики авторов пачками по batch_size пользователей.
+
+    Возвращает число исправленных строк.
+    """
+    fixed = 0
+    user_ids = User.objects.order_by('pk').values_list('pk', flat=True)
+    last_pk = 0
+    while True:
+        pks = list(user_ids.filter(pk__gt=last_pk)[:batch_size])
+        if not pks:
+            return fixed
+        last_pk = pks[-1]
+        posts = sum((Counter(_counts(part, 'author_id', pks))
+                     for part in shards.spread(Post.objects.all())),
+                    Counter())
+        followers = _counts(Follow.objects, 'author_id', pks)
+        following = _counts(Follow.objects, 'user_id', pks)
+        current = AuthorStats.objects.in_bulk(pks)
+        created, changed = [], []
+        for pk in pks:
+            actual = AuthorStats(
+                user_id=pk,
+                posts_count=posts.get(pk, 0),
+                followers_count=followers.get(pk, 0),
+                following_count=following.get(pk, 0),
+            )
+            stats = current.get(pk)
+            if stats is None:
+                created.append(actual)
+            elif (stats.posts_count, stats.followers_count,
+                  stats.following_count) != (actual.posts_count,
+                                             actual.followers_count,
+                                             actual.following_count):
+                changed.append(actual)
+        AuthorStats.objects.bulk_create(created)
+        AuthorStats.objects.bulk_update(
+            changed, ('posts_count', 'followers_count', 'following_count'))
+        fixed += len(created) + len(changed)
+
+
+def reconcile_comments(batch_size):
+    """Сверяет Post.comments_count пачками; возвращает число исправлений."""
+    return sum(_reconcile_comments(posts, batch_size)
+               for posts in shards.spread(Post.objects.all()))
+
+
+def _reconcile_comments(posts, batch_size):
+    fixed = 0
+    post_ids = posts.order_by('pk').values_list('pk', flat=True)
+    last_pk = 0
+    while True:
+        pks = list(post_ids.filter(pk__gt=last_pk)[:batch_size])
+        if not pks:
+            return fixed
+        last_pk = pks[-1]
+        comments = _counts(Comment.objects.using(posts.db), 'post_id', pks)
+        changed = [
+            Post(pk=pk, comments_count=comments.get(pk, 0))
+            for pk, count in posts.filter(pk__in=pks).values_list(
+                'pk', 'comments_count')
+            if count != comments.get(pk, 0)
+        ]
+        posts.bulk_update(changed, ('comments_count',))
+        fixed += len(changed)
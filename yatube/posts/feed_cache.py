@@ -0,0 +1,120 @@
+"""Версии кеша лент и страниц.
+
+Фрагменты лент кешируются под ключом с версией ленты. Сигналы
+(см. posts.signals) меняют версию при записи поста, поэтому фрагмент
+можно хранить часами и при этом сразу показывать изменения.
+Общая версия GLOBAL_SCOPE меняется, когда у группы меняется slug
+или её удаляют: это затрагивает карточки во всех лентах. Смена имени
+автора меняет версии только тех лент, где есть его посты, а правка
+названия или описания группы - только версию её страницы
+(см. posts.signals).
+
+Те же версии служат тегами страниц в кеше для анонимов
+(см. posts.middleware): 'index', 'group:<id>', 'author:<id>',
+'post:<id>'.
+"""
+from datetime import datetime, timezone
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.views.decorators.http import condition
+
+from core import replicas
+
+
+VERSION_KEY_PREFIX = 'feed-version'
+GLOBAL_SCOPE = 'global'
+
+
+def _key(scope):
+    return f'{VERSION_KEY_PREFIX}:{scope}'
+
+
+def scope(*parts):
+    return ':'.join(str(part) for part in parts)
+
+
+def versions(*scopes):
+    """Версии общей области и scopes - время последнего изменения
+    в наносекундах, так что вытесненный из кеша счётчик не начнётся
+    заново со старого значения."""
+    keys = [_key(name) for name in (GLOBAL_SCOPE,) + scopes]
+    stored = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in stored}
+    if missing:
+        cache.set_many(missing, None)
+        stored.update(missing)
+    return [stored[key] for key in keys]
+
+
+def version(*scopes):
+    """Версия ленты для ключа {% cache %}."""
+    return '-'.join(str(value) for value in versions(*scopes))
+
+
+def post_scopes(post):
+    """Теги страниц, на которых выводится пост."""
+    scopes = ['index', scope('author', post.author_id),
+              scope('post', post.pk)]
+    if post.group_id:
+        scopes.append(scope('group', post.group_id))
+    return scopes
+
+
+def bump(*scopes):
+    now = time.time_ns()
+    cache.set_many({_key(name): now for name in scopes}, None)
+
+
+def context(*scopes):
+    # Фрагмент, отрисованный с реплики, не сохраняется: {% cache %}
+    # с нулевым сроком только читает кеш.
+    return {
+        'feed_cache_timeout': (0 if replicas.replica_reads()
+                               else settings.FEED_CACHE_TIMEOUT),
+        'feed_version': version(*scopes),
+    }
+
+
+def tag(response, *scopes):
+    """Разрешает закешировать ответ для анонимов под тегами scopes."""
+    response.cache_scopes = scopes
+    return response
+
+
+def rendered_version(request, *scopes):
+    """Версия scopes, прочитанная до отрисовки страницы (см. conditional),
+    или None. Версия, прочитанная после, могла уже смениться записью,
+    которой на странице нет."""
+    if getattr(request, 'page_scopes', None) != scopes:
+        return None
+    return '-'.join(str(value) for value in request.page_versions)
+
+
+def conditional(scopes_func):
+    """Декоратор view с ETag и Last-Modified по версиям scopes.
+
+    scopes_func(request, *args, **kwargs) возвращает теги страницы и
+    должна быть дешёвой: валидаторы считаются до основных запросов
+    view, и на совпадение клиент получает 304 без отрисовки шаблона.
+    ETag учитывает пользователя, потому что шапка сайта у всех своя.
+    """
+    def page_versions(request, *args, **kwargs):
+        if not hasattr(request, 'page_versions'):
+            request.page_scopes = tuple(scopes_func(request, *args, **kwargs))
+            request.page_versions = versions(*request.page_scopes)
+        return request.page_versions
+
+    def etag(request, *args, **kwargs):
+        raw = '{}:{}'.format(
+            '-'.join(map(str, page_versions(request, *args, **kwargs))),
+            request.user.pk or '')
+        return hashlib.md5(raw.encode()).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        changed = max(page_versions(request, *args, **kwargs))
+        return datetime.fromtimestamp(changed / 10 ** 9, tz=timezone.utc)
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
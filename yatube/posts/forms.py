@@ -8,6 +8,17 @@ class PostForm(forms.ModelForm):
         model = Post
         fields = ('text', 'group', 'image')
 
+    def __init__(self, *args, rejected_uploads=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Картинки, отброшенные ещё при приёме запроса (см. posts.uploads).
+        self.rejected_uploads = rejected_uploads or {}
+
+    def clean(self):
+        cleaned_data = super().clean()
+        for field, error in self.rejected_uploads.items():
+            self.add_error(field, error)
+        return cleaned_data
+
 
 class CommentForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from posts import archive
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = ('Переносит старые посты с комментариями в архив '
+            'POST_ARCHIVE_DATABASE пачками, не останавливая сайт')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=settings.POST_ARCHIVE_AFTER_DAYS,
+                            help='Переносить посты старше стольких дней')
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.POST_ARCHIVE_BATCH_SIZE,
+                            help='Сколько постов переносить за раз')
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='Пауза между пачками, с')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только посчитать посты')
+
+    def handle(self, *args, **options):
+        if not archive.enabled():
+            raise CommandError('POST_ARCHIVE_DATABASE не задан')
+        before = timezone.now() - timedelta(days=options['days'])
+        if options['dry_run']:
+            count = sum(part.count() for part in archive.hot_parts(
+                Post.objects.filter(pub_date__lt=before)))
+            self.stdout.write(f'Постов старше {before:%Y-%m-%d}: {count}')
+            return
+        count = archive.archive_posts(before, options['batch_size'],
+                                      options['pause'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Перенесено в архив постов: {count}'))
@@ -0,0 +1,145 @@
+from contextlib import nullcontext
+import random
+from statistics import mean
+from time import perf_counter
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+
+from posts import timelines
+from posts.models import Follow, Post, TimelineEntry
+from posts.paginators import KeysetPaginator, TimelinePaginator
+
+User = get_user_model()
+
+PER_PAGE = 10
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает ленту подписок при чтении через JOIN (pull), '
+            'раскладке при записи (push) и гибридной схеме на '
+            'отдельной тестовой базе')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--edges', default='10000,100000,1000000',
+                            help='Число подписок через запятую')
+        parser.add_argument('--posts', type=int, default=5,
+                            help='Постов на автора')
+        parser.add_argument('--threshold', type=int, default=None,
+                            help='Порог подписчиков для гибридной схемы, '
+                                 'по умолчанию 10%% читателей')
+        parser.add_argument('--samples', type=int, default=50,
+                            help='Сколько лент читать и постов писать')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.stdout.write(
+                f'{"edges":>9} {"strategy":>8} {"build, s":>9} '
+                f'{"write, ms":>10} {"rows/post":>10} {"read, ms":>9}')
+            for edges in map(int, options['edges'].split(',')):
+                self.run_size(edges, options)
+        finally:
+            cache.delete(timelines.CELEBRITIES_KEY)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run_size(self, edges, options):
+        readers, authors = self.populate(edges, options['posts'])
+        threshold = options['threshold'] or max(1, len(readers) // 10)
+        sample_readers = random.sample(readers, min(options['samples'],
+                                                    len(readers)))
+        sample_authors = random.choices(authors, k=options['samples'])
+        strategies = (('pull', None), ('push', None), ('hybrid', threshold))
+        for name, celebrity_followers in strategies:
+            with override_settings(
+                    TIMELINE_CELEBRITY_FOLLOWERS=celebrity_followers):
+                build = self.build(name)
+                write, rows = self.write(name, sample_authors)
+                read = self.read(name, sample_readers)
+            self.stdout.write(
+                f'{edges:>9} {name:>8} {build:>9.2f} {write:>10.2f} '
+                f'{rows:>10.1f} {read:>9.2f}')
+
+    def populate(self, edges, posts_per_author):
+        TimelineEntry.objects.all().delete()
+        Follow.objects.all().delete()
+        Post.objects.all().delete()
+        User.objects.all().delete()
+        reader_count = max(1000, edges // 20)
+        author_count = max(100, edges // 100)
+        User.objects.bulk_create(
+            (User(username=f'reader{i}') for i in range(reader_count)))
+        User.objects.bulk_create(
+            (User(username=f'author{i}') for i in range(author_count)))
+        readers = list(User.objects.filter(
+            username__startswith='reader').values_list('pk', flat=True))
+        authors = list(User.objects.filter(
+            username__startswith='author').values_list('pk', flat=True))
+        # Популярность авторов по Ципфу: немногие собирают большую
+        # часть подписок.
+        weights = [1 / (rank + 1) for rank in range(len(authors))]
+        per_reader = edges // len(readers)
+        follows = []
+        for reader in readers:
+            followed = set()
+            while len(followed) < per_reader:
+                followed.update(random.choices(
+                    authors, weights, k=per_reader - len(followed)))
+            follows.extend(Follow(user_id=reader, author_id=author)
+                           for author in followed)
+            if len(follows) >= 10000:
+                Follow.objects.bulk_create(follows)
+                follows = []
+        Follow.objects.bulk_create(follows)
+        Post.objects.bulk_create(
+            (Post(author_id=author, text='Текст')
+             for author in authors for _ in range(posts_per_author)))
+        return readers, authors
+
+    def build(self, name):
+        TimelineEntry.objects.all().delete()
+        if name == 'pull':
+            return 0.0
+        started = perf_counter()
+        timelines.rebuild()
+        return perf_counter() - started
+
+    def write(self, name, authors):
+        timings = []
+        before = TimelineEntry.objects.count()
+        # Все схемы пишут пост через create() со всеми сигналами,
+        # а pull только не раскладывает его по лентам.
+        fan_out = (mock.patch.object(timelines, 'fan_out_post')
+                   if name == 'pull' else nullcontext())
+        with fan_out:
+            for author in authors:
+                started = perf_counter()
+                Post.objects.create(author_id=author, text='Новый пост')
+                timings.append(perf_counter() - started)
+        rows = (TimelineEntry.objects.count() - before) / len(authors)
+        return mean(timings) * 1000, rows
+
+    def read(self, name, readers):
+        timings = []
+        posts = Post.objects.select_related('author', 'group')
+        for reader in readers:
+            started = perf_counter()
+            if name == 'pull':
+                paginator = KeysetPaginator(
+                    posts.filter(author__following__user_id=reader),
+                    PER_PAGE)
+            else:
+                user = User(pk=reader)
+                paginator = TimelinePaginator(
+                    user.timeline.all(), PER_PAGE, posts=posts,
+                    pulled=timelines.pulled_posts(user))
+            list(paginator.first_page())
+            timings.append(perf_counter() - started)
+        return mean(timings) * 1000
@@ -0,0 +1,124 @@
+from io import BytesIO
+import random
+import shutil
+import tempfile
+from time import process_time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from PIL import Image, ImageFilter
+from sorl.thumbnail.images import ImageFile
+
+from posts import media, thumbnails
+
+# Клиенты: нужная ширина картинки в пикселях и форматы, которые они
+# понимают, в порядке предпочтения.
+CLIENTS = (
+    ('старый браузер', 960, ()),
+    ('телефон, WebP', 480, ('WEBP',)),
+    ('телефон, AVIF', 480, ('AVIF', 'WEBP')),
+    ('ноутбук, AVIF', 960, ('AVIF', 'WEBP')),
+    ('ретина, AVIF', 1440, ('AVIF', 'WEBP')),
+)
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает одну JPEG-миниатюру карточки с вариантами для '
+            'srcset: байты, которые получит клиент, и процессорное '
+            'время кодирования на одну загрузку')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uploads', type=int, default=5,
+                            help='Сколько картинок загрузить')
+        parser.add_argument('--size', default='3000x2000',
+                            help='Размер исходной картинки, ШxВ')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        size = tuple(map(int, options['size'].split('x')))
+        media_root = tempfile.mkdtemp()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                self.run(options['uploads'], size)
+        finally:
+            cache.clear()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(media_root, ignore_errors=True)
+
+    def run(self, uploads, size):
+        photos = [self.photo(size) for _ in range(uploads)]
+        geometry, options = settings.POST_THUMBNAILS['card']
+
+        # Как было: одна JPEG-миниатюра карточки через sorl-thumbnail.
+        started = process_time()
+        single = [thumbnails.backend.get_thumbnail(
+            default_storage.save(f'posts/single{i}.jpg', ContentFile(photo)),
+            geometry, **options) for i, photo in enumerate(photos)]
+        single_cpu = (process_time() - started) / uploads
+        single_bytes = sum(default_storage.size(thumbnail.name)
+                           for thumbnail in single)
+
+        names = [media.storage().save('posts/bench.jpg', ContentFile(photo))
+                 for photo in photos]
+
+        started = process_time()
+        for name in names:
+            thumbnails.generate(name)
+        variants_cpu = (process_time() - started) / uploads
+        specs = thumbnails.variants('card')
+
+        self.stdout.write(
+            f'Кодирование на загрузку: одна миниатюра '
+            f'{single_cpu * 1000:.0f} мс, {len(specs)} вариантов '
+            f'{variants_cpu * 1000:.0f} мс')
+        self.stdout.write(f'{"клиент":>16} {"было, КБ":>9} {"стало, КБ":>10}')
+        formats = thumbnails.modern_formats()
+        for client, width, accepts in CLIENTS:
+            after = 0
+            for name in names:
+                after += self.served(name, specs, width, [
+                    image_format for image_format in accepts
+                    if image_format in formats
+                ])
+            self.stdout.write(
+                f'{client:>16} {single_bytes / uploads / 1024:>9.1f} '
+                f'{after / uploads / 1024:>10.1f}')
+
+    @staticmethod
+    def served(name, specs, width, accepts):
+        """Размер файла, который браузер выберет из srcset."""
+        candidates = {}
+        for image_format, geometry, options in specs:
+            variant_width = int(geometry.split('x')[0])
+            thumbnail = thumbnails.backend.thumbnail_file(
+                ImageFile(name, media.storage()), geometry, **options)
+            candidates.setdefault(image_format, []).append(
+                (variant_width, default_storage.size(thumbnail.name)))
+        image_format = next(iter(accepts), None)
+        sizes = sorted(candidates[image_format])
+        for variant_width, size in sizes:
+            if variant_width >= width:
+                return size
+        return sizes[-1][1]
+
+    @staticmethod
+    def photo(size):
+        """Похожая на фотографию картинка: плавные пятна и шум."""
+        base = Image.new('RGB', (32, 24))
+        base.putdata([tuple(random.randrange(256) for _ in range(3))
+                      for _ in range(32 * 24)])
+        image = base.resize(size, Image.BICUBIC)
+        noise = Image.effect_noise(size, 24).convert('RGB')
+        image = Image.blend(image, noise, 0.15).filter(
+            ImageFilter.GaussianBlur(1))
+        output = BytesIO()
+        image.save(output, 'JPEG', quality=90)
+        return output.getvalue()
@@ -0,0 +1,134 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+from django.test import override_settings
+
+from posts.models import Comment, Post
+from posts.paginators import KeysetPaginator
+
+User = get_user_model()
+
+PER_PAGE = 10
+# Как SQLite и модуль sqlite3 работают без настройки: журнал
+# отката, полная синхронизация, кеш и mmap по умолчанию.
+DEFAULT_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': 'FULL'}
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает чтение лент и запись комментариев из нескольких '
+            'потоков на файловой базе SQLite с прагмами по умолчанию '
+            'и из SQLITE_PRAGMAS, а также цену открытия соединения, '
+            'которую CONN_MAX_AGE снимает с каждого запроса')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4,
+                            help='Потоков, читающих ленту')
+        parser.add_argument('--writers', type=int, default=2,
+                            help='Потоков, пишущих комментарии')
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--posts', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        profiles = (('по умолчанию', DEFAULT_PRAGMAS),
+                    ('SQLITE_PRAGMAS', settings.SQLITE_PRAGMAS))
+        self.stdout.write(
+            f'{"прагмы":>15} {"чтений/с":>9} {"записей/с":>10} '
+            f'{"ошибок":>7} {"соединение, мс":>15}')
+        for name, pragmas in profiles:
+            random.seed(options['seed'])
+            directory = tempfile.mkdtemp()
+            test_settings = connection.settings_dict['TEST']
+            old_test_name = test_settings['NAME']
+            test_settings['NAME'] = os.path.join(directory, 'bench.sqlite3')
+            try:
+                with override_settings(SQLITE_PRAGMAS=pragmas):
+                    old_name = connection.creation.create_test_db(
+                        verbosity=0, autoclobber=True, serialize=False)
+                    try:
+                        reads, writes, errors = self.run(options)
+                        connect = self.connect_time()
+                    finally:
+                        connections.close_all()
+                        connection.creation.destroy_test_db(
+                            old_name, verbosity=0)
+            finally:
+                test_settings['NAME'] = old_test_name
+                shutil.rmtree(directory, ignore_errors=True)
+                cache.clear()
+            seconds = options['seconds']
+            self.stdout.write(
+                f'{name:>15} {reads / seconds:>9.0f} '
+                f'{writes / seconds:>10.0f} {errors:>7} {connect:>15.2f}')
+
+    def run(self, options):
+        self.authors = [User.objects.create(username=f'author{i}')
+                        for i in range(20)]
+        Post.objects.bulk_create(
+            Post(author=random.choice(self.authors), text=f'Пост {i}')
+            for i in range(options['posts']))
+        self.post_ids = list(Post.objects.values_list('pk', flat=True))
+        connections.close_all()
+
+        self.counts = {'reads': 0, 'writes': 0, 'errors': 0}
+        self.lock = threading.Lock()
+        self.deadline = perf_counter() + options['seconds']
+        threads = [
+            threading.Thread(target=self.worker, args=('reads', self.read))
+            for _ in range(options['readers'])
+        ] + [
+            threading.Thread(target=self.worker, args=('writes', self.write))
+            for _ in range(options['writers'])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return (self.counts['reads'], self.counts['writes'],
+                self.counts['errors'])
+
+    def worker(self, kind, operation):
+        done = errors = 0
+        try:
+            while perf_counter() < self.deadline:
+                try:
+                    operation()
+                    done += 1
+                except OperationalError:
+                    # database is locked: запрос не дождался записи.
+                    errors += 1
+        finally:
+            # У каждого потока своё соединение с базой.
+            connections.close_all()
+        with self.lock:
+            self.counts[kind] += done
+            self.counts['errors'] += errors
+
+    def read(self):
+        paginator = KeysetPaginator(Post.objects.for_cards(), PER_PAGE)
+        list(paginator.first_page())
+        post = Post.objects.get(pk=random.choice(self.post_ids))
+        list(post.comments.order_by('created', 'pk'))
+
+    def write(self):
+        Comment.objects.create(post_id=random.choice(self.post_ids),
+                               author=random.choice(self.authors),
+                               text='Комментарий')
+
+    @staticmethod
+    def connect_time(samples=50):
+        """Среднее время открытия соединения вместе с прагмами, мс."""
+        started = perf_counter()
+        for _ in range(samples):
+            connection.close()
+            connection.ensure_connection()
+        return (perf_counter() - started) / samples * 1000
@@ -0,0 +1,182 @@
+from itertools import islice
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings as thumbnail_settings
+from sorl.thumbnail.helpers import deserialize
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix, del_prefix
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from posts import media, shards
+from posts.models import MediaFile, Post
+
+
+def walk(storage, directory):
+    """Файлы каталога directory хранилища: пары (имя, os.stat_result).
+
+    Каталоги читаются os.scandir по одному, так что память не зависит
+    от числа файлов.
+    """
+    root = storage.path(directory)
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    name = os.path.relpath(entry.path, storage.location)
+                    yield name.replace(os.sep, '/'), entry.stat()
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def live_images(names):
+    live = set()
+    for posts in shards.spread(Post.objects.filter(image__in=names)):
+        live.update(posts.values_list('image', flat=True))
+    return live
+
+
+class Command(BaseCommand):
+    help = ('Удаляет картинки, на которые не ссылается ни один пост, '
+            'миниатюры без записи в KV sorl-thumbnail и записи KV '
+            'миниатюр удалённых картинок')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только показать, что будет удалено')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Сколько файлов или записей KV '
+                                 'проверять одним запросом')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Не больше стольких удалений в секунду, '
+                                 '0 - без ограничения')
+        parser.add_argument('--min-age', type=int, default=60 * 60,
+                            help='Не трогать файлы моложе стольких секунд: '
+                                 'пост с ними может быть ещё не сохранён')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+        self.interval = 1 / options['rate'] if options['rate'] else 0
+        self.deadline = time.time() - options['min_age']
+        self.last_delete = 0
+        self.verbosity = options['verbosity']
+
+        # Сначала записи KV: миниатюры, которые в них остались
+        # без исходной картинки, потом удаляются как файлы без записи.
+        entries = self.collect_kvstore()
+        images, image_bytes = self.collect_images()
+        thumbs, thumb_bytes = self.collect_thumbnails()
+
+        verb = 'Будет удалено' if self.dry_run else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb}: картинок {images} ({filesizeformat(image_bytes)}), '
+            f'миниатюр {thumbs} ({filesizeformat(thumb_bytes)}), '
+            f'записей KV {entries}; всего освобождено '
+            f'{filesizeformat(image_bytes + thumb_bytes)}'))
+
+    def report(self, name):
+        if self.verbosity > 1:
+            self.stdout.write(name)
+
+    def throttle(self):
+        """Выдерживает паузу между удалениями по --rate."""
+        if self.interval:
+            pause = self.last_delete + self.interval - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            self.last_delete = time.monotonic()
+
+    def collect_kvstore(self):
+        """Удаляет записи KV миниатюр картинок, которых нет в постах."""
+        prefix = add_prefix('', 'thumbnails')
+        deleted = 0
+        last = prefix
+        while True:
+            # Ключевая пагинация по ключу: удалённые записи не сдвигают
+            # следующую пачку.
+            rows = list(
+                KVStoreModel.objects.filter(key__startswith=prefix,
+                                            key__gt=last)
+                .order_by('key').values_list('key', 'value')
+                [:self.batch_size])
+            if not rows:
+                return deleted
+            last = rows[-1][0]
+            sources = dict(KVStoreModel.objects.filter(key__in=[
+                add_prefix(del_prefix(key)) for key, value in rows
+            ]).values_list('key', 'value'))
+            names = {
+                key: deserialize_image_file(sources[image_key]).name
+                for key, value in rows
+                for image_key in [add_prefix(del_prefix(key))]
+                if image_key in sources
+            }
+            live = live_images(set(names.values()))
+            for key, value in rows:
+                if names.get(key) in live:
+                    continue
+                stale = [key, add_prefix(del_prefix(key))]
+                stale.extend(add_prefix(thumbnail_key)
+                             for thumbnail_key in deserialize(value))
+                deleted += len(stale)
+                if not self.dry_run:
+                    self.throttle()
+                    default.kvstore._delete_raw(*stale)
+
+    def collect_images(self):
+        """Удаляет файлы картинок, на которые не ссылается ни один пост."""
+        storage = media.storage()
+        directory = Post._meta.get_field('image').upload_to
+        count = size = 0
+        for batch in batches(walk(storage, directory), self.batch_size):
+            old = {name: stat.st_size for name, stat in batch
+                   if stat.st_mtime < self.deadline}
+            for name in set(old) - live_images(list(old)):
+                count += 1
+                size += old[name]
+                self.report(name)
+                if not self.dry_run:
+                    self.throttle()
+                    MediaFile.objects.filter(name=name).delete()
+                    media.delete_file(name)
+        return count, size
+
+    def collect_thumbnails(self):
+        """Удаляет файлы миниатюр, о которых не знает KV sorl-thumbnail."""
+        storage = default.storage
+        directory = thumbnail_settings.THUMBNAIL_PREFIX
+        count = size = 0
+        for batch in batches(walk(storage, directory), self.batch_size):
+            old = {
+                add_prefix(ImageFile(name, storage).key): (name, stat.st_size)
+                for name, stat in batch if stat.st_mtime < self.deadline
+            }
+            known = set(KVStoreModel.objects.filter(
+                key__in=list(old)).values_list('key', flat=True))
+            for key in set(old) - known:
+                name, file_size = old[key]
+                count += 1
+                size += file_size
+                self.report(name)
+                if not self.dry_run:
+                    self.throttle()
+                    storage.delete(name)
+        return count, size
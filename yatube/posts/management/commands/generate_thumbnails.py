@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from posts import media, shards, thumbnails
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = ('Готовит миниатюры для уже загруженных картинок постов, '
+            'например после изменения POST_THUMBNAILS, и записывает '
+            'в посты размеры картинок и заглушки, если их там нет')
+
+    def handle(self, *args, **options):
+        names = set()
+        for posts in shards.spread(Post.objects.exclude(image='')):
+            names.update(posts.values_list('image', flat=True).distinct()
+                         .order_by().iterator())
+        done = 0
+        for name in sorted(names):
+            unmeasured = Post.objects.filter(image=name,
+                                             image_width__isnull=True)
+            if shards.exists(unmeasured):
+                with media.storage().open(name) as file:
+                    width, height = thumbnails.measure(file)
+                shards.update(unmeasured, image_width=width,
+                              image_height=height)
+            placeholder = thumbnails.generate(name)
+            without_placeholder = Post.objects.filter(image=name,
+                                                      image_placeholder='')
+            if placeholder is None and shards.exists(without_placeholder):
+                # Миниатюры уже были готовы, оригинал не раскодирован.
+                with media.storage().open(name) as file, \
+                        Image.open(file) as image:
+                    placeholder = thumbnails.placeholder(image)
+            if placeholder:
+                shards.update(without_placeholder,
+                              image_placeholder=placeholder)
+            thumbnails.refresh_posts(name)
+            done += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Подготовлены миниатюры картинок: {done}'))
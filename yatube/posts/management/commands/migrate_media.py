@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+
+from posts import media, thumbnails
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = ('Переносит картинки постов из общего каталога в хранилище '
+            'по содержимому: файлы копируются потоково, одинаковые '
+            'склеиваются, старые файлы и их миниатюры удаляются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Сколько имён файлов выбирать за раз')
+        parser.add_argument('--keep-old', action='store_true',
+                            help='Не удалять старые файлы')
+
+    def handle(self, *args, **options):
+        storage = media.storage()
+        moved = merged = missing = 0
+        last = ''
+        while True:
+            # Ключевая пагинация по имени: перенесённые файлы получают
+            # новые имена и при повторной встрече просто пропускаются.
+            names = list(
+                Post.objects.exclude(image='').filter(image__gt=last)
+                .order_by('image').values_list('image', flat=True)
+                .distinct()[:options['batch_size']]
+            )
+            if not names:
+                break
+            last = names[-1]
+            for name in names:
+                if storage.is_hashed(name):
+                    continue
+                if not storage.exists(name):
+                    missing += 1
+                    self.stderr.write(f'Нет файла {name}')
+                    continue
+                with storage.open(name) as source:
+                    new_name = storage.hashed_name(name, source)
+                    merged += storage.exists(new_name)
+                    storage.save(name, source)
+                media.rename(name, new_name)
+                if not options['keep_old']:
+                    # Старые миниатюры записаны в KV от имени файла
+                    # в хранилище по умолчанию.
+                    thumbnails.backend.delete(name)
+                moved += 1
+                try:
+                    thumbnails.generate(new_name)
+                except Exception as error:
+                    self.stderr.write(f'Нет миниатюр {new_name}: {error}')
+                thumbnails.refresh_posts(new_name)
+        self.stdout.write(self.style.SUCCESS(
+            f'Перенесено файлов: {moved}, из них совпали с уже '
+            f'перенесёнными: {merged}, не найдено: {missing}'))
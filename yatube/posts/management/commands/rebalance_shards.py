@@ -0,0 +1,83 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from posts import shards
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = ('Переносит авторов с постами и комментариями между шардами '
+            'POST_SHARDS пачками, не останавливая сайт. Без --author '
+            'выравнивает число постов на шардах')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--author', type=int, action='append',
+                            dest='authors', help='id автора, можно '
+                            'несколько раз; нужен --to')
+        parser.add_argument('--to', help='Шард, куда переносить авторов')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Сколько постов копировать за раз')
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='Пауза между пачками, с')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только показать переносы')
+
+    def handle(self, *args, **options):
+        if not shards.enabled():
+            raise CommandError('POST_SHARDS пуст')
+        if options['authors']:
+            if options['to'] not in settings.POST_SHARDS:
+                raise CommandError('--to должен быть шардом из POST_SHARDS')
+            moves = [(author_id, options['to'])
+                     for author_id in options['authors']]
+        else:
+            moves = self.plan()
+        for author_id, target in moves:
+            source = shards.for_author(author_id)
+            if options['dry_run']:
+                self.stdout.write(f'Автор {author_id}: {source} -> {target}')
+                continue
+            moved, left = shards.move_author(
+                author_id, target, options['batch_size'], options['pause'])
+            self.stdout.write(
+                f'Автор {author_id}: {source} -> {target}, постов {moved}')
+            if left:
+                self.stderr.write(
+                    f'На {source} остались посты автора {author_id} '
+                    f'({left}), записанные во время переноса: '
+                    f'запустите перенос ещё раз')
+        self.stdout.write(self.style.SUCCESS(
+            f'Перенесено авторов: {len(moves)}'))
+
+    def plan(self):
+        """Переносы, которые выравнивают число постов на шардах.
+
+        С самого нагруженного шарда на самый свободный переносится
+        самый крупный автор, который ещё уменьшает разрыв между ними.
+        """
+        authors = {}
+        load = {database: 0 for database in settings.POST_SHARDS}
+        for database in settings.POST_SHARDS:
+            counts = Post.objects.using(database).values(
+                'author_id').annotate(posts=Count('pk')).order_by()
+            for row in counts:
+                authors[row['author_id']] = (database, row['posts'])
+                load[database] += row['posts']
+        moves = []
+        while True:
+            heaviest = max(load, key=load.get)
+            lightest = min(load, key=load.get)
+            gap = load[heaviest] - load[lightest]
+            candidates = [
+                (posts, author_id)
+                for author_id, (database, posts) in authors.items()
+                if database == heaviest and posts < gap
+            ]
+            if not candidates:
+                return moves
+            posts, author_id = max(candidates)
+            authors[author_id] = (lightest, posts)
+            load[heaviest] -= posts
+            load[lightest] += posts
+            moves.append((author_id, lightest))
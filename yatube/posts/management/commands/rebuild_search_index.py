@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from posts import search
+
+
+class Command(BaseCommand):
+    help = ('Пересобирает полнотекстовый индекс постов, например после '
+            'загрузки данных в обход триггеров или пересоздания таблицы')
+
+    def handle(self, *args, **options):
+        databases = [database for database in search.databases()
+                     if search.available(database)]
+        if not databases:
+            raise CommandError('Индекс FTS5 есть только на SQLite')
+        for database in databases:
+            search.rebuild(database)
+            self.stdout.write(self.style.SUCCESS(
+                f'{database}: поисковый индекс пересобран'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from posts import timelines
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает ленты подписок с нуля по таблице Follow'
+
+    def handle(self, *args, **options):
+        timelines.rebuild()
+        self.stdout.write(self.style.SUCCESS('Ленты подписок пересобраны'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from posts import counters
+
+
+class Command(BaseCommand):
+    help = ('Сверяет счётчики постов, подписчиков, подписок и '
+            'комментариев с данными и исправляет расхождения')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Сколько строк сверять за один проход')
+
+    def handle(self, *args, **options):
+        authors = counters.reconcile_authors(options['batch_size'])
+        posts = counters.reconcile_comments(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Исправлено счётчиков авторов: {authors}, '
+            f'постов: {posts}'))
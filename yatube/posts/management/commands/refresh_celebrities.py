@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from posts import timelines
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает популярных авторов по порогу '
+            'TIMELINE_CELEBRITY_FOLLOWERS и поправляет ленты подписок')
+
+    def handle(self, *args, **options):
+        promoted, demoted = timelines.refresh_celebrities()
+        self.stdout.write(self.style.SUCCESS(
+            f'Новых популярных авторов: {len(promoted)}, '
+            f'бывших: {len(demoted)}'))
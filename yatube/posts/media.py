@@ -0,0 +1,69 @@
+"""Счётчики ссылок на файлы картинок постов.
+
+Одинаковые загрузки хранятся одним файлом (см. posts.storage), поэтому
+файл удаляется вместе с миниатюрами только тогда, когда на него не
+ссылается ни один пост. Удаляет его не release, а команда
+collect_media: такая же загрузка может получить имя файла ещё до
+коммита своего поста, и только collect_media по времени изменения
+файла (--min-age) видит, что он снова нужен.
+"""
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import transaction
+from django.db.models import F
+from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile
+
+from . import shards
+from .models import MediaFile, Post
+
+
+def storage():
+    return Post._meta.get_field('image').storage
+
+
+def retain(name, count=1):
+    """Добавляет count ссылок на файл name."""
+    if MediaFile.objects.filter(name=name).update(
+            references=F('references') + count):
+        return
+    media_file, created = MediaFile.objects.get_or_create(
+        name=name, defaults={'references': count, 'size': _size(name)})
+    if not created:
+        MediaFile.objects.filter(name=name).update(
+            references=F('references') + count)
+
+
+def release(name, count=1):
+    """Убирает count ссылок; файл без ссылок остаётся collect_media."""
+    MediaFile.objects.filter(name=name, references__gte=count).update(
+        references=F('references') - count)
+
+
+def delete_file(name):
+    """Удаляет файл картинки, её миниатюры и их записи в KV."""
+    default.kvstore.delete(ImageFile(name, storage()))
+    try:
+        storage().delete(name)
+    except SuspiciousFileOperation:
+        # Путь вне MEDIA_ROOT, записанный в пост в обход формы.
+        pass
+
+
+def _size(name):
+    try:
+        return storage().size(name)
+    except (OSError, SuspiciousFileOperation):
+        return 0
+
+
+def rename(old, new):
+    """Переводит посты и ссылки с файла old на файл new.
+
+    Сам файл old не удаляется: этим занимается вызывающий код.
+    """
+    with transaction.atomic():
+        count = shards.update(Post.objects.filter(image=old), image=new)
+        MediaFile.objects.filter(name=old).delete()
+        if count:
+            retain(new, count)
+    return count
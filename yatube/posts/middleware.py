@@ -0,0 +1,84 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+from core import replicas
+
+from . import feed_cache
+
+
+PAGE_KEY_PREFIX = 'anonymous-page'
+CACHED_HEADERS = ('Content-Type', 'Content-Language', 'X-Frame-Options',
+                  'X-Content-Type-Options', 'X-XSS-Protection',
+                  'Referrer-Policy', 'ETag', 'Last-Modified')
+
+
+class AnonymousPageCacheMiddleware:
+    """Кеш целых страниц для анонимных посетителей.
+
+    Стоит первым в MIDDLEWARE: при попадании в кеш сессии,
+    аутентификация, контекст-процессоры и шаблоны не выполняются.
+    Кешируются только ответы, которые view пометил тегами через
+    feed_cache.tag(); страница считается устаревшей, как только
+    меняется версия любого её тега (см. posts.signals). Страница
+    сохраняется с версиями, которые view прочитал до своих запросов
+    (см. feed_cache.conditional), иначе запись, сделанная во время
+    отрисовки, не сбросила бы страницу без неё.
+    Запросы с cookie сессии или сообщений кеш не трогают, поэтому
+    вошедший пользователь никогда не получит чужую шапку сайта.
+    Страницу для кеша view отрисовывает, читая из default: с отстающей
+    реплики в кеш под свежей версией попали бы старые данные.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not self.is_cacheable_request(request):
+            return self.get_response(request)
+        key = self.page_key(request)
+        cached = cache.get(key)
+        if cached is not None:
+            version, scopes, content, status, headers = cached
+            if version == feed_cache.version(*scopes):
+                response = HttpResponse(content, status=status)
+                for header, value in headers:
+                    response[header] = value
+                response['X-Page-Cache'] = 'hit'
+                return get_conditional_response(
+                    request, etag=response.get('ETag'),
+                    last_modified=parse_http_date_safe(
+                        response.get('Last-Modified', '')),
+                    response=response)
+        replicas.read_primary(request)
+        response = self.get_response(request)
+        scopes = getattr(response, 'cache_scopes', None)
+        version = (None if scopes is None
+                   else feed_cache.rendered_version(request, *scopes))
+        if (version is not None and request.method == 'GET'
+                and response.status_code == 200
+                and not response.streaming and not response.cookies):
+            cache.set(key, (
+                version, scopes, response.content,
+                response.status_code,
+                [(header, response[header]) for header in CACHED_HEADERS
+                 if response.has_header(header)],
+            ), settings.ANONYMOUS_PAGE_CACHE_TIMEOUT)
+        return response
+
+    @staticmethod
+    def is_cacheable_request(request):
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        return not any(name in request.COOKIES for name in (
+            settings.SESSION_COOKIE_NAME, CookieStorage.cookie_name))
+
+    @staticmethod
+    def page_key(request):
+        url = request.build_absolute_uri().encode()
+        return f'{PAGE_KEY_PREFIX}:{hashlib.md5(url).hexdigest()}'
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.16 on 2026-10-18 03:16
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0014_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPost',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'архивный пост',
+                'verbose_name_plural': 'Архивные посты',
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('posts.post',),
+        ),
+    ]
@@ -1,6 +1,9 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth import get_user_model
 
+from .storage import ContentAddressedStorage
+
 
 FIRST_FIFTEEN_SYMBOLS = 15
 User = get_user_model()
@@ -16,16 +19,62 @@ class Group(models.Model):
         return self.title
 
 
+CARD_FIELDS = ('text', 'pub_date', 'updated', 'image', 'image_width',
+               'image_height', 'image_placeholder')
+CARD_AUTHOR_FIELDS = ('username', 'first_name', 'last_name')
+
+
+class ShardedQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        # Без явной базы шард выбирает роутер по самому объекту
+        # (см. posts.shards.ShardRouter), а не по запросу.
+        if not settings.POST_SHARDS or self._db is not None:
+            return super().create(**kwargs)
+        obj = self.model(**kwargs)
+        obj.save(force_insert=True)
+        return obj
+
+
+class PostQuerySet(ShardedQuerySet):
+    def for_cards(self):
+        """Посты с автором и группой и только теми полями,
+        которые выводит includes/card.html."""
+        if settings.POST_SHARDS or settings.POST_ARCHIVE_DATABASE:
+            # Авторы и группы живут в default: JOIN на шарде или
+            # в архиве невозможен.
+            return self.only(*CARD_FIELDS, 'author', 'group').prefetch_related(
+                models.Prefetch('author', User.objects.only(
+                    *CARD_AUTHOR_FIELDS)),
+                models.Prefetch('group', Group.objects.only('slug')),
+            )
+        return self.select_related('author', 'group').only(
+            *CARD_FIELDS, 'group__slug',
+            *(f'author__{field}' for field in CARD_AUTHOR_FIELDS))
+
+    def with_related(self, *fields):
+        """select_related, а на шардах и с архивом - prefetch_related
+        тех же связей."""
+        if settings.POST_SHARDS or settings.POST_ARCHIVE_DATABASE:
+            return self.prefetch_related(*fields)
+        return self.select_related(*fields)
+
+
 class Post(models.Model):
     text = models.TextField(verbose_name='Текст поста',
                             help_text='Введите основной текст поста',)
     pub_date = models.DateTimeField(auto_now_add=True,
                                     verbose_name='Дата публикации')
+    updated = models.DateTimeField(auto_now=True,
+                                   verbose_name='Дата изменения')
+    # Посты и комментарии могут лежать на шардах (см. posts.shards),
+    # а пользователи и группы - только в default, поэтому связи с ними
+    # без внешних ключей в базе.
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
         related_name='posts',
         verbose_name='Автор',
+        db_constraint=False,
     )
     group = models.ForeignKey(
         Group,
@@ -33,18 +82,56 @@ class Post(models.Model):
         null=True,
         related_name='posts',
         on_delete=models.SET_NULL,
+        db_constraint=False,
         verbose_name='Относится к группе...',
         help_text='Выберите группу, к которой относится ваш пост',
     )
     image = models.ImageField(upload_to='posts/',
+                              storage=ContentAddressedStorage(),
                               blank=True,
                               verbose_name='Картинка')
+    # Размеры картинки читаются при загрузке (см. posts.signals
+    # .measure_image), а её крошечную размытую копию (data: URI)
+    # записывает пул миниатюр, см. posts.thumbnails._run.
+    image_width = models.PositiveIntegerField(
+        null=True,
+        editable=False,
+        verbose_name='Ширина картинки',
+    )
+    image_height = models.PositiveIntegerField(
+        null=True,
+        editable=False,
+        verbose_name='Высота картинки',
+    )
+    image_placeholder = models.TextField(
+        blank=True,
+        editable=False,
+        verbose_name='Заглушка картинки',
+    )
+    comments_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Число комментариев',
+    )
+
+    objects = PostQuerySet.as_manager()
 
     def __str__(self):
         return self.text[:FIRST_FIFTEEN_SYMBOLS]
 
     class Meta:
         ordering = ('-pub_date',)
+        # Ленты выбираются по ключу (pub_date, id) от новых к старым
+        # (см. posts.paginators): индексы отдают строки уже в этом
+        # порядке, без сортировки во временном B-дереве.
+        indexes = [
+            models.Index(fields=('-pub_date', '-id'),
+                         name='post_pub_date'),
+            models.Index(fields=('author', '-pub_date', '-id'),
+                         name='post_author_pub_date'),
+            models.Index(fields=('group', '-pub_date', '-id'),
+                         name='post_group_pub_date'),
+        ]
         verbose_name_plural = "Публикации"
         verbose_name = 'публикацию'
 
@@ -59,6 +146,7 @@ class Comment(models.Model):
         User,
         related_name='comments',
         on_delete=models.CASCADE,
+        db_constraint=False,
     )
     text = models.TextField(
         verbose_name='Текст комментария',
@@ -69,6 +157,12 @@ class Comment(models.Model):
         verbose_name='Дата публикации комментария',
     )
 
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=('post', 'created', 'id'),
+                                name='comment_post_created')]
+
 
 class Follow(models.Model):
     user = models.ForeignKey(
@@ -88,3 +182,130 @@ class Follow(models.Model):
     class Meta:
         constraints = [models.UniqueConstraint(fields=('user', 'author'),
                        name='Уникальные значения')]
+
+
+class TimelineEntry(models.Model):
+    """Пост автора в ленте подписчика, записанный при публикации."""
+
+    user = models.ForeignKey(
+        User,
+        related_name='timeline',
+        on_delete=models.CASCADE,
+        verbose_name='Подписчик',
+    )
+    post = models.ForeignKey(
+        Post,
+        related_name='timeline_entries',
+        on_delete=models.CASCADE,
+        verbose_name='Пост',
+        db_constraint=False,
+    )
+    pub_date = models.DateTimeField(verbose_name='Дата публикации')
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=('user', 'post'),
+                       name='Пост один раз в ленте')]
+        indexes = [models.Index(fields=('user', '-pub_date', '-post'),
+                                name='timeline_user_pub_date')]
+        verbose_name_plural = 'Ленты подписок'
+        verbose_name = 'запись ленты'
+
+
+class Celebrity(models.Model):
+    """Автор, чьи посты не раскладываются по лентам подписчиков, а
+    подмешиваются при чтении (см. posts.timelines)."""
+
+    author = models.OneToOneField(
+        User,
+        primary_key=True,
+        related_name='+',
+        on_delete=models.CASCADE,
+        verbose_name='Автор',
+    )
+
+    class Meta:
+        verbose_name_plural = 'Популярные авторы'
+        verbose_name = 'популярный автор'
+
+
+class AuthorStats(models.Model):
+    """Счётчики автора, которые обновляются вместе с постами
+    и подписками (см. posts.counters)."""
+
+    user = models.OneToOneField(
+        User,
+        primary_key=True,
+        related_name='stats',
+        on_delete=models.CASCADE,
+        verbose_name='Пользователь',
+    )
+    posts_count = models.PositiveIntegerField(default=0,
+                                              verbose_name='Постов')
+    followers_count = models.PositiveIntegerField(default=0,
+                                                  verbose_name='Подписчиков')
+    following_count = models.PositiveIntegerField(default=0,
+                                                  verbose_name='Подписок')
+
+    class Meta:
+        verbose_name_plural = 'Счётчики авторов'
+        verbose_name = 'счётчики автора'
+
+
+class MediaFile(models.Model):
+    """Файл картинки и число постов, которые на него ссылаются
+    (см. posts.storage и posts.media)."""
+
+    name = models.CharField(max_length=255, primary_key=True,
+                            verbose_name='Файл')
+    size = models.BigIntegerField(default=0, verbose_name='Размер, байт')
+    references = models.PositiveIntegerField(default=0,
+                                             verbose_name='Ссылок')
+
+    class Meta:
+        verbose_name_plural = 'Файлы картинок'
+        verbose_name = 'файл картинки'
+
+
+class AuthorShard(models.Model):
+    """База, в которой лежат посты автора (см. posts.shards)."""
+
+    author = models.OneToOneField(
+        User,
+        primary_key=True,
+        related_name='shard',
+        on_delete=models.CASCADE,
+        verbose_name='Автор',
+    )
+    database = models.CharField(max_length=100, verbose_name='База')
+    moving = models.BooleanField(default=False, verbose_name='Переносится')
+
+    class Meta:
+        verbose_name_plural = 'Шарды авторов'
+        verbose_name = 'шард автора'
+
+
+class MovedPost(models.Model):
+    """Пост, который перенесён с шарда, где он создан: такой пост
+    лежит на шарде своего автора (см. posts.shards)."""
+
+    post_id = models.BigIntegerField(primary_key=True, verbose_name='Пост')
+    author = models.ForeignKey(
+        User,
+        related_name='+',
+        on_delete=models.CASCADE,
+        verbose_name='Автор',
+    )
+
+    class Meta:
+        verbose_name_plural = 'Перенесённые посты'
+        verbose_name = 'перенесённый пост'
+
+
+class ArchivedPost(Post):
+    """Пост из архива POST_ARCHIVE_DATABASE (см. posts.archive) - для
+    раздела админки, который читает архив."""
+
+    class Meta:
+        proxy = True
+        verbose_name_plural = 'Архивные посты'
+        verbose_name = 'архивный пост'
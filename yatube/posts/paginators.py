@@ -0,0 +1,447 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+import heapq
+from itertools import islice
+from math import ceil
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+
+AFTER = 'after'
+BEFORE = 'before'
+LAST_PAGE_TOKEN = 'last'
+FEED_COUNT_KEY_PREFIX = 'feed-count'
+
+
+def feed_count_key(*parts):
+    return ':'.join(str(part) for part in (FEED_COUNT_KEY_PREFIX,) + parts)
+
+
+def encode_cursor(pub_date, pk, number):
+    raw = f'{pub_date.isoformat()}|{pk}|{number}'.encode()
+    return urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Возвращает (pub_date, pk, number) или None для битого токена."""
+    try:
+        raw = urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        pub_date, pk, number = raw.split('|')
+        pub_date = parse_datetime(pub_date)
+        pk, number = int(pk), int(number)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if pub_date is None or number < 1:
+        return None
+    return pub_date, pk, number
+
+
+def spread(queryset, databases):
+    """Запрос queryset к каждой из баз databases."""
+    return ([queryset.using(database) for database in databases]
+            or [queryset])
+
+
+def tiers(queryset, databases, archive):
+    """Запросы к горячим базам databases, а за ними - к архиву archive.
+
+    Архив (см. posts.archive) старше любого горячего поста, поэтому
+    лента - это горячие посты, а после них архивные.
+    """
+    result = [spread(queryset, databases)]
+    if archive:
+        result.append([queryset.using(archive)])
+    return result
+
+
+def fetch_tiers(levels, limit, newer, select, key=None):
+    """Первые limit строк ленты из уровней levels (см. tiers).
+
+    Запросы уровня выбираются select(запрос, число строк) и сливаются
+    по key; следующий уровень читается, только если строк не хватило,
+    так что архив не трогают, пока лента не пролистана до него.
+    """
+    if newer:
+        # К новым постам лента идёт от архива к горячим.
+        levels = levels[::-1]
+    rows = []
+    for parts in levels:
+        need = limit - len(rows)
+        rows.extend(islice(
+            heapq.merge(*(select(part, need) for part in parts),
+                        key=key, reverse=not newer),
+            need))
+        if len(rows) >= limit:
+            break
+    return rows
+
+
+class KeysetPaginator(Paginator):
+    """Пагинатор по ключу (pub_date, id).
+
+    Страница по курсору ?after=/?before= выбирается условием на ключ,
+    а не OFFSET, поэтому любая глубина стоит как первая страница.
+    Соседние страницы определяются по лишней строке выборки, COUNT(*)
+    нужен только для ссылки на последнюю страницу.
+    Старые ссылки вида ?page=N продолжают работать через OFFSET.
+
+    Пагинатор создаётся на один запрос: после get_page_from_request
+    он помнит выбранное окно и отдаёт курсоры соседних страниц.
+
+    Если передан count_key, число постов берётся из кеша и
+    пересчитывается раз в PAGINATOR_COUNT_TIMEOUT секунд или после
+    сброса ключа сигналами, так что обычный запрос ленты не делает
+    COUNT(*) вовсе.
+    """
+
+    # Поле, которое разрешает равенство pub_date; его значение
+    # совпадает с pk поста на странице.
+    key_field = 'pk'
+
+    def __init__(self, object_list, per_page, count_key=None,
+                 window=None, **kwargs):
+        super().__init__(
+            object_list.order_by('-pub_date', f'-{self.key_field}'),
+            per_page, **kwargs)
+        self.count_key = count_key
+        self.window = (settings.PAGINATOR_WINDOW
+                       if window is None else window)
+        self.page_obj = None
+        self.cursor = ''
+        self._has_next = False
+
+    @property
+    def num_pages(self):
+        if self.page_obj is not None:
+            return self.page_obj.number + int(self._has_next)
+        return self.total_pages()
+
+    @cached_property
+    def count(self):
+        if self.count_key is None:
+            return self.total_count()
+        count = cache.get(self.count_key)
+        if count is None:
+            count = self.total_count()
+            cache.set(self.count_key, count,
+                      settings.PAGINATOR_COUNT_TIMEOUT)
+        return count
+
+    def total_count(self):
+        return self.object_list.count()
+
+    def total_pages(self):
+        if self.count == 0 and not self.allow_empty_first_page:
+            return 0
+        hits = max(1, self.count - self.orphans)
+        return ceil(hits / self.per_page)
+
+    def get_page_from_request(self, request):
+        after = request.GET.get(AFTER)
+        before = request.GET.get(BEFORE)
+        if before == LAST_PAGE_TOKEN:
+            return self.last_page()
+        token = after or before
+        cursor = decode_cursor(token) if token else None
+        if cursor is not None:
+            if after:
+                return self.page_after(cursor, f'{AFTER}-{token}')
+            return self.page_before(cursor, f'{BEFORE}-{token}')
+        if request.GET.get('page'):
+            return self.get_page(request.GET.get('page'))
+        return self.first_page()
+
+    def fetch(self, limit, cursor=None, newer=False, keys=False, offset=0):
+        """Строки ленты по обе стороны от курсора (pub_date, pk).
+
+        Старые строки идут от новых к старым, более новые (newer=True) -
+        от ближайших к курсору. С keys=True возвращаются только ключи.
+        """
+        return self.select(self.object_list, limit, cursor, newer, keys,
+                           offset)
+
+    def select(self, queryset, limit, cursor=None, newer=False, keys=False,
+               offset=0):
+        """fetch по упорядоченному запросу queryset."""
+        if keys:
+            queryset = queryset.prefetch_related(None).values_list(
+                'pub_date', self.key_field)
+        if newer:
+            queryset = queryset.reverse()
+        if cursor is not None:
+            pub_date, pk = cursor
+            queryset = queryset.filter(
+                self._newer_than(pub_date, pk) if newer
+                else self._older_than(pub_date, pk))
+        return list(queryset[offset:offset + limit])
+
+    def first_page(self):
+        rows = self.fetch(self.per_page + 1)
+        return self._window(rows[:self.per_page], 1,
+                            len(rows) > self.per_page, 'first')
+
+    def last_page(self):
+        number = self.total_pages()
+        size = self.count - (number - 1) * self.per_page
+        rows = self.fetch(max(size, 1), newer=True)
+        return self._window(rows[::-1], max(number, 1), False,
+                            LAST_PAGE_TOKEN)
+
+    def page_after(self, cursor, name):
+        pub_date, pk, number = cursor
+        rows = self.fetch(self.per_page + 1, (pub_date, pk))
+        if not rows:
+            return self.last_page()
+        return self._window(rows[:self.per_page], max(number, 2),
+                            len(rows) > self.per_page, name)
+
+    def page_before(self, cursor, name):
+        pub_date, pk, number = cursor
+        rows = self.fetch(self.per_page + 1, (pub_date, pk), newer=True)
+        if len(rows) <= self.per_page:
+            # Дошли до начала ленты: показываем полную первую страницу.
+            return self.first_page()
+        return self._window(rows[:self.per_page][::-1], max(number, 2),
+                            True, name)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        rows = self.fetch(self.per_page + 1,
+                          offset=(number - 1) * self.per_page)
+        return self._window(rows[:self.per_page], number,
+                            len(rows) > self.per_page, f'page-{number}')
+
+    def _older_than(self, pub_date, pk, key_field=None):
+        key_field = key_field or self.key_field
+        return (Q(pub_date__lt=pub_date)
+                | Q(pub_date=pub_date, **{f'{key_field}__lt': pk}))
+
+    def _newer_than(self, pub_date, pk, key_field=None):
+        key_field = key_field or self.key_field
+        return (Q(pub_date__gt=pub_date)
+                | Q(pub_date=pub_date, **{f'{key_field}__gt': pk}))
+
+    def _window(self, rows, number, has_next, cursor):
+        self._has_next = has_next
+        self.cursor = cursor
+        self.page_obj = self._get_page(rows, number, self)
+        return self.page_obj
+
+    @property
+    def next_token(self):
+        if not self.page_obj or not self.page_obj.has_next():
+            return ''
+        post = self.page_obj[-1]
+        return encode_cursor(post.pub_date, post.pk, self.page_obj.number + 1)
+
+    @property
+    def previous_token(self):
+        if not self.page_obj or not self.page_obj.has_previous():
+            return ''
+        post = self.page_obj[0]
+        return encode_cursor(post.pub_date, post.pk, self.page_obj.number - 1)
+
+    @property
+    def last_token(self):
+        return LAST_PAGE_TOKEN
+
+    @property
+    def cache_key(self):
+        return self.cursor
+
+    @property
+    def page_links(self):
+        """Окно номеров страниц: первая, соседи текущей и последняя.
+
+        Возвращает пары (номер, ссылка); номер None означает пропуск.
+        Курсоры соседей берутся из одной выборки ключей (pub_date, id)
+        в каждую сторону, без OFFSET и COUNT(*).
+        """
+        page = self.page_obj
+        if not page or not page.has_other_pages():
+            return []
+        number = page.number
+        links = [(number, '')]
+        links[:0] = self._previous_links(page)
+        links.extend(self._next_links(page))
+        first_number = links[0][0]
+        if first_number > 1:
+            if first_number > 2:
+                links.insert(0, (None, ''))
+            links.insert(0, (1, '?'))
+        last_number = links[-1][0]
+        if page.has_next():
+            total = self.total_pages()
+            if total > last_number:
+                if total > last_number + 1:
+                    links.append((None, ''))
+                links.append((total, f'?{BEFORE}={LAST_PAGE_TOKEN}'))
+        return links
+
+    def _boundary_keys(self, post, newer):
+        return self.fetch(self.per_page * (self.window - 1) + 1,
+                          (post.pub_date, post.pk), newer=newer, keys=True)
+
+    def _previous_links(self, page):
+        if not page.has_previous():
+            return []
+        links = []
+        number = page.number
+        keys = []
+        if self.window > 1 and number > 2:
+            keys = self._boundary_keys(page[0], newer=True)
+        for step in range(1, self.window + 1):
+            target = number - step
+            if target < 1:
+                break
+            if target == 1:
+                links.append((1, '?'))
+                break
+            if step == 1:
+                links.append((target, f'?{BEFORE}={self.previous_token}'))
+                continue
+            index = self.per_page * (step - 1) - 1
+            if len(keys) <= self.per_page * (step - 1):
+                break
+            pub_date, pk = keys[index]
+            links.append(
+                (target, f'?{BEFORE}={encode_cursor(pub_date, pk, target)}'))
+        return links[::-1]
+
+    def _next_links(self, page):
+        if not page.has_next():
+            return []
+        links = [(page.number + 1, f'?{AFTER}={self.next_token}')]
+        if self.window < 2:
+            return links
+        keys = self._boundary_keys(page[-1], newer=False)
+        for step in range(2, self.window + 1):
+            if len(keys) <= self.per_page * (step - 1):
+                break
+            target = page.number + step
+            pub_date, pk = keys[self.per_page * (step - 1) - 1]
+            links.append(
+                (target, f'?{AFTER}={encode_cursor(pub_date, pk, target)}'))
+        return links
+
+
+class ShardedPaginator(KeysetPaginator):
+    """Пагинатор ленты, посты которой лежат на нескольких шардах
+    и в архиве.
+
+    Каждый шард из databases (по умолчанию POST_SHARDS, см.
+    posts.shards) выбирает свою страницу по тому же курсору, а страницы
+    сливаются по ключу (pub_date, id); databases=() - запрос уже
+    направлен в нужную базу. Архив archive (по умолчанию
+    POST_ARCHIVE_DATABASE) читается, только когда горячих постов
+    на страницу не хватило. Без шардов и архива это KeysetPaginator.
+    """
+
+    def __init__(self, object_list, per_page, databases=None, archive=None,
+                 **kwargs):
+        self.databases = (settings.POST_SHARDS if databases is None
+                          else databases)
+        self.archive = (settings.POST_ARCHIVE_DATABASE if archive is None
+                        else archive)
+        super().__init__(object_list, per_page, **kwargs)
+
+    def total_count(self):
+        return sum(part.count()
+                   for parts in tiers(self.object_list, self.databases,
+                                      self.archive)
+                   for part in parts)
+
+    def fetch(self, limit, cursor=None, newer=False, keys=False, offset=0):
+        levels = tiers(self.object_list, self.databases, self.archive)
+        if len(levels) == 1 and len(levels[0]) == 1:
+            return self.select(levels[0][0], limit, cursor, newer, keys,
+                               offset)
+        # Для ?page=N каждый шард отдаёт строки с самого начала ленты:
+        # на каком шарде окажется N-я строка, заранее неизвестно.
+        rows = fetch_tiers(
+            levels, offset + limit, newer,
+            lambda part, count: self.select(part, count, cursor, newer,
+                                            keys),
+            key=None if keys else attrgetter('pub_date', 'pk'))
+        return rows[offset:]
+
+
+class TimelinePaginator(KeysetPaginator):
+    """Пагинатор ленты подписок по материализованному таймлайну.
+
+    object_list - записи TimelineEntry одного пользователя; страница
+    выбирается диапазоном по индексу (user, pub_date, post) и
+    превращается в посты одним запросом.
+
+    pulled - посты авторов, которые не раскладываются по лентам при
+    записи (см. posts.timelines); они подмешиваются при чтении слиянием
+    упорядоченных выборок по ключу (pub_date, id) - таймлайна и постов
+    с каждого шарда из databases (по умолчанию POST_SHARDS), а когда
+    их не хватает - из архива archive (по умолчанию
+    POST_ARCHIVE_DATABASE). Посты таймлайна, уже перенесённые в архив,
+    дочитываются оттуда.
+    """
+
+    key_field = 'post_id'
+
+    def __init__(self, object_list, per_page, posts, pulled=None,
+                 databases=None, archive=None, **kwargs):
+        self.posts = posts
+        self.pulled = pulled
+        self.databases = (settings.POST_SHARDS if databases is None
+                          else databases)
+        self.archive = (settings.POST_ARCHIVE_DATABASE if archive is None
+                        else archive)
+        if pulled is not None:
+            self.pulled = pulled.order_by('-pub_date', '-pk').values_list(
+                'pub_date', 'pk')
+        super().__init__(object_list, per_page, **kwargs)
+
+    def total_count(self):
+        count = super().total_count()
+        if self.pulled is not None:
+            count += sum(part.count()
+                         for parts in tiers(self.pulled, self.databases,
+                                            self.archive)
+                         for part in parts)
+        return count
+
+    def fetch(self, limit, cursor=None, newer=False, keys=False, offset=0):
+        # Из таймлайна нужны только ключи, сами посты выбираются
+        # в _get_page одним запросом.
+        if self.pulled is None:
+            return super().fetch(limit, cursor, newer, True, offset)
+        stored = super().fetch(offset + limit, cursor, newer, True)
+        pulled = self.pulled.reverse() if newer else self.pulled
+        if cursor is not None:
+            pub_date, pk = cursor
+            pulled = pulled.filter(
+                self._newer_than(pub_date, pk, 'pk') if newer
+                else self._older_than(pub_date, pk, 'pk'))
+        pulled = fetch_tiers(
+            tiers(pulled, self.databases, self.archive), offset + limit,
+            newer, lambda part, count: part[:count])
+        rows, seen = [], set()
+        for row in heapq.merge(stored, pulled, reverse=not newer):
+            post_id = row[1]
+            if post_id not in seen:
+                seen.add(post_id)
+                rows.append(row)
+        return rows[offset:offset + limit]
+
+    def _get_page(self, object_list, number, paginator):
+        post_ids = [post_id for pub_date, post_id in object_list]
+        posts = {}
+        for part in spread(self.posts, self.databases):
+            posts.update(part.in_bulk(post_ids))
+        missing = [pk for pk in post_ids if pk not in posts]
+        if missing and self.archive:
+            posts.update(self.posts.using(self.archive).in_bulk(missing))
+        return super()._get_page(
+            [posts[pk] for pk in post_ids if pk in posts], number, paginator)
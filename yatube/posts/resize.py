@@ -0,0 +1,144 @@
+"""Картинки постов в произвольном размере по подписанной ссылке.
+
+Ссылка /media/r/<подпись>/<Ш>x<В>/<имя> (см. url) подписана
+SECRET_KEY, поэтому чужие размеры заказать нельзя. Картинка вписывается
+в рамку ШxВ при первом запросе и кладётся в RESIZE_CACHE_DIR; кеш
+ограничен RESIZE_CACHE_MAX_BYTES и вытесняет файлы, которые дольше
+всего не читали (время чтения отмечается в mtime, см. cached).
+"""
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils._os import safe_join
+from PIL import Image
+
+from . import media
+
+
+SALT = 'posts.resize'
+SIGNATURE_LENGTH = 16
+# mtime файла в кеше обновляется при чтении не чаще раза в столько
+# секунд: точности хватает для LRU, а лишних записей на диск нет.
+TOUCH_INTERVAL = 60 * 60
+# Вытеснение освобождает место с запасом, чтобы не запускаться
+# на каждой следующей записи.
+LOW_WATERMARK = 0.9
+
+_lock = threading.Lock()
+_usage = None
+
+
+def signature(name, width, height):
+    value = salted_hmac(SALT, f'{width}x{height}/{name}').hexdigest()
+    return value[:SIGNATURE_LENGTH]
+
+
+def check(sign, name, width, height):
+    return constant_time_compare(sign, signature(name, width, height))
+
+
+def url(image, width, height):
+    """Подписанная ссылка на картинку image, вписанную в ШxВ."""
+    return reverse('posts:resized_image', kwargs={
+        'sign': signature(image.name, width, height),
+        'width': width, 'height': height, 'name': image.name,
+    })
+
+
+def cached(name, width, height):
+    """Путь к файлу картинки name в размере ШxВ в кеше на диске.
+
+    Файла нет - картинка уменьшается и записывается. Недопустимый
+    размер - ValueError, нет исходника - OSError.
+    """
+    limit = settings.RESIZE_MAX_DIMENSION
+    if not (0 < width <= limit and 0 < height <= limit):
+        raise ValueError(f'Размер {width}x{height} вне 1..{limit}')
+    path = safe_join(settings.RESIZE_CACHE_DIR, f'{width}x{height}', name)
+    try:
+        modified = os.stat(path).st_mtime
+    except FileNotFoundError:
+        _store(path, _render(name, width, height))
+    else:
+        if modified < time.time() - TOUCH_INTERVAL:
+            os.utime(path)
+    return path
+
+
+def _render(name, width, height):
+    storage = media.storage()
+    with storage.open(name) as source, Image.open(source) as image:
+        image_format = image.format
+        # JPEG сразу раскодируется в уменьшенном масштабе.
+        image.draft(image.mode, (width, height))
+        image.thumbnail((width, height), Image.LANCZOS)
+        output = tempfile.SpooledTemporaryFile()
+        image.save(output, image_format)
+    output.seek(0)
+    return output
+
+
+def _store(path, content):
+    global _usage
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Файл появляется в кеше целиком: параллельный запрос того же
+    # размера либо не найдёт его, либо прочитает готовым.
+    with content, tempfile.NamedTemporaryFile(dir=directory,
+                                              delete=False) as temporary:
+        for chunk in iter(lambda: content.read(64 * 1024), b''):
+            temporary.write(chunk)
+    os.replace(temporary.name, path)
+    written = os.path.getsize(path)
+    with _lock:
+        if _usage is None:
+            _usage = sum(size for path, mtime, size in _files())
+        else:
+            _usage += written
+        if _usage > settings.RESIZE_CACHE_MAX_BYTES:
+            _usage = evict()
+
+
+def _files():
+    for directory, dirnames, filenames in os.walk(settings.RESIZE_CACHE_DIR):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield path, stat.st_mtime, stat.st_size
+
+
+def evict():
+    """Удаляет давно не читанные файлы кеша; возвращает его размер."""
+    files = sorted(_files(), key=lambda file: file[1])
+    usage = sum(size for path, mtime, size in files)
+    target = settings.RESIZE_CACHE_MAX_BYTES * LOW_WATERMARK
+    for path, mtime, size in files:
+        if usage <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        usage -= size
+    return usage
+
+
+def cached_path(sign, name, width, height):
+    """Путь к файлу картинки для view; None - ссылка недействительна."""
+    if not check(sign, name, width, height):
+        return None
+    try:
+        return cached(name, width, height)
+    except (OSError, ValueError, SuspiciousFileOperation):
+        # Нет исходника или он не картинка: отвечаем так же, как на
+        # чужую подпись.
+        return None
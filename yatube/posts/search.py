@@ -0,0 +1,183 @@
+"""Полнотекстовый поиск по постам.
+
+На SQLite запрос идёт в индекс FTS5 posts_post_fts (см. миграцию
+0012_post_search_index): результаты упорядочены по bm25, фрагменты
+с подсвеченными словами строит snippet(). Страницы выбираются
+курсором по ключу (ранг, id), как ленты (см. posts.paginators).
+На других базах - подстрока в тексте, от новых постов к старым.
+
+С шардами (см. posts.shards) запрос идёт в индекс каждого шарда,
+а выдачи сливаются по тому же ключу (ранг, id). bm25 считается по
+статистике своего шарда, поэтому ранги разных шардов сравнимы лишь
+приблизительно.
+
+Индекс обновляют триггеры на posts_post. Миграция, которая
+пересоздаёт таблицу постов на SQLite, удаляет и триггеры: после неё
+их нужно создать заново, а индекс - пересобрать командой
+rebuild_search_index.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+import heapq
+from itertools import islice
+import re
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from . import shards
+from .models import Post
+
+
+FTS_TABLE = 'posts_post_fts'
+SNIPPET_TOKENS = 24
+# Границы подсветки в snippet(): символы, которых нет в тексте
+# после escape(), заменяются тегами уже после экранирования.
+MARK_START = '\x02'
+MARK_END = '\x03'
+WORD_RE = re.compile(r'\w+')
+
+
+def available(database=DEFAULT_DB_ALIAS):
+    return connections[database].vendor == 'sqlite'
+
+
+def databases():
+    """Базы с постами, в которых ищет search()."""
+    return [part.db for part in shards.spread(Post.objects.all())]
+
+
+def match_expression(query):
+    """Запрос пользователя в синтаксисе FTS5: все слова, последнее -
+    как префикс. Операторы и кавычки FTS5 из запроса не проходят."""
+    words = WORD_RE.findall(query.lower())
+    if not words:
+        return ''
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def encode_cursor(rank, pk, number):
+    raw = f'{rank!r}|{pk}|{number}'.encode()
+    return urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Возвращает (rank, pk, number) или None для битого токена."""
+    try:
+        raw = urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        rank, pk, number = raw.split('|')
+        rank, pk, number = float(rank), int(pk), int(number)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if number < 1:
+        return None
+    return rank, pk, number
+
+
+def highlight(snippet):
+    return mark_safe(escape(snippet).replace(MARK_START, '<mark>').replace(
+        MARK_END, '</mark>'))
+
+
+class Result:
+    """Пост в выдаче поиска с фрагментом текста."""
+
+    def __init__(self, post, rank, snippet):
+        self.post = post
+        self.rank = rank
+        self.snippet = snippet
+
+
+class SearchPage:
+    """Страница выдачи: results, номер number и курсор next_token."""
+
+    def __init__(self, results, number, has_next):
+        self.results = results
+        self.number = number
+        self.next_token = ''
+        if has_next:
+            last = results[-1]
+            self.next_token = encode_cursor(last.rank, last.post.pk,
+                                            number + 1)
+
+
+def search(query, per_page, token=''):
+    """Страница выдачи по запросу query после курсора token."""
+    cursor = decode_cursor(token) if token else None
+    number = cursor[2] if cursor else 1
+    parts = []
+    for database in databases():
+        # Ключ слияния: FTS5 отдаёт строки по возрастанию (ранг, id),
+        # LIKE - от новых постов к старым.
+        if available(database):
+            part = [((rank, pk), pk, rank, snippet, database)
+                    for pk, rank, snippet
+                    in _fts_rows(query, per_page + 1, cursor, database)]
+        else:
+            part = [((rank, -pk), pk, rank, snippet, database)
+                    for pk, rank, snippet
+                    in _like_rows(query, per_page + 1, cursor, database)]
+        parts.append(part)
+    rows = list(islice(heapq.merge(*parts), per_page + 1))
+    posts = {}
+    for database in {row[4] for row in rows[:per_page]}:
+        posts.update(Post.objects.for_cards().using(database).in_bulk(
+            [row[1] for row in rows[:per_page] if row[4] == database]))
+    results = [Result(posts[pk], rank, highlight(snippet))
+               for key, pk, rank, snippet, database in rows[:per_page]
+               if pk in posts]
+    return SearchPage(results, number, len(rows) > per_page)
+
+
+def _fts_rows(query, limit, cursor, database=DEFAULT_DB_ALIAS):
+    expression = match_expression(query)
+    if not expression:
+        return []
+    where = ''
+    params = [MARK_START, MARK_END, SNIPPET_TOKENS, expression]
+    if cursor is not None:
+        rank, pk = cursor[:2]
+        where = (f'AND (bm25({FTS_TABLE}) > %s '
+                 f'OR (bm25({FTS_TABLE}) = %s AND rowid > %s))')
+        params += [rank, rank, pk]
+    with connections[database].cursor() as db:
+        db.execute(
+            f"SELECT rowid, bm25({FTS_TABLE}), "
+            f"snippet({FTS_TABLE}, 0, %s, %s, '…', %s) "
+            f'FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s {where} '
+            f'ORDER BY bm25({FTS_TABLE}), rowid LIMIT %s',
+            params + [limit])
+        return db.fetchall()
+
+
+def _like_rows(query, limit, cursor, database=DEFAULT_DB_ALIAS):
+    query = query.strip()
+    if not query:
+        return []
+    posts = Post.objects.using(database).filter(
+        text__icontains=query).order_by('-pk')
+    if cursor is not None:
+        posts = posts.filter(pk__lt=cursor[1])
+    return [(pk, 0.0, text[:SNIPPET_TOKENS * 8])
+            for pk, text in posts.values_list('pk', 'text')[:limit]]
+
+
+def filter_matching(queryset, query):
+    """Посты queryset, найденные в индексе по запросу query."""
+    # RawSQL в pk__in дал бы IN ((SELECT ...)), а это в SQLite
+    # скалярный подзапрос - только первая найденная строка.
+    table = queryset.model._meta.db_table
+    return queryset.extra(
+        where=[f'"{table}"."id" IN (SELECT rowid FROM {FTS_TABLE} '
+               f'WHERE {FTS_TABLE} MATCH %s)'],
+        params=[match_expression(query)])
+
+
+def rebuild(database=DEFAULT_DB_ALIAS):
+    """Пересобирает индекс базы database по её постам."""
+    with connections[database].cursor() as db:
+        db.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        db.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
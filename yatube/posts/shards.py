@@ -0,0 +1,409 @@
+"""Шарды постов и комментариев по авторам.
+
+При непустом POST_SHARDS посты автора вместе с комментариями к ним
+лежат в одной базе из этого списка, а какой - записано в AuthorShard.
+Автор без записи ещё ничего не публиковал: его первый пост ложится на
+шард по остатку от деления id автора. Пользователи, группы, подписки,
+ленты подписок и счётчики остаются в default.
+
+Источник истины о шардах - AuthorShard и MovedPost в default: чтения
+берут их из кеша не дольше SHARD_DIRECTORY_TIMEOUT секунд, а записи
+новых строк - прямо из базы.
+
+id постов и комментариев не повторяются между шардами: шард с номером
+N (с единицы, по порядку в POST_SHARDS) выдаёт id начиная с N * ID_SPAN
+(см. reserve_ids), id меньше ID_SPAN - у строк, созданных в default до
+шардирования. Поэтому шард поста известен по его id без запросов к
+шардам; посты, перенесённые командой rebalance_shards, записаны в
+MovedPost и ищутся по шарду автора.
+
+ShardRouter направляет в шард сохранения и запросы через связи
+(author.posts, post.comments). Запрос Post.objects без такой связи
+пошёл бы в default, поэтому код выбирает базу явно: author_posts,
+posts_by_id и spread.
+
+Старые посты могут лежать ещё и в архиве POST_ARCHIVE_DATABASE (см.
+posts.archive): spread и author_parts включают его, а комментарии,
+написанные в архив, получают id из диапазона от ARCHIVE_ID_START.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import paginators
+from .models import AuthorShard, Comment, MovedPost, Post, User
+
+ID_SPAN = 2 ** 40
+ARCHIVE_ID_START = 2 ** 62
+AUTHOR_KEY_PREFIX = 'shard:author'
+POST_KEY_PREFIX = 'shard:post'
+SHARDED_MODELS = (Post, Comment)
+POST_FIELDS = [field.name for field in Post._meta.concrete_fields
+               if not field.primary_key]
+
+
+def enabled():
+    return bool(settings.POST_SHARDS)
+
+
+def scattered():
+    """Посты лежат не только в default: на шардах или в архиве."""
+    return enabled() or bool(settings.POST_ARCHIVE_DATABASE)
+
+
+def _author_key(author_id):
+    return f'{AUTHOR_KEY_PREFIX}:{author_id}'
+
+
+def _post_key(post_id):
+    return f'{POST_KEY_PREFIX}:{post_id}'
+
+
+def home(pk):
+    """Шард, который выдал id pk, или None для чужого id."""
+    number = pk // ID_SPAN
+    if number == 0:
+        return DEFAULT_DB_ALIAS
+    if 0 < number <= len(settings.POST_SHARDS):
+        return settings.POST_SHARDS[number - 1]
+    return None
+
+
+def for_author(author_id, create=False, cached=True):
+    """Шард постов автора; create=True закрепляет его в AuthorShard.
+
+    cached=False читает AuthorShard мимо кеша - для записи.
+    """
+    key = _author_key(author_id)
+    database = cache.get(key) if cached else None
+    if database is not None:
+        return database
+    directory = AuthorShard.objects.using(DEFAULT_DB_ALIAS)
+    database = directory.filter(author_id=author_id).values_list(
+        'database', flat=True).first()
+    if database is None:
+        database = settings.POST_SHARDS[author_id % len(settings.POST_SHARDS)]
+        if not create:
+            # Постов у автора нет: место выбрано, но не закреплено.
+            return database
+        database = directory.get_or_create(
+            author_id=author_id, defaults={'database': database})[0].database
+    cache.set(key, database, settings.SHARD_DIRECTORY_TIMEOUT)
+    return database
+
+
+def for_post(post_id, cached=True):
+    """Шард поста или None, если такого id быть не может."""
+    key = _post_key(post_id)
+    # В кеше автор перенесённого поста или 0 для поста на своём шарде.
+    author_id = cache.get(key) if cached else None
+    if author_id is None:
+        author_id = MovedPost.objects.using(DEFAULT_DB_ALIAS).filter(
+            post_id=post_id).values_list('author_id', flat=True).first() or 0
+        cache.set(key, author_id, settings.SHARD_DIRECTORY_TIMEOUT)
+    if author_id:
+        return for_author(author_id, cached=cached)
+    return home(post_id)
+
+
+def author_posts(author_id, queryset=None):
+    """Посты автора с его шарда."""
+    if queryset is None:
+        queryset = Post.objects.all()
+    if enabled():
+        queryset = queryset.using(for_author(author_id))
+    return queryset.filter(author_id=author_id)
+
+
+def author_parts(author_id, queryset=None):
+    """Посты автора с его шарда и из архива - по запросу на базу."""
+    posts = author_posts(author_id, queryset)
+    if settings.POST_ARCHIVE_DATABASE:
+        return [posts, posts.using(settings.POST_ARCHIVE_DATABASE)]
+    return [posts]
+
+
+def posts_by_id(post_id, queryset=None):
+    """Запрос к шарду поста post_id, например для
+    get_object_or_404(posts_by_id(post_id), pk=post_id)."""
+    if queryset is None:
+        queryset = Post.objects.all()
+    if not enabled():
+        return queryset
+    database = for_post(post_id)
+    if database is None:
+        return queryset.none()
+    return queryset.using(database)
+
+
+def spread(queryset):
+    """Тот же запрос к каждому шарду и к архиву."""
+    parts = paginators.spread(queryset, settings.POST_SHARDS)
+    if settings.POST_ARCHIVE_DATABASE:
+        parts.append(queryset.using(settings.POST_ARCHIVE_DATABASE))
+    return parts
+
+
+def exists(queryset):
+    return any(part.exists() for part in spread(queryset))
+
+
+def update(queryset, **fields):
+    return sum(part.update(**fields) for part in spread(queryset))
+
+
+def copy_rows(model, rows, database):
+    """Копирует строки rows модели model в базу database как есть;
+    уже скопированные строки пропускает.
+
+    bulk_create ставит полям auto_now_add и auto_now текущее время,
+    поэтому их прежние значения записываются следом через bulk_update.
+    """
+    dated = [field for field in model._meta.concrete_fields
+             if getattr(field, 'auto_now', False)
+             or getattr(field, 'auto_now_add', False)]
+    values = [[getattr(row, field.attname) for field in dated]
+              for row in rows]
+    queryset = model._base_manager.using(database)
+    queryset.bulk_create(rows, ignore_conflicts=True)
+    if not dated:
+        return
+    for row, row_values in zip(rows, values):
+        for field, value in zip(dated, row_values):
+            setattr(row, field.attname, value)
+    queryset.bulk_update(rows, [field.name for field in dated])
+
+
+def delete_rows(model, pks, database):
+    """Удаляет строки модели model с id из pks в базе database мимо
+    сигналов и каскадов Django."""
+    connection = connections[database]
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(model._meta.pk.column)
+    pks = list(pks)
+    size = max(connection.ops.bulk_batch_size([model._meta.pk], pks), 1)
+    with connection.cursor() as cursor:
+        for start in range(0, len(pks), size):
+            batch = pks[start:start + size]
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(
+                f'DELETE FROM {table} WHERE {column} IN ({placeholders})',
+                batch)
+
+
+def reserve_ids(database):
+    """Ставит счётчик id постов и комментариев шарда или архива
+    database на последний id из его диапазона.
+
+    Вызывается после миграций шарда и после переноса на него строк
+    с чужими id, которые сдвигают счётчик SQLite вперёд.
+    """
+    connection = connections[database]
+    if connection.vendor != 'sqlite':
+        # На других СУБД последовательности сдвигаются их средствами.
+        return
+    if database == settings.POST_ARCHIVE_DATABASE:
+        start = ARCHIVE_ID_START
+    else:
+        start = (settings.POST_SHARDS.index(database) + 1) * ID_SPAN
+    with connection.cursor() as cursor:
+        for model in SHARDED_MODELS:
+            table = model._meta.db_table
+            cursor.execute(
+                'INSERT INTO sqlite_sequence (name, seq) SELECT %s, 0 '
+                'WHERE NOT EXISTS '
+                '(SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                [table, table])
+            cursor.execute(
+                f'UPDATE sqlite_sequence SET seq = (SELECT COALESCE('
+                f'MAX(id), %s) FROM {table} WHERE id >= %s AND id < %s) '
+                f'WHERE name = %s',
+                [start, start, start + ID_SPAN, table])
+
+
+class AuthorMoving(Exception):
+    """Посты автора переносятся на другой шард (см. move_author)."""
+
+
+class ShardRouter:
+    """Сохраняет посты и комментарии на шард автора поста.
+
+    Пока посты автора переносятся, запись их и комментариев к ним
+    отклоняется исключением AuthorMoving.
+    """
+
+    def db_for_read(self, model, **hints):
+        return self._database(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        database = self._database(model, instance)
+        if (database is not None and model in SHARDED_MODELS
+                and isinstance(instance, SHARDED_MODELS)):
+            post = instance.post if isinstance(instance, Comment) else instance
+            if AuthorShard.objects.using(DEFAULT_DB_ALIAS).filter(
+                    author_id=post.author_id, moving=True).exists():
+                raise AuthorMoving(post.author_id)
+        return database
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not enabled():
+            return None
+        databases = {DEFAULT_DB_ALIAS, *settings.POST_SHARDS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def _database(self, model, instance):
+        if instance is None or not enabled():
+            return None
+        if model not in SHARDED_MODELS:
+            # Автор и группа поста с шарда лежат в default, а Django
+            # искал бы их в базе поста.
+            if isinstance(instance, SHARDED_MODELS):
+                return DEFAULT_DB_ALIAS
+            return None
+        if isinstance(instance, User):
+            return for_author(instance.pk)
+        if not isinstance(instance, SHARDED_MODELS):
+            return None
+        if instance._state.db and not instance._state.adding:
+            return instance._state.db
+        # Новая строка: шард берётся из базы, а не из кеша, который
+        # у другого процесса мог устареть после переноса автора.
+        if isinstance(instance, Comment):
+            return instance.post_id and for_post(instance.post_id,
+                                                 cached=False)
+        return instance.author_id and for_author(instance.author_id,
+                                                 cached=False)
+
+
+def move_author(author_id, target, batch_size, pause=0.0):
+    """Переносит посты автора вместе с комментариями на шард target.
+
+    Пока посты копируются пачками, автор продолжает писать в старый
+    шард. Затем AuthorShard помечает автора флагом moving, и ShardRouter
+    перестаёт принимать записи его постов и комментариев к ним.
+    Последний проход - одна транзакция старого шарда, которая первым
+    делом блокирует запись в него (см. _lock): она дописывает посты,
+    изменённые за время переноса, и все комментарии, переключает
+    AuthorShard на target и удаляет строки со старого шарда. Посты,
+    удалённые во время переноса, остаются на новом шарде.
+
+    Возвращает (перенесено постов, осталось на старом шарде); второе
+    больше нуля, только если запись, начатая до флага, закончилась
+    уже после переноса.
+    """
+    source = for_author(author_id, cached=False)
+    if source == target:
+        return 0, 0
+    started = timezone.now()
+    posts = Post.objects.using(source).filter(author_id=author_id)
+    moved = _copy(posts, target, batch_size, pause)
+    directory = AuthorShard.objects.using(DEFAULT_DB_ALIAS)
+    directory.update_or_create(
+        author_id=author_id, defaults={'database': source, 'moving': True})
+    try:
+        with transaction.atomic(using=source):
+            _lock(posts)
+            _copy(posts.filter(updated__gte=started), target, batch_size,
+                  update=True)
+            directory.filter(author_id=author_id).update(
+                database=target, moving=False)
+            cache.delete(_author_key(author_id))
+            left = _delete(posts, target, batch_size)
+    finally:
+        directory.filter(author_id=author_id, moving=True).update(
+            moving=False)
+    _recount_comments(author_id, target)
+    return moved, left
+
+
+def _lock(posts):
+    """Не даёт писать посты и комментарии в базу posts до конца
+    транзакции."""
+    connection = connections[posts.db]
+    if connection.vendor == 'sqlite':
+        # SQLite блокирует запись во всю базу с первой записи
+        # транзакции, а не с первого чтения.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {Post._meta.db_table} WHERE 0 = 1')
+    else:
+        # К заблокированным постам не добавить и комментарии.
+        list(posts.select_for_update().values_list('pk', flat=True))
+
+
+def _copy(posts, target, batch_size, pause=0.0, update=False):
+    copied = last_pk = 0
+    posts = posts.order_by('pk')
+    while True:
+        batch = list(posts.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return copied
+        last_pk = batch[-1].pk
+        with transaction.atomic(using=target):
+            copy_rows(Post, batch, target)
+            if update:
+                Post.objects.using(target).bulk_update(batch, POST_FIELDS)
+            _copy_comments(posts.db, target, [post.pk for post in batch])
+            reserve_ids(target)
+        _register(batch, target)
+        copied += len(batch)
+        time.sleep(pause)
+
+
+def _copy_comments(source, target, post_ids):
+    """Копирует комментарии к постам post_ids, возвращает их id."""
+    comments = list(Comment.objects.using(source).filter(
+        post_id__in=post_ids))
+    copy_rows(Comment, comments, target)
+    return [comment.pk for comment in comments]
+
+
+def _register(posts, target):
+    """Записывает, где искать перенесённые посты."""
+    moved = [post for post in posts if home(post.pk) != target]
+    returned = [post.pk for post in posts if home(post.pk) == target]
+    directory = MovedPost.objects.using(DEFAULT_DB_ALIAS)
+    directory.bulk_create(
+        [MovedPost(post_id=post.pk, author_id=post.author_id)
+         for post in moved], ignore_conflicts=True)
+    directory.filter(post_id__in=returned).delete()
+    cache.delete_many([_post_key(post.pk) for post in posts])
+
+
+def _recount_comments(author_id, target):
+    # Post.comments_count меняется update() и не сдвигает updated.
+    counts = Comment.objects.using(target).filter(
+        post=OuterRef('pk')).order_by().values('post').annotate(
+        count=Count('pk')).values('count')
+    Post.objects.using(target).filter(author_id=author_id).update(
+        comments_count=Coalesce(Subquery(counts), 0))
+
+
+def _delete(posts, target, batch_size):
+    # Удаляем мимо сигналов и каскадов: записи лент, счётчики и файлы
+    # картинок относятся к посту, который просто сменил базу.
+    source = posts.db
+    left = last_pk = 0
+    ids = posts.order_by('pk').values_list('pk', flat=True)
+    while True:
+        batch = list(ids.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return left
+        last_pk = batch[-1]
+        copied = list(Post.objects.using(target).filter(
+            pk__in=batch).values_list('pk', flat=True))
+        left += len(batch) - len(copied)
+        # Комментарии, написанные в старый шард за время переноса.
+        with transaction.atomic(using=target):
+            comments = _copy_comments(source, target, copied)
+            reserve_ids(target)
+        delete_rows(Comment, comments, source)
+        delete_rows(Post, copied, source)
@@ -0,0 +1,291 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import (post_delete, post_migrate, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import counters, feed_cache, media, shards, thumbnails, timelines
+from .models import (CARD_AUTHOR_FIELDS, Comment, Follow, Group, Post,
+                     TimelineEntry, User)
+from .paginators import feed_count_key
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def reset_post_feed_counts(sender, instance, signal, created=False,
+                           **kwargs):
+    keys = [feed_count_key('index'),
+            feed_count_key('author', instance.author_id)]
+    if instance.group_id:
+        keys.append(feed_count_key('group', instance.group_id))
+    previous_group_id = getattr(instance, '_previous_group_id', None)
+    if previous_group_id and previous_group_id != instance.group_id:
+        keys.append(feed_count_key('group', previous_group_id))
+    if ((created or signal is post_delete)
+            and instance.author_id not in timelines.celebrity_ids()):
+        # Пост появился в лентах подписчиков автора или пропал из них.
+        # У популярного автора подписчиков слишком много: их число
+        # постов устареет не дольше чем на PAGINATOR_COUNT_TIMEOUT.
+        keys.extend(
+            feed_count_key('follow', user_id) for user_id in
+            Follow.objects.filter(author_id=instance.author_id).values_list(
+                'user_id', flat=True).iterator())
+    cache.delete_many(keys)
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def reset_follow_feed_count(sender, instance, **kwargs):
+    cache.delete(feed_count_key('follow', instance.user_id))
+
+
+@receiver(post_save, sender=Post)
+def fan_out_new_post(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        timelines.fan_out_post(instance)
+
+
+@receiver(post_save, sender=Follow)
+def backfill_timeline(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        timelines.backfill(instance.user_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Follow)
+def purge_timeline(sender, instance, **kwargs):
+    timelines.purge(instance.user_id, instance.author_id)
+
+
+@receiver(post_save, sender=User)
+def create_author_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.recount_author(instance.pk)
+
+
+@receiver(post_save, sender=Post)
+def count_new_post(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.bump_author(instance.author_id, posts_count=1)
+
+
+@receiver(post_delete, sender=Post)
+def count_deleted_post(sender, instance, **kwargs):
+    counters.bump_author(instance.author_id, posts_count=-1)
+
+
+@receiver(post_save, sender=Comment)
+def count_new_comment(sender, instance, created, using, raw=False,
+                      **kwargs):
+    if created and not raw:
+        counters.bump_comments(instance.post_id, 1, using)
+
+
+@receiver(post_delete, sender=Comment)
+def count_deleted_comment(sender, instance, using, **kwargs):
+    counters.bump_comments(instance.post_id, -1, using)
+
+
+@receiver(post_save, sender=Follow)
+def count_new_follow(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.bump_author(instance.author_id, followers_count=1)
+        counters.bump_author(instance.user_id, following_count=1)
+
+
+@receiver(post_delete, sender=Follow)
+def count_deleted_follow(sender, instance, **kwargs):
+    counters.bump_author(instance.author_id, followers_count=-1)
+    counters.bump_author(instance.user_id, following_count=-1)
+
+
+@receiver(pre_save, sender=Post)
+def remember_previous_post(sender, instance, using, raw=False, **kwargs):
+    instance._previous_group_id = None
+    instance._previous_image = None
+    if instance.pk and not raw:
+        instance._previous_group_id, instance._previous_image = (
+            Post.objects.using(using).filter(pk=instance.pk).values_list(
+                'group_id', 'image').first() or (None, None))
+
+
+@receiver(pre_save, sender=User)
+def remember_previous_card(sender, instance, using, raw=False,
+                           update_fields=None, **kwargs):
+    # Поля пользователя, которые выводятся в карточках его постов.
+    instance._previous_card = None
+    if (not instance.pk or raw or update_fields is not None
+            and not update_fields & set(CARD_AUTHOR_FIELDS)):
+        return
+    instance._previous_card = User.objects.using(using).filter(
+        pk=instance.pk).values_list(*CARD_AUTHOR_FIELDS).first()
+
+
+@receiver(pre_save, sender=Post)
+def pin_author_shard(sender, instance, raw=False, **kwargs):
+    # Первый пост закрепляет шард автора: дальше он не зависит
+    # от числа шардов в POST_SHARDS.
+    if instance._state.adding and not raw and shards.enabled():
+        shards.for_author(instance.author_id, create=True, cached=False)
+
+
+@receiver(pre_save, sender=Post)
+def measure_image(sender, instance, raw=False, **kwargs):
+    image = instance.image
+    if raw or image.name == instance._previous_image:
+        return
+    instance.image_width = instance.image_height = None
+    instance.image_placeholder = ''
+    if not image:
+        return
+    # Как ImageFile.width: файл, открытый только ради замера, закрываем.
+    # Заглушку для новой картинки запишет пул миниатюр.
+    close = image.closed
+    try:
+        image.open()
+        instance.image_width, instance.image_height = thumbnails.measure(
+            image)
+    except Exception:
+        # Без размеров заглушка выводится размером по умолчанию.
+        logger.warning('Не удалось измерить картинку %s', image.name,
+                       exc_info=True)
+    finally:
+        if close:
+            image.close()
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def bump_post_feeds(sender, instance, **kwargs):
+    scopes = feed_cache.post_scopes(instance)
+    previous_group_id = getattr(instance, '_previous_group_id', None)
+    if previous_group_id and previous_group_id != instance.group_id:
+        scopes.append(feed_cache.scope('group', previous_group_id))
+    feed_cache.bump(*scopes)
+
+
+@receiver(pre_save, sender=Group)
+def remember_previous_slug(sender, instance, using, raw=False, **kwargs):
+    # Из полей группы карточки постов выводят только slug.
+    instance._previous_slug = None
+    if instance.pk and not raw:
+        instance._previous_slug = Group.objects.using(using).filter(
+            pk=instance.pk).values_list('slug', flat=True).first()
+
+
+@receiver(post_save, sender=Group)
+def bump_group_feeds(sender, instance, created, raw=False, **kwargs):
+    previous_slug = getattr(instance, '_previous_slug', None)
+    if created or raw or previous_slug in (None, instance.slug):
+        # Название и описание выводит только страница группы.
+        feed_cache.bump(feed_cache.scope('group', instance.pk))
+        return
+    bump_group_cards(sender, instance)
+
+
+@receiver(pre_delete, sender=Group)
+def bump_group_cards(sender, instance, **kwargs):
+    # Карточки постов группы кешируются по Post.updated (см.
+    # posts.templatetags.post_cards), поэтому двигаем и его.
+    shards.update(Post.objects.filter(group=instance),
+                  updated=timezone.now())
+    feed_cache.bump(feed_cache.GLOBAL_SCOPE)
+
+
+@receiver(pre_delete, sender=Group)
+def detach_sharded_group_posts(sender, instance, **kwargs):
+    # SET_NULL Django выполняет только в базе группы.
+    if shards.scattered():
+        shards.update(Post.objects.filter(group=instance), group=None)
+
+
+@receiver(post_save, sender=User)
+def bump_user_feeds(sender, instance, created, raw=False, **kwargs):
+    scopes = [feed_cache.scope('author', instance.pk)]
+    if created:
+        feed_cache.bump(*scopes)
+        return
+    card = tuple(getattr(instance, field) for field in CARD_AUTHOR_FIELDS)
+    if raw or getattr(instance, '_previous_card', None) in (None, card):
+        return
+    # Имя автора есть в карточках его постов на главной, в группах
+    # и в профиле; сами карточки кешируются по Post.updated.
+    scopes.append('index')
+    for posts in shards.author_parts(instance.pk):
+        scopes.extend(feed_cache.scope('group', group_id) for group_id in
+                      posts.exclude(group=None).order_by().values_list(
+                          'group_id', flat=True).distinct())
+        posts.update(updated=timezone.now())
+    feed_cache.bump(*scopes)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def bump_comment_pages(sender, instance, **kwargs):
+    feed_cache.bump(feed_cache.scope('post', instance.post_id))
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def bump_follow_pages(sender, instance, **kwargs):
+    # Профили показывают число подписчиков и подписок.
+    feed_cache.bump(feed_cache.scope('author', instance.author_id),
+                    feed_cache.scope('author', instance.user_id))
+
+
+@receiver(post_save, sender=Post)
+def schedule_thumbnails(sender, instance, raw=False, **kwargs):
+    name = instance.image.name
+    if raw or not name or name == instance._previous_image:
+        return
+    transaction.on_commit(lambda: thumbnails.schedule(instance))
+
+
+@receiver(post_save, sender=Post)
+def count_image_references(sender, instance, raw=False, **kwargs):
+    name = instance.image.name
+    previous = instance._previous_image
+    if raw or name == previous:
+        return
+    if name:
+        media.retain(name)
+    if previous:
+        media.release(previous)
+
+
+@receiver(post_delete, sender=Post)
+def release_post_image(sender, instance, **kwargs):
+    if instance.image.name:
+        media.release(instance.image.name)
+
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_posts(sender, instance, **kwargs):
+    # Каскад Django удаляет посты и комментарии только из базы
+    # пользователя.
+    if shards.scattered():
+        for posts in shards.author_parts(instance.pk):
+            posts.delete()
+        for comments in shards.spread(
+                Comment.objects.filter(author_id=instance.pk)):
+            comments.delete()
+
+
+@receiver(post_delete, sender=Post)
+def purge_sharded_timelines(sender, instance, using, **kwargs):
+    # Записи лент лежат в default и каскадом с шарда не удаляются.
+    if using != DEFAULT_DB_ALIAS:
+        TimelineEntry.objects.filter(post_id=instance.pk).delete()
+
+
+@receiver(post_migrate)
+def reserve_shard_ids(sender, using, **kwargs):
+    if sender.label == 'posts' and (
+            using in settings.POST_SHARDS
+            or using == settings.POST_ARCHIVE_DATABASE):
+        shards.reserve_ids(using)
@@ -0,0 +1,67 @@
+"""Хранилище картинок постов с адресацией по содержимому.
+
+Имя файла - SHA-256 его содержимого, разложенный по вложенным
+каталогам: posts/ab/cd/abcd….jpg, так что в одном каталоге не
+оказывается сотен тысяч файлов. Одинаковые загрузки попадают в один
+и тот же файл; сколько постов на него ссылается, считает posts.media.
+"""
+import hashlib
+import os
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    # Уровни вложенности и число символов хеша на уровень.
+    shard_levels = 2
+    shard_width = 2
+
+    def hashed_name(self, name, content):
+        """Имя файла по его содержимому; content читается по частям."""
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        directory, basename = os.path.split(name)
+        extension = os.path.splitext(basename)[1].lower()
+        hexdigest = digest.hexdigest()
+        shards = [hexdigest[level * self.shard_width:
+                            (level + 1) * self.shard_width]
+                  for level in range(self.shard_levels)]
+        return '/'.join(filter(None, (directory, *shards,
+                                      hexdigest + extension)))
+
+    def is_hashed(self, name):
+        """Лежит ли файл name уже по адресу своего содержимого."""
+        *shards, basename = name.split('/')[-self.shard_levels - 1:]
+        match = re.fullmatch(r'([0-9a-f]{64})(\.\w+)?', basename)
+        return bool(match) and shards == [
+            match.group(1)[level * self.shard_width:
+                           (level + 1) * self.shard_width]
+            for level in range(self.shard_levels)
+        ]
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.hashed_name(name, content)
+        if self.exists(name):
+            # Файл снова нужен: освежаем время изменения, чтобы
+            # collect_media не принял его за давно брошенный.
+            os.utime(self.path(name))
+            return name
+        try:
+            return self._save(name, content)
+        except FileExistsError:
+            # Такой же файл только что записала параллельная загрузка.
+            return name
+
+    def get_available_name(self, name, max_length=None):
+        # Имя определяется содержимым: занятое имя - это тот же файл.
+        raise FileExistsError(name)
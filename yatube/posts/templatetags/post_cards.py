@@ -0,0 +1,63 @@
+from django import template
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from core import replicas
+from posts import thumbnails
+
+
+register = template.Library()
+
+CARD_KEY_PREFIX = 'post-card'
+
+
+def card_key(post, all_group_posts, profile):
+    return (f'{CARD_KEY_PREFIX}:{post.pk}:{post.updated.timestamp()}:'
+            f'{int(bool(all_group_posts))}{int(bool(profile))}')
+
+
+def card_keys(post):
+    """Ключи всех вариантов карточки поста."""
+    return [card_key(post, all_group_posts, profile)
+            for all_group_posts in (False, True)
+            for profile in (False, True)]
+
+
+@register.simple_tag
+def post_cards(posts, all_group_posts=False, profile=False):
+    """Отрисованные карточки постов ленты, каждая из своего кеша.
+
+    Ключ карточки зависит от id поста, Post.updated и флагов шаблона,
+    так что одна и та же карточка переиспользуется всеми лентами.
+    Все карточки страницы читаются из кеша одним get_many, а миниатюры
+    для недостающих карточек ищутся одним проходом по KV sorl-thumbnail.
+    Карточки, отрисованные с реплики, в кеш не попадают, как и карточки
+    с заглушкой вместо миниатюры: пост могли изменить после того, как
+    его миниатюры встали в очередь, и пул сбросит карточку по старому
+    Post.updated (см. posts.thumbnails.schedule).
+    """
+    posts = list(posts)
+    keys = [card_key(post, all_group_posts, profile) for post in posts]
+    cards = cache.get_many(keys)
+    stale = [(key, post) for key, post in zip(keys, posts)
+             if key not in cards]
+    page_thumbnails = thumbnails.lookup_many(
+        (post.image for key, post in stale), 'card')
+    missing = {}
+    cacheable = {}
+    for key, post in stale:
+        missing[key] = render_to_string('includes/card.html', {
+            'post': post,
+            'all_group_posts': all_group_posts,
+            'profile': profile,
+            'thumbnails': page_thumbnails,
+        })
+        if not (post.image and isinstance(page_thumbnails[post.image.name],
+                                          thumbnails.Placeholder)):
+            cacheable[key] = missing[key]
+    if cacheable and not replicas.replica_reads():
+        cache.set_many(cacheable, settings.CARD_CACHE_TIMEOUT)
+    cards.update(missing)
+    return [mark_safe(cards[key]) for key in keys]
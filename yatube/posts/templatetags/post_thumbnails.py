@@ -0,0 +1,33 @@
+from django import template
+
+from posts import resize, thumbnails
+
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def post_thumbnail(context, image, name):
+    """Готовая миниатюра картинки поста или заглушка её размера.
+
+    Миниатюра не генерируется в запросе (см. posts.thumbnails): пока
+    её нет, у результата пустой url, но есть width и height.
+    Если в контексте есть словарь thumbnails, заранее собранный для
+    всей страницы (см. post_cards), отдельного запроса к KV нет.
+    """
+    prefetched = context.get('thumbnails') or {}
+    if image.name in prefetched:
+        return prefetched[image.name]
+    return thumbnails.lookup(image, name)
+
+
+@register.simple_tag
+def resized_url(image, width, height):
+    """Подписанная ссылка на картинку поста, вписанную в ШxВ.
+
+    Размер выбирает шаблон, заранее ничего готовить не нужно:
+    картинка уменьшается при первом запросе (см. posts.resize).
+    """
+    if not image:
+        return ''
+    return resize.url(image, width, height)
@@ -0,0 +1,107 @@
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.urls import reverse
+
+from .. import shards
+from ..models import Comment, Follow, Post, User
+
+ARCHIVE = 'archive'
+
+
+@override_settings(POST_ARCHIVE_DATABASE=ARCHIVE, COUNT_POSTS=2,
+                   PAGINATOR_WINDOW=1)
+@mock.patch.object(transaction, 'on_commit', lambda func: func())
+class ArchiveTest(TestCase):
+    databases = {'default', ARCHIVE}
+
+    def setUp(self):
+        cache.clear()
+        shards.reserve_ids(ARCHIVE)
+        self.author = User.objects.create_user(username='author')
+        self.reader = User.objects.create_user(username='reader')
+        self.posts = [Post.objects.create(author=self.author,
+                                          text=f'Пост {number}')
+                      for number in range(6)]
+        # Три первых поста - старые.
+        for age, post in enumerate(reversed(self.posts[:3]), start=100):
+            Post.objects.filter(pk=post.pk).update(
+                pub_date=timezone.now() - timedelta(days=age))
+        self.old = self.posts[0]
+        Comment.objects.create(post=self.old, author=self.reader,
+                               text='Старый ответ')
+        call_command('archive_posts', days=30, pause=0, stdout=StringIO())
+        self.client.force_login(self.reader)
+
+    def tearDown(self):
+        cache.clear()
+
+    def pks(self, response):
+        return [post.pk for post in response.context['page_obj']]
+
+    def test_old_posts_moved_with_comments(self):
+        """Старые посты и их комментарии переезжают в архив"""
+        hot = Post.objects.using('default')
+        self.assertEqual(hot.count(), 3)
+        self.assertEqual(Post.objects.using(ARCHIVE).count(), 3)
+        self.assertFalse(Comment.objects.using('default').exists())
+        self.assertEqual(
+            Comment.objects.using(ARCHIVE).get().post_id, self.old.pk)
+
+    def test_post_detail_resolves_archived_post(self):
+        """Страница архивного поста открывается и принимает комментарии"""
+        url = reverse('posts:post_detail', args=(self.old.pk,))
+        response = self.client.get(url)
+        self.assertContains(response, self.old.text)
+        self.assertContains(response, 'Старый ответ')
+        self.assertContains(response, self.author.username)
+        self.client.post(reverse('posts:add_comment', args=(self.old.pk,)),
+                         {'text': 'Новый ответ'})
+        comment = Comment.objects.using(ARCHIVE).get(text='Новый ответ')
+        self.assertGreaterEqual(comment.pk, shards.ARCHIVE_ID_START)
+        self.assertEqual(
+            Post.objects.using(ARCHIVE).get(pk=self.old.pk).comments_count,
+            2)
+        self.assertEqual(self.client.get(
+            reverse('posts:post_detail', args=(0,))).status_code, 404)
+
+    def test_feeds_read_archive_only_when_deep(self):
+        """Ленты читают архив, только дойдя до архивных постов"""
+        Follow.objects.create(user=self.reader, author=self.author)
+        expected = [post.pk for post in reversed(self.posts)]
+        for url in (reverse('posts:index'),
+                    reverse('posts:profile', args=('author',)),
+                    reverse('posts:follow_index')):
+            with self.subTest(url=url):
+                # Первый запрос кеширует число постов для ссылок.
+                self.client.get(url)
+                with self.assertNumQueries(0, using=ARCHIVE):
+                    response = self.client.get(url)
+                pks = self.pks(response)
+                while len(pks) < len(expected):
+                    token = response.context['page_obj'].paginator.next_token
+                    self.assertTrue(token)
+                    response = self.client.get(url, {'after': token})
+                    pks += self.pks(response)
+                self.assertEqual(pks, expected)
+                response = self.client.get(url, {'before': 'last'})
+                self.assertEqual(self.pks(response), expected[-2:])
+
+    def test_archived_posts_searchable(self):
+        """Архивные посты находит поиск и раздел архива в админке"""
+        page = self.client.get(reverse('posts:search'),
+                               {'q': 'пост'}).context['page']
+        self.assertIn(self.old.pk, [result.post.pk for result in page.results])
+        admin = User.objects.create_superuser('admin', 'a@a.ru', 'pass')
+        self.client.force_login(admin)
+        response = self.client.get(
+            reverse('admin:posts_archivedpost_changelist'), {'q': 'пост'})
+        self.assertEqual(
+            sorted(post.pk for post in response.context['cl'].result_list),
+            [post.pk for post in self.posts[:3]])
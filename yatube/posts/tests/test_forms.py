@@ -1,10 +1,16 @@
+import hashlib
 import shutil
+import struct
 import tempfile
+from unittest import mock
+import zlib
 
 from django.test import Client, TestCase, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
 from django.urls import reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.conf import settings
+from PIL import ImageFile
 
 from ..models import Group, Post, User, Comment
 
@@ -75,11 +81,96 @@ class PostCreateFormTest(TestCase):
 
         self.assertEqual(Post.objects.count(), posts_count + COUNT_POSTS_ADDED)
 
-        self.assertTrue(Post.objects.filter(author=self.user,
-                                            text='Тестовый пост 2',
-                                            group=None,
-                                            image='posts/small.gif',
-                                            ).exists())
+        digest = hashlib.sha256(small_gif).hexdigest()
+        self.assertTrue(Post.objects.filter(
+            author=self.user,
+            text='Тестовый пост 2',
+            group=None,
+            image=f'posts/{digest[:2]}/{digest[2:4]}/{digest}.gif',
+        ).exists())
+
+    @override_settings(POST_IMAGE_MAX_SIZE=1024)
+    def test_oversized_image_rejected(self):
+        """Слишком большой файл отбрасывается при приёме запроса"""
+        posts_count = Post.objects.count()
+        uploaded = SimpleUploadedFile('big.gif', b'GIF89a' + b'\0' * 4096,
+                                      content_type='image/gif')
+
+        response = self.authorized_user.post(
+            reverse('posts:post_create'),
+            data={'text': 'Большая картинка', 'image': uploaded},
+        )
+
+        self.assertEqual(Post.objects.count(), posts_count)
+        self.assertIn('Файл больше',
+                      response.context['form'].errors['image'][0])
+
+    @override_settings(POST_IMAGE_MAX_SIZE=1024)
+    def test_oversized_upload_stops_reading(self):
+        """Приём файла останавливается на пределе, CSRF проверяется"""
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        url = reverse('posts:post_create')
+        data = {'text': 'Большая картинка',
+                'image': SimpleUploadedFile('big.gif',
+                                            b'GIF89a' + b'\0' * 4096)}
+        self.assertTemplateUsed(client.post(url, data), 'core/403csrf.html')
+
+        # Поля идут в порядке формы: токен раньше картинки.
+        client.get(url)
+        data = {'csrfmiddlewaretoken': client.cookies['csrftoken'].value,
+                **data}
+        data['image'].seek(0)
+        with mock.patch(
+                'django.core.files.uploadhandler.MemoryFileUploadHandler.'
+                'receive_data_chunk') as receive:
+            response = client.post(url, data)
+        receive.assert_not_called()
+        self.assertIn('Файл больше',
+                      response.context['form'].errors['image'][0])
+
+    @override_settings(POST_IMAGE_MAX_SIZE=1024)
+    def test_rejected_upload_before_other_fields(self):
+        """Отказ виден, даже если файл идёт в запросе первым"""
+        data = encode_multipart(BOUNDARY, {
+            'image': SimpleUploadedFile('big.gif',
+                                        b'GIF89a' + b'\0' * 4096),
+            'text': 'Большая картинка',
+        })
+        for url in (reverse('posts:post_create'),
+                    reverse('posts:post_edit',
+                            kwargs={'post_id': self.post.pk})):
+            with self.subTest(url=url):
+                response = self.authorized_user.generic(
+                    'POST', url, data, content_type=MULTIPART_CONTENT)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Файл больше',
+                              response.context['form'].errors['image'][0])
+
+    def test_image_bomb_rejected_by_header(self):
+        """Картинка с огромными размерами отбрасывается по заголовку,
+        без раскодирования
+        """
+        posts_count = Post.objects.count()
+        header = struct.pack('>IIBBBBB', 50000, 50000, 8, 2, 0, 0, 0)
+        png = (b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(header))
+               + b'IHDR' + header
+               + struct.pack('>I', zlib.crc32(b'IHDR' + header)))
+        # Сами пиксели не дойдут до Pillow: хватит начала блока IDAT.
+        png += struct.pack('>I', 1024) + b'IDAT' + b'\0' * 1024
+        uploaded = SimpleUploadedFile('bomb.png', png,
+                                      content_type='image/png')
+
+        with mock.patch.object(ImageFile.ImageFile, 'load') as load:
+            response = self.authorized_user.post(
+                reverse('posts:post_create'),
+                data={'text': 'Бомба', 'image': uploaded},
+            )
+
+        load.assert_not_called()
+        self.assertEqual(Post.objects.count(), posts_count)
+        self.assertIn('мегапикселей',
+                      response.context['form'].errors['image'][0])
 
     def test_edit_post(self):
         """Тест редактирования поста с последующим его измненением в БД"""
@@ -1,6 +1,32 @@
-from django.test import TestCase
-
-from ..models import Group, Post, Comment, User, FIRST_FIFTEEN_SYMBOLS
+from io import StringIO
+import shutil
+import tempfile
+from unittest import mock
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+
+from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile
+
+from .. import media, thumbnails
+from ..models import (AuthorStats, Group, MediaFile, Post, Comment, Follow,
+                      User, FIRST_FIFTEEN_SYMBOLS)
+
+TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
+SMALL_GIF = (
+    b'\x47\x49\x46\x38\x39\x61\x02\x00'
+    b'\x01\x00\x80\x00\x00\x00\x00\x00'
+    b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+    b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+    b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+    b'\x0A\x00\x3B'
+)
 
 
 class PostModelTest(TestCase):
@@ -88,3 +114,134 @@ class CommentModelTest(TestCase):
                          'Введите комментарий')
         self.assertEqual(comment._meta.get_field('text').verbose_name,
                          'Текст комментария')
+
+
+class CountersTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(username='author')
+        self.reader = User.objects.create_user(username='reader')
+
+    def assertStats(self, user, posts, followers, following):
+        stats = AuthorStats.objects.get(user=user)
+        self.assertEqual(
+            (stats.posts_count, stats.followers_count, stats.following_count),
+            (posts, followers, following))
+
+    def test_counters_follow_writes(self):
+        """Счётчики меняются вместе с постами, комментариями и подписками"""
+        post = Post.objects.create(author=self.author, text='Пост')
+        Comment.objects.create(post=post, author=self.reader, text='Текст')
+        follow = Follow.objects.create(user=self.reader, author=self.author)
+
+        self.assertStats(self.author, 1, 1, 0)
+        self.assertStats(self.reader, 0, 0, 1)
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 1)
+
+        follow.delete()
+        post.comments.all().delete()
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 0)
+        post.delete()
+        self.assertStats(self.author, 0, 0, 0)
+        self.assertStats(self.reader, 0, 0, 0)
+
+    def test_reconcile_counters_command(self):
+        """Команда reconcile_counters исправляет расхождения"""
+        post = Post.objects.create(author=self.author, text='Пост')
+        Comment.objects.create(post=post, author=self.reader, text='Текст')
+        Follow.objects.create(user=self.reader, author=self.author)
+        AuthorStats.objects.filter(user=self.author).update(posts_count=7)
+        AuthorStats.objects.filter(user=self.reader).delete()
+        Post.objects.update(comments_count=0)
+
+        call_command('reconcile_counters', stdout=StringIO())
+
+        self.assertStats(self.author, 1, 1, 0)
+        self.assertStats(self.reader, 0, 0, 1)
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 1)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, POST_THUMBNAIL_WORKERS=0)
+@mock.patch.object(transaction, 'on_commit', lambda func: func())
+class MediaStorageTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(username='author')
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def create_post(self, filename):
+        return Post.objects.create(
+            author=self.author, text='Пост',
+            image=SimpleUploadedFile(filename, SMALL_GIF))
+
+    def test_identical_uploads_share_one_file(self):
+        """Одинаковые загрузки хранятся одним файлом со счётчиком ссылок"""
+        first = self.create_post('first.gif')
+        second = self.create_post('second.GIF')
+        name = first.image.name
+        self.assertEqual(second.image.name, name)
+        self.assertRegex(name, r'^posts/(..)/(..)/\1\2[0-9a-f]{60}\.gif$')
+        self.assertEqual(MediaFile.objects.get(name=name).references, 2)
+
+        first.delete()
+        second.delete()
+        self.assertEqual(MediaFile.objects.get(name=name).references, 0)
+        # Файл без ссылок удаляет только collect_media, и свежий
+        # файл он не трогает: его могла вернуть такая же загрузка.
+        call_command('collect_media', stdout=StringIO())
+        self.assertTrue(media.storage().exists(name))
+        call_command('collect_media', min_age=0, stdout=StringIO())
+        self.assertFalse(media.storage().exists(name))
+        self.assertFalse(MediaFile.objects.filter(name=name).exists())
+
+    def test_migrate_media_command(self):
+        """Старые файлы переносятся в хранилище по содержимому"""
+        legacy = default_storage.save('posts/legacy.gif',
+                                      ContentFile(SMALL_GIF))
+        posts = [Post.objects.create(author=self.author, text='Пост',
+                                     image=legacy) for _ in range(2)]
+        shared = self.create_post('new.gif')
+
+        call_command('migrate_media', batch_size=1, stdout=StringIO())
+
+        for post in posts:
+            post.refresh_from_db()
+            self.assertEqual(post.image.name, shared.image.name)
+        self.assertFalse(default_storage.exists(legacy))
+        self.assertFalse(MediaFile.objects.filter(name=legacy).exists())
+        self.assertEqual(
+            MediaFile.objects.get(name=shared.image.name).references, 3)
+
+    def test_collect_media_command(self):
+        """Брошенные картинки, их миниатюры и записи KV удаляются"""
+        live = self.create_post('live.gif')
+        orphan = Post.objects.create(
+            author=self.author, text='Пост',
+            image=SimpleUploadedFile('old.gif', SMALL_GIF + b'\0'))
+        name = orphan.image.name
+        # Обновление в обход сигналов оставляет файл без ссылок.
+        Post.objects.filter(pk=orphan.pk).update(image='')
+        geometry, options = settings.POST_THUMBNAILS['card']
+        thumbnail = thumbnails.backend.thumbnail_file(
+            ImageFile(name, media.storage()), geometry, **options)
+        self.assertTrue(thumbnail.exists())
+
+        output = StringIO()
+        call_command('collect_media', dry_run=True, min_age=0,
+                     stdout=output)
+        self.assertIn('картинок 1', output.getvalue())
+        self.assertTrue(media.storage().exists(name))
+
+        call_command('collect_media', min_age=0, stdout=StringIO())
+        self.assertFalse(media.storage().exists(name))
+        self.assertFalse(thumbnail.exists())
+        self.assertIsNone(default.kvstore.get(thumbnail))
+        self.assertTrue(media.storage().exists(live.image.name))
+        self.assertIsNotNone(default.kvstore.get(
+            thumbnails.backend.thumbnail_file(live.image, geometry,
+                                              **options)))
@@ -0,0 +1,176 @@
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from .. import shards
+from ..models import AuthorShard, Comment, Follow, MovedPost, Post, User
+
+SHARD = 'shard'
+
+
+@override_settings(POST_SHARDS=('default', SHARD))
+@mock.patch.object(transaction, 'on_commit', lambda func: func())
+class ShardsTest(TestCase):
+    databases = {'default', SHARD}
+
+    def setUp(self):
+        cache.clear()
+        for database in ('default', SHARD):
+            shards.reserve_ids(database)
+        self.left = User.objects.create_user(username='left')
+        self.right = User.objects.create_user(username='right')
+        self.reader = User.objects.create_user(username='reader')
+        AuthorShard.objects.create(author=self.left, database='default')
+        AuthorShard.objects.create(author=self.right, database=SHARD)
+        self.posts = []
+        for number in range(6):
+            author = (self.left, self.right)[number % 2]
+            self.posts.append(Post.objects.create(
+                author=author, text=f'Пост {number}'))
+        self.client.force_login(self.reader)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_posts_stored_on_author_shard(self):
+        """Посты и комментарии лежат на шарде автора поста"""
+        post = self.posts[1]
+        self.assertEqual(post._state.db, SHARD)
+        self.assertEqual(shards.home(post.pk), SHARD)
+        self.assertFalse(Post.objects.using('default').filter(
+            author=self.right).exists())
+        self.client.post(reverse('posts:add_comment', args=(post.pk,)),
+                         {'text': 'Комментарий'})
+        comment = Comment.objects.using(SHARD).get()
+        self.assertEqual(comment.post_id, post.pk)
+        self.assertEqual(shards.home(comment.pk), SHARD)
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 1)
+
+    def test_writes_ignore_stale_directory_cache(self):
+        """Новый пост ложится на шард из AuthorShard, даже если кеш
+        процесса ещё помнит старый"""
+        cache.set(shards._author_key(self.left.pk), SHARD)
+        post = Post.objects.create(author=self.left, text='Новый')
+        self.assertEqual(post._state.db, 'default')
+        self.assertTrue(Post.objects.using('default').filter(
+            pk=post.pk).exists())
+
+    def test_post_pages_hit_one_shard(self):
+        """Профиль и страница поста не ходят на чужой шард"""
+        post = self.posts[0]
+        for url in (reverse('posts:profile', args=('left',)),
+                    reverse('posts:post_detail', args=(post.pk,))):
+            with self.subTest(url=url):
+                with self.assertNumQueries(0, using=SHARD):
+                    response = self.client.get(url)
+                self.assertContains(response, post.text)
+        response = self.client.get(
+            reverse('posts:profile', args=('right',)))
+        self.assertEqual(
+            [card.pk for card in response.context['page_obj']],
+            [post.pk for post in reversed(self.posts[1::2])])
+
+    def test_index_merges_shards(self):
+        """Главная сливает посты шардов по дате и листается курсором"""
+        expected = [post.pk for post in reversed(self.posts)]
+        with self.settings(COUNT_POSTS=4):
+            response = self.client.get(reverse('posts:index'))
+            first = [post.pk for post in response.context['page_obj']]
+            token = response.context['page_obj'].paginator.next_token
+            response = self.client.get(reverse('posts:index'),
+                                       {'after': token})
+            second = [post.pk for post in response.context['page_obj']]
+        self.assertEqual(first + second, expected)
+        self.assertEqual(response.context['page_obj'].paginator.count, 6)
+
+    def test_follow_index_reads_shards(self):
+        """Лента подписок собирает посты с разных шардов"""
+        Follow.objects.create(user=self.reader, author=self.left)
+        Follow.objects.create(user=self.reader, author=self.right)
+        response = self.client.get(reverse('posts:follow_index'))
+        self.assertEqual([post.pk for post in response.context['page_obj']],
+                         [post.pk for post in reversed(self.posts)])
+
+    def test_search_reads_every_shard(self):
+        """Поиск находит посты всех шардов и листается курсором"""
+        found = []
+        after = ''
+        with self.settings(COUNT_POSTS=4):
+            while True:
+                page = self.client.get(reverse('posts:search'), {
+                    'q': 'пост', 'after': after}).context['page']
+                found += [result.post.pk for result in page.results]
+                after = page.next_token
+                if not after:
+                    break
+        self.assertCountEqual(found, [post.pk for post in self.posts])
+
+    def test_rebalance_moves_author(self):
+        """Перенос автора сохраняет посты, комментарии и их адреса"""
+        post = self.posts[0]
+        Comment.objects.create(post=post, author=self.reader, text='Ответ')
+        call_command('rebalance_shards', author=[self.left.pk], to=SHARD,
+                     pause=0, stdout=StringIO())
+        self.assertFalse(Post.objects.using('default').exists())
+        self.assertEqual(Post.objects.using(SHARD).count(), 6)
+        self.assertEqual(Comment.objects.using(SHARD).get().post_id, post.pk)
+        self.assertEqual(Post.objects.using(SHARD).get(pk=post.pk).pub_date,
+                         post.pub_date)
+        self.assertTrue(MovedPost.objects.filter(post_id=post.pk).exists())
+        self.assertEqual(shards.for_post(post.pk), SHARD)
+        response = self.client.get(
+            reverse('posts:post_detail', args=(post.pk,)))
+        self.assertContains(response, 'Ответ')
+        # Чужие id на шарде не сдвигают его счётчик.
+        new_post = Post.objects.create(author=self.left, text='Новый')
+        self.assertEqual(new_post._state.db, SHARD)
+        self.assertEqual(shards.home(new_post.pk), SHARD)
+
+    def test_rebalance_keeps_writes_made_while_copying(self):
+        """Комментарий, написанный в старый шард во время копирования,
+        переезжает вместе с постом"""
+        post = self.posts[0]
+
+        def write(seconds):
+            if not Comment.objects.using('default').exists():
+                Comment.objects.create(post=post, author=self.reader,
+                                       text='Во время переноса')
+
+        with mock.patch.object(shards.time, 'sleep', write):
+            moved, left = shards.move_author(self.left.pk, SHARD, 1)
+        self.assertEqual((moved, left), (3, 0))
+        self.assertFalse(Comment.objects.using('default').exists())
+        self.assertEqual(Comment.objects.using(SHARD).get().post_id, post.pk)
+        self.assertEqual(
+            Post.objects.using(SHARD).get(pk=post.pk).comments_count, 1)
+        self.assertFalse(AuthorShard.objects.get(author=self.left).moving)
+
+    def test_writes_refused_while_author_moves(self):
+        """Пока автор переносится, его посты и комментарии не пишутся"""
+        AuthorShard.objects.filter(author=self.left).update(moving=True)
+        with self.assertRaises(shards.AuthorMoving):
+            Post.objects.create(author=self.left, text='Новый')
+        with self.assertRaises(shards.AuthorMoving):
+            Comment.objects.create(post=self.posts[0], author=self.reader,
+                                   text='Ответ')
+        Comment.objects.create(post=self.posts[1], author=self.reader,
+                               text='Ответ')
+
+    def test_rebalance_plan(self):
+        """Без --author перенос выравнивает число постов на шардах"""
+        for number in range(4):
+            Post.objects.create(author=self.reader, text=f'Ещё {number}')
+        before = {database: Post.objects.using(database).count()
+                  for database in ('default', SHARD)}
+        call_command('rebalance_shards', pause=0, stdout=StringIO())
+        after = {database: Post.objects.using(database).count()
+                 for database in ('default', SHARD)}
+        self.assertEqual(sum(after.values()), sum(before.values()))
+        self.assertLess(abs(after['default'] - after[SHARD]),
+                        abs(before['default'] - before[SHARD]))
@@ -1,15 +1,27 @@
+from base64 import b64decode
+from io import BytesIO, StringIO
 from math import ceil
+import os
 import shutil
 import tempfile
+from unittest import mock
 
 from django.core.cache import cache
-from django.test import Client, TestCase, override_settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import (Client, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from django import forms
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.conf import settings
+from PIL import Image, ImageFile
 
-from ..models import Group, Post, User, Comment, Follow
+from .. import feed_cache, resize, thumbnails
+from ..models import Group, Post, User, Comment, Follow, TimelineEntry
+from ..paginators import encode_cursor
 
 LIMIT_POSTS_FOR_PAGE = 10
 COUNT_POSTS_FIRST_PAGE = 10
@@ -18,12 +30,19 @@ POST_NUMBER_1 = 0
 PAGE_NUMBER_2 = str(ceil((COUNT_POSTS_FIRST_PAGE
                           + COUNT_POSTS_SECOND_PAGE) / LIMIT_POSTS_FOR_PAGE))
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
+SMALL_GIF = (
+    b'\x47\x49\x46\x38\x39\x61\x02\x00'
+    b'\x01\x00\x80\x00\x00\x00\x00\x00'
+    b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+    b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+    b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+    b'\x0A\x00\x3B'
+)
 
 
 @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class PostsPagesTests(TestCase):
     def setUp(self):
-        super().setUpClass()
         self.user_1 = User.objects.create_user(username='firstuser')
         self.authorized_user_1 = Client()
         self.authorized_user_1.force_login(self.user_1)
@@ -293,10 +312,113 @@ class PaginatorViewsTest(TestCase):
         self.assertEqual(len(response.context['page_obj']),
                          COUNT_POSTS_SECOND_PAGE)
 
+    def test_paginator_cursor_navigation(self):
+        """Переход по курсорам ?after=/?before= между страницами"""
+        response = self.authorized_client_author.get(reverse('posts:index'))
+        first_page = response.context['page_obj']
+        response = self.authorized_client_author.get(
+            reverse('posts:index')
+            + f'?after={first_page.paginator.next_token}')
+        second_page = response.context['page_obj']
+        self.assertEqual(len(second_page), COUNT_POSTS_SECOND_PAGE)
+        self.assertEqual(second_page.number, 2)
+        self.assertFalse(second_page.has_next())
+
+        response = self.authorized_client_author.get(
+            reverse('posts:index')
+            + f'?before={second_page.paginator.previous_token}')
+        self.assertEqual(list(response.context['page_obj']),
+                         list(first_page))
+
+    def test_paginator_cursor_same_pub_date(self):
+        """Посты с одинаковой датой не теряются и не дублируются"""
+        Post.objects.update(pub_date=self.post.pub_date)
+        seen = []
+        url = reverse('posts:index')
+        while True:
+            page_obj = self.authorized_client_author.get(
+                url).context['page_obj']
+            seen.extend(post.pk for post in page_obj)
+            if not page_obj.has_next():
+                break
+            url = (reverse('posts:index')
+                   + f'?after={page_obj.paginator.next_token}')
+        self.assertEqual(sorted(seen),
+                         sorted(Post.objects.values_list('pk', flat=True)))
+
+    def test_paginator_last_page(self):
+        """Ссылка на последнюю страницу и битый курсор"""
+        response = self.authorized_client_author.get(
+            reverse('posts:index') + '?before=last')
+        self.assertEqual(len(response.context['page_obj']),
+                         COUNT_POSTS_SECOND_PAGE)
+        response = self.authorized_client_author.get(
+            reverse('posts:index') + '?after=broken')
+        self.assertEqual(response.context['page_obj'].number, 1)
+
+    @override_settings(COUNT_POSTS=2, PAGINATOR_WINDOW=1)
+    def test_paginator_windowed_page_range(self):
+        """Пагинатор выводит окно номеров вместо всех страниц"""
+        cache.clear()
+        response = self.authorized_client_author.get(
+            f'/group/{self.group.slug}/')
+        page_links = response.context['page_obj'].paginator.page_links
+        self.assertEqual([number for number, link in page_links],
+                         [1, 2, None, 7])
+
+        next_link = page_links[1][1]
+        response = self.authorized_client_author.get(
+            f'/group/{self.group.slug}/{next_link}')
+        page_links = response.context['page_obj'].paginator.page_links
+        self.assertEqual([number for number, link in page_links],
+                         [1, 2, 3, None, 7])
+
+    def test_paginator_uses_cached_count(self):
+        """Повторный запрос ленты не выполняет COUNT(*)"""
+        cache.clear()
+        self.authorized_client_author.get(reverse('posts:index'))
+        with CaptureQueriesContext(connection) as queries:
+            self.authorized_client_author.get(
+                reverse('posts:index') + '?before=last')
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'COUNT(' in query['sql']])
+
+        Post.objects.create(author=self.user_author, text='Новый пост')
+        response = self.authorized_client_author.get(
+            reverse('posts:index') + '?before=last')
+        self.assertEqual(response.context['page_obj'].paginator.count,
+                         COUNT_POSTS_FIRST_PAGE + COUNT_POSTS_SECOND_PAGE + 1)
+
+    def test_post_writes_reset_affected_counts(self):
+        """Перенос поста в другую группу и новый пост сбрасывают
+        число постов старой группы и лент подписчиков"""
+        cache.clear()
+        other = Group.objects.create(title='Другая', slug='other',
+                                     description='Описание')
+        reader = User.objects.create_user(username='reader')
+        Follow.objects.create(user=reader, author=self.user_author)
+        reader_client = Client()
+        reader_client.force_login(reader)
+        group_url = reverse('posts:group_list', args=(self.group.slug,))
+        follow_url = reverse('posts:follow_index')
+        total = COUNT_POSTS_FIRST_PAGE + COUNT_POSTS_SECOND_PAGE
+        for url in (group_url, follow_url):
+            reader_client.get(url)
+
+        self.post.group = other
+        self.post.save()
+        response = reader_client.get(group_url)
+        self.assertEqual(response.context['page_obj'].paginator.count,
+                         total - 1)
+
+        Post.objects.create(author=self.user_author, text='Новый пост')
+        response = reader_client.get(follow_url)
+        self.assertEqual(response.context['page_obj'].paginator.count,
+                         total + 1)
+
 
 class CachesTest(TestCase):
     def setUp(self):
-        super().setUpClass()
         self.user_1 = User.objects.create_user(username='user_1')
         self.authorized_user_1 = Client()
         self.authorized_user_1.force_login(self.user_1)
@@ -309,17 +431,118 @@ class CachesTest(TestCase):
     def test_caches_index(self):
         """Тестируем кеширование на главной странице"""
         response = self.authorized_user_1.get(reverse('posts:index'))
-        Post.objects.filter(pk=self.post.pk).delete()
+        # update() не шлёт сигналов, поэтому страница берётся из кеша
+        Post.objects.filter(pk=self.post.pk).update(text='Изменённый')
         response_2 = self.authorized_user_1.get(reverse('posts:index'))
         self.assertEqual(response.content, response_2.content)
         cache.clear()
         response_2 = self.authorized_user_1.get(reverse('posts:index'))
         self.assertNotEqual(response.content, response_2.content)
 
+    def test_post_card_shared_between_feeds(self):
+        """Карточка поста берётся из кеша в любой ленте"""
+        author = User.objects.create_user(username='author')
+        post = Post.objects.create(author=author, text='Пост автора')
+        Follow.objects.create(user=self.user_1, author=author)
+        cache.clear()
+        self.authorized_user_1.get(reverse('posts:index'))
+        # Без сигналов Post.updated не меняется: ключ карточки прежний
+        Post.objects.filter(pk=post.pk).update(text='Изменённый')
+        response = self.authorized_user_1.get(reverse('posts:follow_index'))
+        self.assertContains(response, 'Пост автора')
+
+        post.refresh_from_db()
+        post.save()
+        response = self.authorized_user_1.get(reverse('posts:follow_index'))
+        self.assertContains(response, 'Изменённый')
+
+    def test_author_rename_resets_only_author_feeds(self):
+        """Смена имени автора сбрасывает его ленты, а вход - ничего"""
+        group = Group.objects.create(title='Группа', slug='group',
+                                     description='Описание')
+        other = Group.objects.create(title='Другая', slug='other',
+                                     description='Описание')
+        Post.objects.filter(pk=self.post.pk).update(group=group)
+        urls = (
+            reverse('posts:index'),
+            reverse('posts:group_list', kwargs={'slug': group.slug}),
+            reverse('posts:profile',
+                    kwargs={'username': self.user_1.username}),
+        )
+        scopes = ('index', feed_cache.scope('group', group.pk),
+                  feed_cache.scope('author', self.user_1.pk))
+        versions = feed_cache.version(*scopes)
+        self.user_1.last_login = timezone.now()
+        self.user_1.save()
+        self.assertEqual(feed_cache.version(*scopes), versions)
+
+        for url in urls:
+            self.authorized_user_1.get(url)
+        other_version = feed_cache.version(
+            feed_cache.scope('group', other.pk))
+        self.user_1.first_name = 'Переименованный'
+        self.user_1.save()
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertContains(self.authorized_user_1.get(url),
+                                    'Переименованный')
+        self.assertEqual(
+            feed_cache.version(feed_cache.scope('group', other.pk)),
+            other_version)
+
+    def test_group_edit_resets_global_feeds_only_on_slug_change(self):
+        """Правка описания группы сбрасывает только её страницу"""
+        group = Group.objects.create(title='Группа', slug='group',
+                                     description='Описание')
+        Post.objects.filter(pk=self.post.pk).update(group=group)
+        updated = Post.objects.get(pk=self.post.pk).updated
+        group_scope = feed_cache.scope('group', group.pk)
+        global_versions = feed_cache.version('index', feed_cache.GLOBAL_SCOPE)
+        group_version = feed_cache.version(group_scope)
+        group.description = 'Новое описание'
+        group.save()
+        self.assertEqual(
+            feed_cache.version('index', feed_cache.GLOBAL_SCOPE),
+            global_versions)
+        self.assertNotEqual(feed_cache.version(group_scope), group_version)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).updated, updated)
+
+        self.authorized_user_1.get(reverse('posts:index'))
+        group.slug = 'renamed'
+        group.save()
+        response = self.authorized_user_1.get(reverse('posts:index'))
+        self.assertContains(response, reverse(
+            'posts:group_list', kwargs={'slug': 'renamed'}))
+
+    def test_feed_caches_reset_on_post_write(self):
+        """Кеш лент сбрасывается сразу после записи поста"""
+        group = Group.objects.create(title='Группа', slug='group',
+                                     description='Описание')
+        urls = (
+            reverse('posts:index'),
+            reverse('posts:group_list', kwargs={'slug': group.slug}),
+            reverse('posts:profile',
+                    kwargs={'username': self.user_1.username}),
+        )
+        for url in urls:
+            self.authorized_user_1.get(url)
+        self.post.text = 'Отредактированный пост'
+        self.post.group = group
+        self.post.save()
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.authorized_user_1.get(url)
+                self.assertContains(response, 'Отредактированный пост')
+
+        self.post.delete()
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.authorized_user_1.get(url)
+                self.assertNotContains(response, 'Отредактированный пост')
+
 
 class FollowingTest(TestCase):
     def setUp(self):
-        super().setUpClass()
         # follower
         self.user_1 = User.objects.create_user(username='user_1')
         self.authorized_user_1 = Client()
@@ -378,3 +601,596 @@ class FollowingTest(TestCase):
 
         self.assertNotEqual(len_objects_unf, Post.objects.filter(
             author=self.user_2).count())
+
+    def test_timeline_backfill_and_purge(self):
+        """Посты автора попадают в ленту при подписке и уходят при отписке"""
+        post = Post.objects.create(author=self.user_2, text='Старый пост')
+        self.authorized_user_1.get(reverse(
+            'posts:profile_follow', kwargs={'username': self.user_2.username}))
+        response = self.authorized_user_1.get(reverse('posts:follow_index'))
+        self.assertEqual(list(response.context['page_obj']), [post])
+
+        self.authorized_user_1.get(reverse(
+            'posts:profile_unfollow',
+            kwargs={'username': self.user_2.username}))
+        self.assertFalse(TimelineEntry.objects.filter(
+            user=self.user_1).exists())
+
+    def test_rebuild_timelines_command(self):
+        """Команда rebuild_timelines восстанавливает ленты по подпискам"""
+        Follow.objects.create(user=self.user_1, author=self.user_2)
+        Follow.objects.create(user=self.user_3, author=self.user_2)
+        Post.objects.create(author=self.user_2, text='Тестовый пост')
+        TimelineEntry.objects.all().delete()
+
+        call_command('rebuild_timelines', stdout=StringIO())
+
+        self.assertEqual(TimelineEntry.objects.filter(
+            post__author=self.user_2).count(), 2)
+
+    @override_settings(TIMELINE_CELEBRITY_FOLLOWERS=1)
+    def test_hybrid_timeline_merges_celebrity_posts(self):
+        """Посты популярного автора подмешиваются в ленту при чтении"""
+        cache.clear()
+        Follow.objects.create(user=self.user_1, author=self.user_2)
+        Follow.objects.create(user=self.user_3, author=self.user_2)
+        Follow.objects.create(user=self.user_1, author=self.user_3)
+        call_command('refresh_celebrities', stdout=StringIO())
+        with CaptureQueriesContext(connection) as queries:
+            celebrity_post = Post.objects.create(author=self.user_2,
+                                                 text='Пост знаменитости')
+        # Запись не перебирает подписчиков популярного автора.
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'posts_follow' in query['sql']])
+        regular_post = Post.objects.create(author=self.user_3,
+                                           text='Обычный пост')
+
+        self.assertFalse(TimelineEntry.objects.filter(
+            post=celebrity_post).exists())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.authorized_user_1.get(
+                reverse('posts:follow_index'))
+        self.assertEqual(list(response.context['page_obj']),
+                         [regular_post, celebrity_post])
+        self.assertEqual(response.context['page_obj'].paginator.count, 2)
+        # Список «знаменитостей» не пересчитывается при чтении ленты.
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'GROUP BY' in query['sql']])
+
+    @override_settings(TIMELINE_CELEBRITY_FOLLOWERS=1)
+    def test_refresh_celebrities_fixes_timelines(self):
+        """Пересчёт «знаменитостей» убирает и возвращает их посты в ленты"""
+        Follow.objects.create(user=self.user_1, author=self.user_2)
+        post = Post.objects.create(author=self.user_2, text='Пост')
+        Follow.objects.create(user=self.user_3, author=self.user_2)
+        self.assertTrue(TimelineEntry.objects.filter(post=post).exists())
+
+        call_command('refresh_celebrities', stdout=StringIO())
+        self.assertFalse(TimelineEntry.objects.filter(post=post).exists())
+
+        Follow.objects.filter(user=self.user_3).delete()
+        call_command('refresh_celebrities', stdout=StringIO())
+        self.assertEqual(TimelineEntry.objects.filter(post=post).count(), 1)
+
+
+class FeedQueriesTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create_user(username='author',
+                                              first_name='Имя',
+                                              last_name='Фамилия')
+        cls.follower = User.objects.create_user(username='follower')
+        cls.group = Group.objects.create(
+            title='Тестовая группа',
+            slug='test-slug',
+            description='Тестовое описание',
+        )
+        Follow.objects.create(user=cls.follower, author=cls.author)
+
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(self.follower)
+
+    def create_posts(self, count):
+        for i in range(count):
+            Post.objects.create(author=self.author, group=self.group,
+                                text=f'Пост №{i}')
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        return len(queries)
+
+    def test_feeds_run_fixed_number_of_queries(self):
+        """Число запросов ленты не зависит от числа карточек"""
+        urls = (
+            reverse('posts:index'),
+            reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+            reverse('posts:profile',
+                    kwargs={'username': self.author.username}),
+            reverse('posts:follow_index'),
+        )
+        self.create_posts(2)
+        few_posts = [self.count_queries(url) for url in urls]
+        self.create_posts(5)
+        many_posts = [self.count_queries(url) for url in urls]
+        self.assertEqual(few_posts, many_posts)
+
+
+class AnonymousPageCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='author')
+        self.post = Post.objects.create(author=self.author, text='Пост')
+        self.url = reverse('posts:post_detail',
+                           kwargs={'post_id': self.post.pk})
+        self.authorized_client = Client()
+        self.authorized_client.force_login(self.author)
+
+    def test_anonymous_page_cached_until_purged(self):
+        """Страница для анонима берётся из кеша до записи по её тегу"""
+        self.client.get(self.url)
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+
+        Post.objects.filter(pk=self.post.pk).update(text='Без сигнала')
+        self.assertNotContains(self.client.get(self.url), 'Без сигнала')
+
+        Comment.objects.create(post=self.post, author=self.author,
+                               text='Новый комментарий')
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('X-Page-Cache'))
+        self.assertContains(response, 'Новый комментарий')
+
+    def test_write_during_render_purges_page(self):
+        """Запись во время отрисовки не оставляет в кеше страницу без неё"""
+        from .. import views
+
+        def render(*args, **kwargs):
+            response = real_render(*args, **kwargs)
+            Comment.objects.create(post=self.post, author=self.author,
+                                   text='Новый комментарий')
+            return response
+
+        real_render = views.render
+        with mock.patch.object(views, 'render', render):
+            self.client.get(self.url)
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('X-Page-Cache'))
+        self.assertContains(response, 'Новый комментарий')
+
+    def test_authorized_user_never_gets_cached_page(self):
+        """Вошедший пользователь не получает страницу из кеша"""
+        self.client.get(self.url)
+        self.client.get(self.url)
+        response = self.authorized_client.get(self.url)
+        self.assertFalse(response.has_header('X-Page-Cache'))
+        self.assertContains(response, 'Пользователь: author')
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='author')
+        self.post = Post.objects.create(author=self.author, text='Пост')
+        self.authorized_client = Client()
+        self.authorized_client.force_login(self.author)
+
+    def test_unchanged_page_returns_not_modified(self):
+        """Неизменная страница отдаётся как 304 без запросов ленты"""
+        # Сессия и пользователь, плюс поиск тега страницы по URL.
+        urls = (
+            (reverse('posts:index'), 2),
+            (reverse('posts:profile', kwargs={'username': 'author'}), 3),
+            (reverse('posts:post_detail',
+                     kwargs={'post_id': self.post.pk}), 3),
+        )
+        for url, queries in urls:
+            with self.subTest(url=url):
+                etag = self.authorized_client.get(url)['ETag']
+                with self.assertNumQueries(queries):
+                    response = self.authorized_client.get(
+                        url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+
+    def test_write_changes_validators(self):
+        """Запись по тегу страницы меняет ETag"""
+        url = reverse('posts:post_detail', kwargs={'post_id': self.post.pk})
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        Comment.objects.create(post=self.post, author=self.author,
+                               text='Комментарий')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertNotEqual(
+            self.authorized_client.get(url)['ETag'], response['ETag'])
+
+
+class PostImageSizeTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+    def test_size_stored_on_upload_and_placeholder_in_pool(self):
+        """Размеры картинки читаются при загрузке, заглушку делает пул"""
+        photo = BytesIO()
+        Image.new('RGB', (640, 480), (255, 0, 0)).save(photo, 'JPEG')
+        with mock.patch.object(thumbnails, 'schedule'), \
+                mock.patch.object(ImageFile.ImageFile, 'load') as load:
+            post = Post.objects.create(
+                author=User.objects.create_user(username='author'),
+                text='Пост', image=SimpleUploadedFile('photo.jpg',
+                                                      photo.getvalue()))
+        load.assert_not_called()
+        post.refresh_from_db()
+        self.assertEqual((post.image_width, post.image_height), (640, 480))
+        self.assertEqual(post.image_placeholder, '')
+
+        thumbnails.schedule(post)
+        post.refresh_from_db()
+        prefix = 'data:image/jpeg;base64,'
+        self.assertTrue(post.image_placeholder.startswith(prefix))
+        placeholder = Image.open(BytesIO(
+            b64decode(post.image_placeholder[len(prefix):])))
+        self.assertEqual(placeholder.size, (thumbnails.PLACEHOLDER_SIZE, 12))
+
+        post.image = None
+        post.save()
+        self.assertIsNone(post.image_width)
+        self.assertEqual(post.image_placeholder, '')
+
+    def test_expected_thumbnail_size(self):
+        """Заглушка получает размер будущей миниатюры"""
+        options = {'crop': 'center', 'upscale': False}
+        cases = (
+            ((1920, 1080), (960, 339)),
+            ((400, 300), (400, 300)),
+            ((2000, 300), (960, 300)),
+        )
+        for source, expected in cases:
+            with self.subTest(source=source):
+                self.assertEqual(thumbnails.expected_size(
+                    960, 339, options, *source), expected)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, POST_THUMBNAIL_WORKERS=1)
+class ThumbnailPoolTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def test_thumbnails_generated_in_pool(self):
+        """Миниатюры готовит пул потоков со своим соединением с базой"""
+        post = Post.objects.create(
+            author=User.objects.create_user(username='author'),
+            text='Пост', image=SimpleUploadedFile('pool.gif', SMALL_GIF))
+        executor = thumbnails._executor
+        self.assertIsNotNone(executor)
+        thumbnails._executor = None
+        executor.shutdown(wait=True)
+        # Запись KV-хранилища берётся из базы, куда её записал поток.
+        cache.clear()
+        self.assertTrue(thumbnails.lookup(post.image, 'card').url)
+
+
+def gif(color):
+    image = BytesIO()
+    Image.new('RGB', (2, 1), (color, 0, 0)).save(image, 'GIF')
+    return image.getvalue()
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class ThumbnailsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='author')
+        self.authorized_client = Client()
+        self.authorized_client.force_login(self.author)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    @override_settings(POST_THUMBNAIL_WORKERS=0)
+    @mock.patch.object(transaction, 'on_commit', lambda func: func())
+    def test_thumbnails_generated_on_upload(self):
+        """Миниатюры готовятся при загрузке, лента их только выводит"""
+        self.authorized_client.post(reverse('posts:post_create'), data={
+            'text': 'Пост с картинкой',
+            'image': SimpleUploadedFile('upload.gif', SMALL_GIF,
+                                        content_type='image/gif'),
+        })
+        post = Post.objects.get()
+        thumbnail = thumbnails.lookup(post.image, 'card')
+        self.assertTrue(thumbnail.url)
+        self.assertContains(self.client.get(reverse('posts:index')),
+                            thumbnail.url)
+
+    def test_placeholder_until_thumbnail_ready(self):
+        """Пока миниатюры нет, выводится заглушка и карточка обновляется"""
+        photo = BytesIO()
+        Image.new('RGB', (1920, 1080), (0, 128, 255)).save(photo, 'JPEG')
+        # Очередь ещё не дошла до картинки.
+        with mock.patch.object(thumbnails, 'schedule') as schedule, \
+                mock.patch.object(transaction, 'on_commit',
+                                  lambda func: func()):
+            post = Post.objects.create(
+                author=self.author, text='Пост',
+                image=SimpleUploadedFile('raw.jpg', photo.getvalue()))
+        schedule.assert_called_once_with(post)
+        response = self.client.get(reverse('posts:index'))
+        self.assertNotContains(response, '<img class="card-img')
+        self.assertContains(response, 'aspect-ratio: 960 / 339')
+
+        with override_settings(POST_THUMBNAIL_WORKERS=0):
+            thumbnails.schedule(post)
+        response = self.client.get(reverse('posts:index'))
+        self.assertContains(
+            response, thumbnails.lookup(post.image, 'card').url)
+        self.assertContains(response, 'url(data:image/jpeg;base64,')
+
+    def test_placeholder_card_not_cached(self):
+        """Карточка с заглушкой не кешируется под новым Post.updated"""
+        with mock.patch.object(thumbnails, 'schedule'):
+            post = Post.objects.create(
+                author=self.author, text='Пост',
+                image=SimpleUploadedFile('edited.gif', SMALL_GIF))
+            # Пост изменили, пока миниатюры стояли в очереди.
+            post.text = 'Изменённый пост'
+            post.save()
+        self.client.get(reverse('posts:index'))
+        # Пул сбрасывает карточку по ключам, собранным до правки.
+        thumbnails._run(post.image.name, post.pk, post._state.db, [],
+                        feed_cache.post_scopes(post))
+        response = self.client.get(reverse('posts:index'))
+        self.assertContains(
+            response, thumbnails.lookup(post.image, 'card').url)
+
+    def test_feed_page_looks_up_thumbnails_in_one_query(self):
+        """Миниатюры всей страницы ищутся одним запросом к KV"""
+        with mock.patch.object(thumbnails, 'schedule'):
+            posts = [
+                Post.objects.create(
+                    author=self.author, text=f'Пост {i}',
+                    image=SimpleUploadedFile(f'page{i}.gif', gif(i)))
+                for i in range(3)
+            ]
+        for post in posts[1:]:
+            thumbnails.generate(post.image.name)
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('posts:index'))
+        kv_queries = [query for query in queries.captured_queries
+                      if 'thumbnail_kvstore' in query['sql']]
+        self.assertEqual(len(kv_queries), 1)
+        for post in posts[1:]:
+            self.assertContains(
+                response, thumbnails.lookup(post.image, 'card').url)
+        # Заглушка размером с будущую миниатюру картинки 2x1.
+        self.assertContains(response, 'aspect-ratio: 2 / 1', count=1)
+
+    @override_settings(POST_THUMBNAIL_WIDTHS=(480, 960),
+                       POST_THUMBNAIL_FORMATS={'WEBP': {'quality': 75}})
+    def test_responsive_variants(self):
+        """Картинка поста выводится в <picture> с вариантами srcset"""
+        photo = BytesIO()
+        Image.new('RGB', (1200, 800), (200, 100, 50)).save(photo, 'JPEG')
+        with mock.patch.object(thumbnails, 'schedule'):
+            post = Post.objects.create(
+                author=self.author, text='Пост',
+                image=SimpleUploadedFile('photo.jpg', photo.getvalue()))
+        thumbnails.generate(post.image.name)
+        picture = thumbnails.lookup(post.image, 'card')
+        self.assertEqual((picture.width, picture.height), (960, 339))
+        self.assertEqual(len(picture.srcset.split(', ')), 2)
+        (mime_type, srcset), = picture.sources
+        self.assertEqual(mime_type, 'image/webp')
+        self.assertRegex(srcset, r'\.webp 480w, .*\.webp 960w$')
+
+        response = self.client.get(
+            reverse('posts:post_detail', kwargs={'post_id': post.pk}))
+        self.assertContains(response, f'srcset="{srcset}"')
+        self.assertContains(response, f'src="{picture.url}"')
+
+
+RESIZE_CACHE_DIR = tempfile.mkdtemp(dir=settings.BASE_DIR)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT,
+                   RESIZE_CACHE_DIR=RESIZE_CACHE_DIR)
+class ResizedImageTest(TestCase):
+    def setUp(self):
+        resize._usage = None
+        image = BytesIO()
+        Image.new('RGB', (40, 20), (255, 0, 0)).save(image, 'PNG')
+        self.post = Post.objects.create(
+            author=User.objects.create_user(username='author'),
+            text='Пост с картинкой',
+            image=SimpleUploadedFile('wide.png', image.getvalue()))
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        shutil.rmtree(RESIZE_CACHE_DIR, ignore_errors=True)
+
+    def get(self, url):
+        response = self.client.get(url)
+        content = b''.join(response.streaming_content)
+        response.close()
+        return response, content
+
+    def test_resized_and_cached(self):
+        """Картинка вписывается в размер из ссылки и берётся из кеша"""
+        url = resize.url(self.post.image, 10, 10)
+        response, content = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(Image.open(BytesIO(content)).size, (10, 5))
+
+        with mock.patch.object(resize, '_render') as render:
+            self.assertEqual(self.get(url)[1], content)
+        render.assert_not_called()
+
+    def test_bad_signature(self):
+        """Ссылка с чужим размером или подписью не работает"""
+        url = resize.url(self.post.image, 10, 10)
+        for bad_url in (url.replace('/10x10/', '/20x20/'),
+                        url.replace('/r/', '/r/0')):
+            with self.subTest(url=bad_url):
+                self.assertEqual(self.client.get(bad_url).status_code, 404)
+
+    def test_lru_eviction(self):
+        """Кеш вытесняет файлы, которые дольше всего не читали"""
+        # Все три рамки дают одну и ту же картинку 10x5.
+        first = resize.cached(self.post.image.name, 10, 10)
+        size = os.path.getsize(first)
+        os.utime(first, (0, 0))
+        limit = int(size * 2 / resize.LOW_WATERMARK) + 1
+        with override_settings(RESIZE_CACHE_MAX_BYTES=limit):
+            second = resize.cached(self.post.image.name, 10, 11)
+            resize.cached(self.post.image.name, 10, 12)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(username='author')
+
+    def search(self, query, **params):
+        return self.client.get(reverse('posts:search'),
+                               {'q': query, **params})
+
+    def test_ranked_results_with_snippets(self):
+        """Поиск находит посты по словам и подсвечивает их"""
+        rare = Post.objects.create(author=self.author,
+                                   text='Котики <b>спят</b> весь день')
+        Post.objects.create(author=self.author, text='Собаки гуляют')
+        dense = Post.objects.create(author=self.author,
+                                    text='Котики, котики и снова котики')
+
+        response = self.search('котик')
+        results = response.context['page'].results
+        self.assertEqual([result.post for result in results], [dense, rare])
+        self.assertContains(response, '<mark>Котики</mark>')
+        self.assertContains(response, '&lt;b&gt;спят&lt;/b&gt;')
+
+    def test_index_follows_edits(self):
+        """Индекс обновляется при изменении и удалении постов"""
+        post = Post.objects.create(author=self.author, text='Старый текст')
+        post.text = 'Новый текст'
+        post.save()
+        self.assertFalse(self.search('старый').context['page'].results)
+        self.assertTrue(self.search('новый').context['page'].results)
+        post.delete()
+        self.assertFalse(self.search('новый').context['page'].results)
+
+    @override_settings(COUNT_POSTS=2)
+    def test_cursor_pagination(self):
+        """Страницы выдачи выбираются курсором без повторов"""
+        Post.objects.bulk_create(
+            Post(author=self.author, text=f'Пост номер {i}')
+            for i in range(5))
+        seen = []
+        after = ''
+        while True:
+            page = self.search('пост', after=after).context['page']
+            seen.extend(result.post.pk for result in page.results)
+            after = page.next_token
+            if not after:
+                break
+        self.assertEqual(sorted(seen),
+                         sorted(Post.objects.values_list('pk', flat=True)))
+
+    def test_admin_search_uses_index(self):
+        """Поиск в админке идёт по индексу, а не LIKE"""
+        admin = User.objects.create_superuser('admin', 'a@a.ru', 'pass')
+        self.client.force_login(admin)
+        posts = [Post.objects.create(author=self.author, text=text)
+                 for text in ('Морские ежи', 'Ежи в лесу')]
+        Post.objects.create(author=self.author, text='Ежевика')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('admin:posts_post_changelist'), {'q': 'ежи'})
+        self.assertEqual(list(response.context['cl'].result_list),
+                         posts[::-1])
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'LIKE' in query['sql']
+                          and 'posts_post' in query['sql']])
+
+
+class QueryPlanTest(TestCase):
+    """Запросы лент и комментариев идут по своим индексам."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author')
+        cls.reader = User.objects.create_user(username='reader')
+        cls.group = Group.objects.create(title='Группа', slug='group',
+                                         description='Описание')
+        Follow.objects.create(user=cls.reader, author=cls.author)
+        for i in range(15):
+            post = Post.objects.create(author=cls.author, group=cls.group,
+                                       text=f'Пост {i}')
+        Comment.objects.create(post=post, author=cls.reader, text='Ок')
+        cls.post = post
+
+    def setUp(self):
+        cache.clear()
+
+    def ordered_queries(self, client, url):
+        """Планы запросов страницы url, в которых есть ORDER BY."""
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        plans = {}
+        with connection.cursor() as cursor:
+            for query in queries.captured_queries:
+                sql = query['sql']
+                if sql.startswith('SELECT') and 'ORDER BY' in sql:
+                    cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                    plans[sql] = ' | '.join(
+                        row[-1] for row in cursor.fetchall())
+        return plans
+
+    def test_feeds_use_indexes_without_temp_sort(self):
+        """Ленты и комментарии не сортируются во временном B-дереве"""
+        reader = Client()
+        reader.force_login(self.reader)
+        cases = (
+            (self.client, reverse('posts:index'), 'post_pub_date'),
+            (self.client, reverse('posts:group_list', args=['group']),
+             'post_group_pub_date'),
+            (self.client, reverse('posts:profile', args=['author']),
+             'post_author_pub_date'),
+            (reader, reverse('posts:follow_index'),
+             'timeline_user_pub_date'),
+            (self.client, reverse('posts:post_detail', args=[self.post.pk]),
+             'comment_post_created'),
+        )
+        tenth = Post.objects.order_by('-pub_date', '-pk')[9]
+        after = f'?after={encode_cursor(tenth.pub_date, tenth.pk, 2)}'
+        for client, url, index in cases:
+            for page in ('', '?page=2', after):
+                with self.subTest(url=url + page):
+                    plans = self.ordered_queries(client, url + page)
+                    self.assertTrue(any(index in plan
+                                        for plan in plans.values()), plans)
+                    for sql, plan in plans.items():
+                        self.assertNotIn('TEMP B-TREE', plan, sql)
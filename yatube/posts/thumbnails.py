@@ -0,0 +1,404 @@
+"""Миниатюры картинок постов, подготовленные заранее.
+
+Все размеры из POST_THUMBNAILS готовятся после загрузки картинки
+в пуле из POST_THUMBNAIL_WORKERS потоков, а не в запросе ленты,
+вместе с вариантами для srcset: ширины POST_THUMBNAIL_WIDTHS
+в форматах POST_THUMBNAIL_FORMATS (см. variants).
+Шаблоны только ищут готовую миниатюру в KV-хранилище sorl-thumbnail
+(см. posts.templatetags.post_thumbnails) и до её появления выводят
+заглушку того же размера. Когда миниатюры готовы, карточка поста
+и ленты с ним сбрасываются. Миниатюры всех карточек страницы ищутся
+одним проходом по кешу и одним запросом к базе (см. lookup_many).
+Размеры оригинала читаются из заголовка файла сразу при загрузке
+(см. measure), а крошечная размытая заглушка для фона карточки
+делается в пуле из уже раскодированного оригинала (см. generate).
+"""
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.utils import timezone
+from PIL import Image, ImageFilter, features
+from sorl.thumbnail import base, default
+from sorl.thumbnail.conf import defaults as default_settings
+from sorl.thumbnail.conf import settings as thumbnail_settings
+from sorl.thumbnail.engines import pil_engine
+from sorl.thumbnail.helpers import serialize, tokey
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores import cached_db_kvstore
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.models import KVStore as KVStoreModel
+from sorl.thumbnail.parsers import parse_geometry
+
+from . import feed_cache, shards
+from .models import Post
+from .templatetags import post_cards
+
+
+logger = logging.getLogger(__name__)
+
+# Наибольшая сторона размытой заглушки в пикселях.
+PLACEHOLDER_SIZE = 16
+
+_executor = None
+_lock = threading.Lock()
+_pending = set()
+
+
+class KVStore(cached_db_kvstore.KVStore):
+    """KV-хранилище sorl-thumbnail с пакетным чтением."""
+
+    def get_many(self, image_files):
+        """Словарь {ключ файла: ImageFile или None}.
+
+        Ключи читаются одним get_many из кеша, промахи - одним запросом
+        к базе; отсутствующие записи тоже кешируются, как в _get_raw.
+        """
+        keys = {add_prefix(image_file.key): image_file.key
+                for image_file in image_files}
+        values = self.cache.get_many(list(keys))
+        missing = [key for key in keys if key not in values]
+        if missing:
+            stored = dict(KVStoreModel.objects.filter(
+                key__in=missing).values_list('key', 'value'))
+            fetched = {key: stored.get(key, cached_db_kvstore.EMPTY_VALUE)
+                       for key in missing}
+            self.cache.set_many(fetched,
+                                thumbnail_settings.THUMBNAIL_CACHE_TIMEOUT)
+            values.update(fetched)
+        return {
+            keys[key]: (None if value == cached_db_kvstore.EMPTY_VALUE
+                        else deserialize_image_file(value))
+            for key, value in values.items()
+        }
+
+
+class Engine(pil_engine.Engine):
+    """PIL-движок sorl-thumbnail для Pillow без Image.ANTIALIAS."""
+
+    def _scale(self, image, width, height):
+        return image.resize((width, height), resample=Image.LANCZOS)
+
+
+class ThumbnailBackend(base.ThumbnailBackend):
+    """Бэкенд sorl-thumbnail, который ищет миниатюры без генерации
+    и делает несколько миниатюр из одной раскодированной картинки."""
+
+    extensions = {**base.EXTENSIONS, 'AVIF': 'avif'}
+
+    def thumbnail_options(self, source, options):
+        """Опции с умолчаниями - так же, как в get_thumbnail."""
+        options = dict(options)
+        if thumbnail_settings.THUMBNAIL_PRESERVE_FORMAT:
+            options.setdefault('format', self._get_format(source))
+        for key, value in self.default_options.items():
+            options.setdefault(key, value)
+        for key, attr in self.extra_options:
+            value = getattr(thumbnail_settings, attr)
+            if value != getattr(default_settings, attr):
+                options.setdefault(key, value)
+        return options
+
+    def thumbnail_file(self, file_, geometry_string, **options):
+        """Файл миниатюры с тем же именем, что даст get_thumbnail."""
+        source = ImageFile(file_)
+        options = self.thumbnail_options(source, options)
+        name = self._get_thumbnail_filename(source, geometry_string, options)
+        return ImageFile(name, default.storage)
+
+    def create(self, source, source_image, geometry_string, **options):
+        """Миниатюра из уже раскодированной картинки source_image.
+
+        Файл, который уже есть в хранилище, только записывается в KV:
+        одинаковые картинки хранятся одним файлом (см. posts.storage).
+        """
+        thumbnail = self.thumbnail_file(source, geometry_string, **options)
+        if not thumbnail.exists():
+            options = self.thumbnail_options(source, options)
+            options['image_info'] = default.engine.get_image_info(
+                source_image)
+            self._create_thumbnail(source_image, geometry_string, options,
+                                   thumbnail)
+        default.kvstore.set(thumbnail, source)
+        return thumbnail
+
+    def _get_thumbnail_filename(self, source, geometry_string, options):
+        # В sorl-thumbnail нет расширения для AVIF.
+        key = tokey(source.key, geometry_string, serialize(options))
+        path = f'{key[:2]}/{key[2:4]}/{key}'
+        extension = self.extensions[options['format']]
+        return f'{thumbnail_settings.THUMBNAIL_PREFIX}{path}.{extension}'
+
+
+backend = ThumbnailBackend()
+
+
+class Placeholder:
+    """Заглушка на месте миниатюры, которая ещё готовится.
+
+    Если размеры оригинала известны (source_size), у заглушки те же
+    размеры, что получатся у миниатюры, и страница не сдвинется,
+    когда миниатюра появится.
+    """
+
+    url = ''
+    srcset = ''
+    sources = ()
+
+    def __init__(self, geometry_string, options=None, source_size=None):
+        self.width, self.height = parse_geometry(geometry_string)
+        if source_size and all(source_size):
+            self.width, self.height = expected_size(
+                self.width, self.height, options or {}, *source_size)
+
+
+def expected_size(width, height, options, source_width, source_height):
+    """Размер миниатюры ШxВ картинки source_width x source_height,
+    как его посчитает sorl-thumbnail с опциями crop и upscale."""
+    crop = options.get('crop')
+    factor = (max if crop else min)(width / source_width,
+                                    height / source_height)
+    if not options.get('upscale', thumbnail_settings.THUMBNAIL_UPSCALE):
+        factor = min(factor, 1)
+    scaled_width = round(source_width * factor)
+    scaled_height = round(source_height * factor)
+    if crop:
+        return min(scaled_width, width), min(scaled_height, height)
+    return scaled_width, scaled_height
+
+
+class Picture:
+    """Готовая миниатюра с вариантами для <picture>.
+
+    url, width и height - основная миниатюра из POST_THUMBNAILS,
+    srcset - её размеры для srcset тега <img>, sources - пары
+    (MIME-тип, srcset) современных форматов для тегов <source>.
+    """
+
+    def __init__(self, thumbnail, srcset, sources):
+        self.url = thumbnail.url
+        self.width = thumbnail.width
+        self.height = thumbnail.height
+        self.srcset = srcset
+        self.sources = sources
+
+
+def modern_formats():
+    """Форматы из POST_THUMBNAIL_FORMATS, которые умеет этот Pillow."""
+    return {image_format: options for image_format, options
+            in settings.POST_THUMBNAIL_FORMATS.items()
+            if features.check(image_format.lower())}
+
+
+def variants(name):
+    """Варианты миниатюры name: список (формат, геометрия, опции).
+
+    Каждая ширина из POST_THUMBNAIL_WIDTHS делается в современных
+    форматах и в формате основной миниатюры (формат None). Последней
+    идёт сама основная миниатюра из POST_THUMBNAILS: она пишется
+    в KV после остальных и служит признаком готовности всех вариантов.
+    """
+    geometry, options = settings.POST_THUMBNAILS[name]
+    width, height = parse_geometry(geometry)
+    formats = {**modern_formats(), None: {}}
+    result = []
+    for variant_width in sorted(set(settings.POST_THUMBNAIL_WIDTHS)):
+        variant_height = round(height * variant_width / width)
+        for image_format, format_options in formats.items():
+            if variant_width == width and image_format is None:
+                continue
+            variant_options = {**options, **format_options}
+            if image_format is not None:
+                variant_options['format'] = image_format
+            result.append((image_format, f'{variant_width}x{variant_height}',
+                           variant_options))
+    result.append((None, geometry, options))
+    return result
+
+
+def lookup(image, name):
+    """Готовая миниатюра размера name из POST_THUMBNAILS или заглушка."""
+    if not image:
+        return Placeholder(*settings.POST_THUMBNAILS[name])
+    return lookup_many([image], name)[image.name]
+
+
+def lookup_many(images, name):
+    """Миниатюры размера name для картинок images одним проходом по KV.
+
+    Возвращает {имя картинки: Picture или заглушка}.
+    """
+    specs = variants(name)
+    images = [image for image in images if image]
+    files = {
+        (image.name, index): backend.thumbnail_file(image, geometry,
+                                                    **options)
+        for image in images
+        for index, (image_format, geometry, options) in enumerate(specs)
+    }
+    found = default.kvstore.get_many(files.values())
+    pictures = {}
+    for image in images:
+        ready = [found.get(files[image.name, index].key)
+                 for index in range(len(specs))]
+        pictures[image.name] = _picture(specs, ready, source_size(image))
+    return pictures
+
+
+def source_size(image):
+    """Размеры оригинала, сохранённые в посте картинки image."""
+    post = getattr(image, 'instance', None)
+    return (getattr(post, 'image_width', None),
+            getattr(post, 'image_height', None))
+
+
+def _picture(specs, ready, size):
+    thumbnail = ready[-1]
+    if thumbnail is None:
+        image_format, geometry, options = specs[-1]
+        return Placeholder(geometry, options, size)
+    srcsets = {}
+    for (image_format, geometry, options), variant in zip(specs, ready):
+        if variant is not None:
+            widths = srcsets.setdefault(image_format, {})
+            widths.setdefault(variant.width, variant.url)
+    srcset = {
+        image_format: ', '.join(f'{url} {width}w'
+                                for width, url in sorted(widths.items()))
+        for image_format, widths in srcsets.items()
+    }
+    fallback = srcset.pop(None)
+    return Picture(thumbnail, fallback, [
+        (Image.MIME[image_format], value)
+        for image_format, value in srcset.items()
+    ])
+
+
+def measure(file):
+    """Размеры картинки file: (Ш, В).
+
+    Читается только заголовок, сама картинка не раскодируется.
+    file - открытый файл, после чтения он перематывается в начало.
+    """
+    file.seek(0)
+    try:
+        with Image.open(file) as image:
+            return image.size
+    finally:
+        file.seek(0)
+
+
+def placeholder(image):
+    """Размытая копия картинки image как data: URI.
+
+    Ещё не раскодированный JPEG раскодируется сразу в уменьшенном
+    масштабе.
+    """
+    image.draft('RGB', (PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    small = image.convert('RGB')
+    small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.LANCZOS)
+    output = BytesIO()
+    small.filter(ImageFilter.GaussianBlur(1)).save(output, 'JPEG',
+                                                   quality=40)
+    data = b64encode(output.getvalue()).decode()
+    return f'data:image/jpeg;base64,{data}'
+
+
+def generate(name):
+    """Делает все варианты миниатюр картинки name и возвращает
+    её размытую заглушку (см. placeholder).
+
+    Оригинал раскодируется один раз, все размеры, форматы и заглушка
+    режутся из него же. JPEG сразу раскодируется в уменьшенном
+    масштабе, которого хватает на самый большой вариант. Если все
+    миниатюры уже готовы, оригинал не открывается и возвращается None.
+    """
+    specs = [spec for thumbnail_name in settings.POST_THUMBNAILS
+             for spec in variants(thumbnail_name)]
+    sizes = [parse_geometry(geometry) for image_format, geometry, options
+             in specs]
+    source = ImageFile(name, Post._meta.get_field('image').storage)
+    ready = default.kvstore.get_many(
+        backend.thumbnail_file(source, geometry, **options)
+        for image_format, geometry, options in specs)
+    if all(ready.values()):
+        return
+    source_image = default.engine.get_image(source)
+    try:
+        source.set_size(default.engine.get_image_size(source_image))
+        default.kvstore.get_or_set(source)
+        source_image.draft(source_image.mode, (max(w for w, h in sizes),
+                                               max(h for w, h in sizes)))
+        for image_format, geometry, options in specs:
+            backend.create(source, source_image, geometry, **options)
+        return placeholder(source_image)
+    finally:
+        default.engine.cleanup(source_image)
+
+
+def refresh_posts(name):
+    """Обновляет закешированные карточки постов с картинкой name."""
+    scopes = set()
+    for posts in shards.spread(Post.objects.filter(image=name)):
+        for post in posts.only('pk', 'author_id', 'group_id'):
+            scopes.update(feed_cache.post_scopes(post))
+        # Карточки постов кешируются по Post.updated (см.
+        # posts.templatetags.post_cards), поэтому двигаем и его.
+        posts.update(updated=timezone.now())
+    feed_cache.bump(*scopes)
+
+
+def schedule(post):
+    """Ставит генерацию миниатюр картинки поста в очередь пула.
+
+    Всё, что нужно для сброса карточки и лент, собирается здесь, пока
+    пост под рукой: из пула в таблицу постов пишется только заглушка.
+    """
+    task = (post.image.name, post.pk, post._state.db,
+            post_cards.card_keys(post), feed_cache.post_scopes(post))
+    if not settings.POST_THUMBNAIL_WORKERS:
+        _run(*task)
+        return
+    global _executor
+    with _lock:
+        if task[0] in _pending:
+            return
+        _pending.add(task[0])
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                settings.POST_THUMBNAIL_WORKERS,
+                thread_name_prefix='post-thumbnails')
+    _executor.submit(_run_in_pool, *task)
+
+
+def _run(name, post_id, database, stale_cards, scopes):
+    try:
+        image_placeholder = generate(name)
+    except Exception:
+        # Битая картинка не должна ломать сохранение поста: карточка
+        # так и останется с заглушкой.
+        logger.exception('Не удалось подготовить миниатюры %s', name)
+        return
+    if image_placeholder:
+        # Картинку поста могли уже заменить, пока она была в очереди.
+        # update() не трогает Post.updated: карточку сбросим ниже.
+        Post.objects.using(database).filter(
+            pk=post_id, image=name).update(
+                image_placeholder=image_placeholder)
+    cache.delete_many(stale_cards)
+    feed_cache.bump(*scopes)
+
+
+def _run_in_pool(*task):
+    try:
+        _run(*task)
+    finally:
+        with _lock:
+            _pending.discard(task[0])
+        # У каждого потока пула своё соединение с базой.
+        connections.close_all()
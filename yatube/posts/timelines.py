@@ -0,0 +1,173 @@
+"""Ленты подписок с гибридной раскладкой постов.
+
+Посты обычных авторов раскладываются по лентам подписчиков при записи.
+Авторы из таблицы Celebrity в ленты не пишутся: их посты подмешиваются
+при чтении ленты (см. TimelinePaginator). Таблицу по порогу
+TIMELINE_CELEBRITY_FOLLOWERS пересчитывает команда refresh_celebrities
+(refresh_celebrities()): она же убирает из лент посты новых
+«знаменитостей» и дописывает посты тех, кто ими быть перестал.
+"""
+from itertools import islice
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+from . import shards
+from .models import Celebrity, Follow, Post, TimelineEntry
+
+
+CELEBRITIES_KEY = 'timeline:celebrities'
+
+
+def celebrity_ids():
+    """Авторы, чьи посты подмешиваются в ленты при чтении.
+
+    Читаются из Celebrity и кешируются на TIMELINE_CELEBRITY_TIMEOUT
+    секунд.
+    """
+    ids = cache.get(CELEBRITIES_KEY)
+    if ids is None:
+        ids = frozenset(Celebrity.objects.values_list('author_id',
+                                                      flat=True))
+        cache.set(CELEBRITIES_KEY, ids, settings.TIMELINE_CELEBRITY_TIMEOUT)
+    return ids
+
+
+def _sync_celebrities():
+    """Приводит Celebrity к порогу TIMELINE_CELEBRITY_FOLLOWERS.
+
+    Возвращает (новые «знаменитости», бывшие).
+    """
+    threshold = settings.TIMELINE_CELEBRITY_FOLLOWERS
+    actual = frozenset()
+    if threshold is not None:
+        actual = frozenset(
+            Follow.objects.values('author_id')
+            .annotate(followers=Count('pk'))
+            .filter(followers__gt=threshold)
+            .values_list('author_id', flat=True)
+        )
+    current = frozenset(Celebrity.objects.values_list('author_id',
+                                                      flat=True))
+    promoted, demoted = actual - current, current - actual
+    Celebrity.objects.bulk_create(
+        [Celebrity(author_id=author_id) for author_id in promoted],
+        ignore_conflicts=True)
+    Celebrity.objects.filter(author_id__in=demoted).delete()
+    cache.delete(CELEBRITIES_KEY)
+    return promoted, demoted
+
+
+def refresh_celebrities():
+    """Пересчитывает «знаменитостей» и поправляет ленты подписчиков.
+
+    Посты новых «знаменитостей» убираются из лент, иначе лента
+    показывала и считала бы их дважды, а посты бывших дописываются,
+    чтобы не пропасть. Возвращает (новые, бывшие).
+    """
+    promoted, demoted = _sync_celebrities()
+    for author_id in promoted:
+        purge_author(author_id)
+    for author_id in demoted:
+        backfill_author(author_id)
+    return promoted, demoted
+
+
+def pulled_posts(user):
+    """Посты «знаменитостей», на которых подписан пользователь."""
+    celebrities = celebrity_ids()
+    if not celebrities:
+        return None
+    author_ids = list(Follow.objects.filter(
+        user=user, author_id__in=celebrities).values_list(
+        'author_id', flat=True))
+    if not author_ids:
+        return None
+    return Post.objects.filter(author_id__in=author_ids)
+
+
+def fan_out_post(post):
+    """Кладёт новый пост в ленты всех подписчиков автора."""
+    if post.author_id in celebrity_ids():
+        return
+    follower_ids = Follow.objects.filter(
+        author_id=post.author_id).values_list('user_id', flat=True)
+    _insert(
+        (TimelineEntry(user_id=user_id, post_id=post.pk,
+                       pub_date=post.pub_date)
+         for user_id in follower_ids.iterator()),
+    )
+
+
+def backfill(user_id, author_id):
+    """Добавляет в ленту подписчика уже написанные посты автора."""
+    if author_id in celebrity_ids():
+        return
+    _insert(
+        (TimelineEntry(user_id=user_id, post_id=pk, pub_date=pub_date)
+         for posts in shards.author_parts(author_id)
+         for pk, pub_date in posts.values_list('pk', 'pub_date').iterator()),
+    )
+
+
+def backfill_author(author_id):
+    """Раскладывает все посты автора по лентам всех его подписчиков."""
+    posts = [row for part in shards.author_parts(author_id)
+             for row in part.values_list('pk', 'pub_date')]
+    if not posts:
+        return
+    follower_ids = Follow.objects.filter(
+        author_id=author_id).values_list('user_id', flat=True)
+    _insert(
+        (TimelineEntry(user_id=user_id, post_id=pk, pub_date=pub_date)
+         for user_id in follower_ids.iterator()
+         for pk, pub_date in posts),
+    )
+
+
+def _insert(entries):
+    # bulk_create превращает генератор в список целиком, поэтому
+    # пачки нарезаются заранее и память не растёт с числом подписчиков.
+    entries = iter(entries)
+    while True:
+        batch = list(islice(entries, settings.TIMELINE_BATCH_SIZE))
+        if not batch:
+            return
+        TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def purge(user_id, author_id):
+    """Убирает из ленты подписчика посты автора после отписки."""
+    _purge(TimelineEntry.objects.filter(user_id=user_id), author_id)
+
+
+def purge_author(author_id):
+    """Убирает посты автора из лент всех подписчиков."""
+    _purge(TimelineEntry.objects.all(), author_id)
+
+
+def _purge(entries, author_id):
+    if not shards.scattered():
+        entries.filter(post__author_id=author_id).delete()
+        return
+    # Посты лежат на шарде или в архиве, JOIN с лентой в default
+    # невозможен.
+    post_ids = (pk for posts in shards.author_parts(author_id)
+                for pk in posts.values_list('pk', flat=True).iterator())
+    while True:
+        batch = list(islice(post_ids, settings.TIMELINE_BATCH_SIZE))
+        if not batch:
+            return
+        entries.filter(post_id__in=batch).delete()
+
+
+def rebuild():
+    """Пересобирает все ленты по текущим подпискам."""
+    TimelineEntry.objects.all().delete()
+    _sync_celebrities()
+    celebrities = celebrity_ids()
+    authors = Follow.objects.values_list('author_id', flat=True).distinct()
+    for author_id in authors.iterator():
+        if author_id not in celebrities:
+            backfill_author(author_id)
@@ -0,0 +1,125 @@
+"""Проверка загружаемых картинок, пока тело запроса ещё принимается.
+
+View, принимающие картинку поста, помечены limit_image_uploads: их
+запросы первым обрабатывает LimitedImageUploadHandler, который видит
+каждый кусок файла раньше обработчиков, которые пишут его в память
+или во временный файл. Приём останавливается, как только файл
+превысил POST_IMAGE_MAX_SIZE или его заголовок (первые
+POST_IMAGE_HEADER_SIZE байт) говорит о слишком больших размерах или
+числе пикселей: такая «бомба» не раскодируется ни формой, ни
+генерацией миниатюр. Причина отказа попадает в
+request.rejected_uploads, и форма показывает её как ошибку поля.
+"""
+from functools import wraps
+from io import BytesIO
+import warnings
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.template.defaultfilters import filesizeformat
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from PIL import Image
+
+
+def limit_image_uploads(view):
+    """Декоратор view: картинки проверяются при приёме запроса.
+
+    Обработчик надо поставить, пока request.POST никто не прочитал,
+    а CsrfViewMiddleware читает его ещё до view. Поэтому view
+    освобождён от проверки CSRF в middleware, а проверяет её
+    csrf_protect уже после установки обработчика.
+    """
+    protected = csrf_protect(view)
+
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.rejected_uploads = {}
+        request.upload_handlers.insert(
+            0, LimitedImageUploadHandler(request))
+        return protected(request, *args, **kwargs)
+    return wrapper
+
+
+def form_data(request):
+    """Данные для формы с картинкой или None, если её не отправляли.
+
+    Поля, которые идут в запросе после отброшенного файла, не
+    разбираются, и request.POST может оказаться пустым. Форма всё
+    равно связывается с ним, чтобы показать причину отказа.
+    """
+    if request.POST or request.rejected_uploads:
+        return request.POST
+    return None
+
+
+class LimitedImageUploadHandler(FileUploadHandler):
+    """Останавливает приём слишком больших картинок."""
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+        self.header = b''
+        self.checked = False
+        self.error = None
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.POST_IMAGE_MAX_SIZE:
+            self.error = (
+                'Файл больше '
+                f'{filesizeformat(settings.POST_IMAGE_MAX_SIZE)}.')
+        elif not self.checked:
+            self.header += raw_data
+            self.check_header(
+                final=len(self.header) >= settings.POST_IMAGE_HEADER_SIZE)
+        self.stop_if_rejected()
+        return raw_data
+
+    def file_complete(self, file_size):
+        if not self.checked:
+            self.check_header(final=True)
+        self.stop_if_rejected()
+        return None
+
+    def stop_if_rejected(self):
+        """Остаток тела запроса только вычитывается, не разбирается:
+        ни файл, ни поля после него в request не попадут."""
+        if self.error is not None:
+            self.request.rejected_uploads[self.field_name] = self.error
+            raise StopUpload(connection_reset=False)
+
+    def check_header(self, final):
+        """Проверяет размеры картинки по уже принятому началу файла.
+
+        Пока заголовок не дочитан, Pillow не может открыть картинку;
+        если его нет и в первых POST_IMAGE_HEADER_SIZE байтах (final),
+        файл не считается картинкой.
+        """
+        try:
+            with warnings.catch_warnings():
+                # Размер проверяется ниже, предупреждение о «бомбе»
+                # ничего не добавляет.
+                warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+                with Image.open(BytesIO(self.header)) as image:
+                    width, height = image.size
+        except Image.DecompressionBombError:
+            self.error = self.too_many_pixels()
+            return
+        except Exception:
+            if final:
+                self.error = 'Загрузите картинку: файл не распознан.'
+            return
+        self.checked = True
+        self.header = b''
+        limit = settings.POST_IMAGE_MAX_DIMENSION
+        if width > limit or height > limit:
+            self.error = (f'Картинка {width}x{height} больше допустимых '
+                          f'{limit}x{limit} пикселей.')
+        elif width * height > settings.POST_IMAGE_MAX_PIXELS:
+            self.error = self.too_many_pixels()
+
+    @staticmethod
+    def too_many_pixels():
+        megapixels = settings.POST_IMAGE_MAX_PIXELS / 1000000
+        return f'В картинке больше {megapixels:g} мегапикселей.'
@@ -1,84 +1,149 @@
-from django.core.paginator import Paginator
+from django.http import Http404
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
+from django.views.decorators.http import require_safe
 
+from core import sendfile
+from core.replicas import pin_primary, reads_from_replica
+
+from . import (archive, counters, feed_cache, resize, search, shards,
+               timelines)
 from .forms import PostForm, CommentForm
+from .uploads import form_data, limit_image_uploads
 from .models import Post, Group, User, Follow
+from .paginators import (KeysetPaginator, ShardedPaginator,
+                         TimelinePaginator, feed_count_key)
 
 
-def get_context_paginator(queryset, request):
-    paginator = Paginator(queryset, settings.COUNT_POSTS)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+def get_context_paginator(queryset, request, count_key=None,
+                          paginator_class=KeysetPaginator, **kwargs):
+    paginator = paginator_class(queryset, settings.COUNT_POSTS,
+                                count_key=count_key, **kwargs)
+    page_obj = paginator.get_page_from_request(request)
     return {
         'page_obj': page_obj,
     }
 
 
+def group_scope(request, slug):
+    group_id = Group.objects.filter(slug=slug).values_list(
+        'pk', flat=True).first()
+    return (feed_cache.scope('group', group_id),)
+
+
+def author_scope(request, username):
+    author_id = User.objects.filter(username=username).values_list(
+        'pk', flat=True).first()
+    return (feed_cache.scope('author', author_id),)
+
+
+def post_scopes(request, post_id):
+    author_id = archive.first(shards.posts_by_id(post_id).filter(
+        pk=post_id).values_list('author_id', flat=True))
+    return (feed_cache.scope('post', post_id),
+            feed_cache.scope('author', author_id))
+
+
+@reads_from_replica
+@feed_cache.conditional(lambda request: ('index',))
 def index(request):
-    context = get_context_paginator(Post.objects.select_related('author',
-                                    'group').all(), request)
-    return render(request, 'posts/index.html', context)
+    context = get_context_paginator(Post.objects.for_cards(), request,
+                                    feed_count_key('index'),
+                                    ShardedPaginator)
+    context.update(feed_cache.context('index'))
+    return feed_cache.tag(render(request, 'posts/index.html', context),
+                          'index')
 
 
+@reads_from_replica
+@feed_cache.conditional(group_scope)
 def group_posts(request, slug):
     group = get_object_or_404(Group, slug=slug)
-    posts = group.posts.all()
+    posts = group.posts.for_cards()
     context = {
         'group': group,
     }
-    context.update(get_context_paginator(posts, request))
-    return render(request, 'posts/group_list.html', context)
+    context.update(get_context_paginator(
+        posts, request, feed_count_key('group', group.pk),
+        ShardedPaginator))
+    group_scope = feed_cache.scope('group', group.pk)
+    context.update(feed_cache.context(group_scope))
+    return feed_cache.tag(
+        render(request, 'posts/group_list.html', context), group_scope)
 
 
+@reads_from_replica
+@feed_cache.conditional(author_scope)
 def profile(request, username):
     author = get_object_or_404(User, username=username)
-    author_posts = author.posts.all()
+    author_posts = shards.author_posts(author.pk, Post.objects.for_cards())
     following = request.user.is_authenticated and Follow.objects.filter(
         user=request.user, author=author).exists()
     context = {
         'author': author,
+        'stats': counters.stats_for(author),
         'following': following,
     }
-    context.update(get_context_paginator(author_posts, request))
-    return render(request, 'posts/profile.html', context)
-
-
+    # Запрос уже направлен на шард автора, архив добавит пагинатор.
+    context.update(get_context_paginator(
+        author_posts, request, feed_count_key('author', author.pk),
+        ShardedPaginator, databases=()))
+    author_scope = feed_cache.scope('author', author.pk)
+    context.update(feed_cache.context(author_scope))
+    return feed_cache.tag(
+        render(request, 'posts/profile.html', context), author_scope)
+
+
+@reads_from_replica
+@feed_cache.conditional(post_scopes)
 def post_detail(request, post_id):
-    post = get_object_or_404(Post, pk=post_id)
+    post = archive.get_object_or_404(
+        shards.posts_by_id(post_id).with_related('author__stats', 'group'),
+        pk=post_id)
     form = CommentForm()
-    comments = post.comments.all()
+    comments = post.comments.order_by('created', 'pk')
     context = {
         'post': post,
+        'author_stats': counters.stats_for(post.author),
         'form': form,
         'comments': comments,
     }
-    return render(request, 'posts/post_detail.html', context)
+    return feed_cache.tag(
+        render(request, 'posts/post_detail.html', context),
+        feed_cache.scope('post', post.pk),
+        feed_cache.scope('author', post.author_id))
 
 
 @login_required
+@limit_image_uploads
 def post_create(request):
-    form = PostForm(request.POST or None,
-                    files=request.FILES or None)
+    form = PostForm(form_data(request),
+                    files=request.FILES or None,
+                    rejected_uploads=request.rejected_uploads)
     if form.is_valid():
         post = form.save(commit=False)
         post.author = request.user
         post.save()
+        pin_primary(request)
         return redirect('posts:profile', post.author.username)
     return render(request, 'posts/create_post.html', {'form': form})
 
 
 @login_required
+@limit_image_uploads
 def post_edit(request, post_id):
-    post = get_object_or_404(Post, pk=post_id)
-    form = PostForm(request.POST or None,
+    post = archive.get_object_or_404(shards.posts_by_id(post_id),
+                                     pk=post_id)
+    form = PostForm(form_data(request),
                     files=request.FILES or None,
-                    instance=post)
+                    instance=post,
+                    rejected_uploads=request.rejected_uploads)
     if post.author != request.user:
         return redirect('posts:post_detail', post_id)
     if form.is_valid():
         form.save()
+        pin_primary(request)
         return redirect('posts:post_detail', post_id)
     context = {
         'post_edit': True,
@@ -90,20 +155,29 @@ def post_edit(request, post_id):
 
 @login_required
 def add_comment(request, post_id):
-    post = get_object_or_404(Post, pk=post_id)
+    post = archive.get_object_or_404(shards.posts_by_id(post_id),
+                                     pk=post_id)
     form = CommentForm(request.POST or None)
     if form.is_valid():
         comment = form.save(commit=False)
         comment.author = request.user
         comment.post = post
         comment.save()
+        pin_primary(request)
     return redirect('posts:post_detail', post_id=post_id)
 
 
 @login_required
+@reads_from_replica
 def follow_index(request):
-    context = get_context_paginator(Post.objects.filter(
-        author__following__user=request.user), request)
+    paginator = TimelinePaginator(
+        request.user.timeline.all(), settings.COUNT_POSTS,
+        posts=Post.objects.for_cards(),
+        pulled=timelines.pulled_posts(request.user),
+        count_key=feed_count_key('follow', request.user.pk))
+    context = {
+        'page_obj': paginator.get_page_from_request(request),
+    }
     return render(request, 'posts/follow.html', context)
 
 
@@ -113,6 +187,7 @@ def profile_follow(request, username):
     if author == request.user:
         return redirect('posts:profile', username=username)
     Follow.objects.get_or_create(user=request.user, author=author)
+    pin_primary(request)
     return redirect('posts:profile', username=username)
 
 
@@ -121,4 +196,27 @@ def profile_unfollow(request, username):
     author = get_object_or_404(User, username=username)
     following = Follow.objects.filter(user=request.user, author=author)
     following.delete()
+    pin_primary(request)
     return redirect('posts:profile', username=username)
+
+
+def post_search(request):
+    query = request.GET.get('q', '')
+    page = search.search(query, settings.COUNT_POSTS,
+                         request.GET.get('after', ''))
+    context = {
+        'query': query,
+        'page': page,
+    }
+    return render(request, 'posts/search.html', context)
+
+
+@require_safe
+def resized_image(request, sign, width, height, name):
+    path = resize.cached_path(sign, name, width, height)
+    if path is None:
+        raise Http404
+    return sendfile.serve(
+        request, path,
+        cache_control=(f'public, max-age={settings.RESIZE_CACHE_MAX_AGE}, '
+                       'immutable'))
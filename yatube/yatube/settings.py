@@ -50,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'posts.middleware.AnonymousPageCacheMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,9 +91,69 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Соединение живёт между запросами и не открывается заново
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# Ленты читаются с реплик из DATABASE_REPLICAS (псевдонимы из
+# DATABASES), записи идут в default; пусто - всё в default.
+# Только модели приложений DATABASE_REPLICA_APPS: сессии и
+# пользователи всегда читаются из default. После своей записи
+# пользователь DATABASE_REPLICA_STICKY_SECONDS секунд читает
+# из default (см. core.replicas). Для проверки на одной машине
+# реплика - копия файла базы, которую обновляет sync_replicas:
+# DATABASES['replica'] = {
+#     **DATABASES['default'],
+#     'NAME': os.path.join(BASE_DIR, 'db.replica.sqlite3'),
+#     'TEST': {'MIRROR': 'default'},
+# }
+# DATABASE_REPLICAS = ('replica',)
+DATABASE_ROUTERS = ['posts.archive.ArchiveRouter',
+                    'posts.shards.ShardRouter',
+                    'core.replicas.ReplicaRouter']
+DATABASE_REPLICAS = ()
+DATABASE_REPLICA_APPS = ('posts',)
+DATABASE_REPLICA_STICKY_SECONDS = 15
+
+# Шарды постов и комментариев - псевдонимы из DATABASES; пусто - всё
+# в default. Посты автора лежат на одном шарде (см. posts.shards),
+# пользователи, группы, подписки и ленты - в default. Новые шарды
+# дописываются в конец: номер шарда в списке задаёт диапазон id
+# его постов. Шарду нужна схема: manage.py migrate --database <шард>.
+POST_SHARDS = ()
+# Сколько секунд чтения берут шард автора и перенесённого поста из
+# кеша. rebalance_shards удаляет эти ключи сам, но увидят это только
+# процессы с общим кешем (memcached, redis), остальные - через
+# столько секунд.
+SHARD_DIRECTORY_TIMEOUT = 5
+
+# Архив старых постов - псевдоним из DATABASES или None. Команда
+# archive_posts переносит туда посты старше POST_ARCHIVE_AFTER_DAYS
+# дней вместе с комментариями пачками по POST_ARCHIVE_BATCH_SIZE;
+# ленты читают архив, только когда листают глубже горячих постов
+# (см. posts.archive). Архиву нужна схема, как шарду:
+# DATABASES['archive'] = {
+#     **DATABASES['default'],
+#     'NAME': os.path.join(BASE_DIR, 'db.archive.sqlite3'),
+# }
+# POST_ARCHIVE_DATABASE = 'archive'
+POST_ARCHIVE_DATABASE = None
+POST_ARCHIVE_AFTER_DAYS = 90
+POST_ARCHIVE_BATCH_SIZE = 500
+
+# Прагмы, которые core.signals включает каждому соединению SQLite:
+# WAL, чтобы чтение не ждало записи; synchronous=NORMAL - в WAL
+# безопасно при сбое приложения; кеш страниц в КиБ (минус) и mmap;
+# сколько миллисекунд ждать занятую базу, а не падать сразу
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -146,9 +207,74 @@ CSRF_FAILURE_VIEW = 'core.views.csrf_failure'
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Сколько секунд браузеры хранят файлы из MEDIA_ROOT
+MEDIA_CACHE_MAX_AGE = 60 * 60 * 24
+# Кто отдаёт медиа и кеш картинок: None - сам Django потоком,
+# 'X-Accel-Redirect' - nginx, 'X-Sendfile' - Apache или lighttpd.
+# Для nginx каталоги сопоставляются internal location, например
+# {MEDIA_ROOT: '/internal/media/'}; файлы вне них отдаёт Django
+SENDFILE_HEADER = None
+SENDFILE_LOCATIONS = {}
 
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
+
+# Сколько секунд кешировать число постов в ленте для пагинатора
+PAGINATOR_COUNT_TIMEOUT = 60 * 15
+# Сколько соседних страниц показывать по обе стороны от текущей
+PAGINATOR_WINDOW = 2
+
+# Размер пачки при раскладке постов по лентам подписчиков
+TIMELINE_BATCH_SIZE = 500
+# Авторы с большим числом подписчиков не раскладываются по лентам,
+# их посты подмешиваются при чтении; None - раскладывать всех.
+# Список пересчитывает команда refresh_celebrities (запускать по
+# расписанию), чтения берут его из кеша на TIMELINE_CELEBRITY_TIMEOUT
+TIMELINE_CELEBRITY_FOLLOWERS = 10000
+TIMELINE_CELEBRITY_TIMEOUT = 60 * 10
+
+# Сколько секунд хранить фрагменты лент; кеш сбрасывается сигналами
+FEED_CACHE_TIMEOUT = 60 * 60 * 6
+# Сколько секунд хранить отрисованную карточку поста
+CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Сколько секунд хранить страницы для анонимов; сбрасываются по тегам
+ANONYMOUS_PAGE_CACHE_TIMEOUT = 60 * 60 * 6
+
+# Миниатюры картинок постов: имя -> (геометрия, опции sorl-thumbnail).
+# Готовятся после загрузки, шаблоны выводят только готовые
+POST_THUMBNAILS = {
+    'card': ('960x339', {'crop': 'center', 'upscale': False}),
+}
+# Ширины вариантов миниатюр для srcset и форматы, в которых они
+# делаются вдобавок к JPEG; форматы, которых не умеет Pillow, пропускаются
+POST_THUMBNAIL_WIDTHS = (480, 960, 1440)
+POST_THUMBNAIL_FORMATS = {
+    'AVIF': {'quality': 50},
+    'WEBP': {'quality': 75},
+}
+# Сколько потоков готовят миниатюры; 0 - прямо при сохранении поста
+POST_THUMBNAIL_WORKERS = 2
+# KV-хранилище sorl-thumbnail с пакетным чтением для страниц лент
+THUMBNAIL_KVSTORE = 'posts.thumbnails.KVStore'
+THUMBNAIL_ENGINE = 'posts.thumbnails.Engine'
+
+# Ограничения картинок постов. Проверяются, пока тело запроса
+# принимается (см. posts.uploads): размер файла в байтах и размеры
+# из заголовка картинки, который ищется в первых
+# POST_IMAGE_HEADER_SIZE байтах
+POST_IMAGE_MAX_SIZE = 10 * 1024 * 1024
+POST_IMAGE_MAX_DIMENSION = 10000
+POST_IMAGE_MAX_PIXELS = 40 * 1000 * 1000
+POST_IMAGE_HEADER_SIZE = 256 * 1024
+
+# Картинки постов в размере по подписанной ссылке /media/r/...
+# (см. posts.resize): каталог кеша на диске, его предел в байтах,
+# наибольшая сторона и сколько секунд браузеры хранят ответ
+RESIZE_CACHE_DIR = os.path.join(BASE_DIR, 'resize_cache')
+RESIZE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+RESIZE_MAX_DIMENSION = 2048
+RESIZE_CACHE_MAX_AGE = 60 * 60 * 24 * 365
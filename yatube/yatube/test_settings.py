@@ -0,0 +1,33 @@
+"""Настройки для тестов.
+
+Кроме default, тестам нужны базы шарда (posts.tests.test_shards)
+и архива (posts.tests.test_archive): тестовый раннер создаёт их для
+тестов, у которых они указаны в databases.
+
+Тестовая default лежит в файле, а не в памяти: пул миниатюр пишет
+в неё из своих потоков (см. posts.tests.test_views.ThumbnailPoolTest).
+"""
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES
+
+DATABASES = {
+    **DATABASES,
+    'default': {
+        **DATABASES['default'],
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
+    },
+    'shard': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+    'archive': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+}
+
+# Миниатюры готовятся прямо при сохранении поста; пул проверяет
+# ThumbnailPoolTest.
+POST_THUMBNAIL_WORKERS = 0
@@ -1,7 +1,8 @@
 from django.contrib import admin
 from django.urls import include, path
 from django.conf import settings
-from django.conf.urls.static import static
+
+from core.views import media
 
 
 urlpatterns = [
@@ -10,14 +11,10 @@ urlpatterns = [
     path('auth/', include('django.contrib.auth.urls')),
     path('about/', include('about.urls', namespace='about')),
     path('', include('posts.urls', namespace='posts')),
+    path(f'{settings.MEDIA_URL.strip("/")}/<path:path>', media,
+         name='media'),
 ]
 
 handler404 = 'core.views.page_not_found'
 handler500 = 'core.views.internal_server_error'
 handler403 = 'core.views.error_403'
-
-
-if settings.DEBUG:
-    urlpatterns += static(
-        settings.MEDIA_URL, document_root=settings.MEDIA_ROOT
-    )